@@ -0,0 +1,70 @@
+"""Compare the cost of sending a screenshot as base64 inside a JSON message
+against sending it as an attachment frame.
+
+For each screenshot size the benchmark times the three places a screenshot
+is handled: the client encoding it, the server decoding it off the wire and
+the server encoding it again for an admin. It also reports how many bytes each
+form puts on the wire.
+
+Usage: python benchmarks/attachment_bench.py
+"""
+import os
+import sys
+import json
+import time
+import base64
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from qa_common import FrameDecoder, Attachment, encode_frame, encode_message
+
+SIZES = [100 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+
+def best_of(function, repeat=5):
+    """Return the best time of <repeat> calls of <function>."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def decode(wire):
+    """Decode <wire> the way the server does, returning the message dictionary."""
+    decoder = FrameDecoder()
+    decoder.feed(wire)
+    message = decoder.next_frame()
+    if isinstance(message, Attachment):
+        header = json.loads(message.header)
+        header["attachment"] = message.body
+        return header
+    return json.loads(message)[1]
+
+def base64_encode(screenshot):
+    return encode_frame({"type":"screenshot",
+                         "screenshot":base64.b64encode(screenshot).decode('ascii')})
+
+def attachment_encode(screenshot):
+    return encode_message({"type":"screenshot", "attachment":screenshot})
+
+def main():
+    print("size_bytes,form,wire_bytes,client_encode_ms,server_decode_ms,"
+          "server_encode_ms")
+    for size in SIZES:
+        screenshot = os.urandom(size)
+        for form, encode in (("base64", base64_encode), 
+                             ("attachment", attachment_encode)):
+            wire = encode(screenshot)
+            message = decode(wire)
+            message["username"] = "student"
+            message["timestamp"] = 0
+            if form == "base64":
+                server_encode = lambda: encode_frame(message)
+            else:
+                server_encode = lambda: encode_message(message)
+            print("{},{},{},{:.3f},{:.3f},{:.3f}".format(
+                size, form, len(wire),
+                best_of(lambda: encode(screenshot)) * 1e3,
+                best_of(lambda: decode(wire)) * 1e3,
+                best_of(server_encode) * 1e3))
+
+if __name__ == '__main__':
+    main()
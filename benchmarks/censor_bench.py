@@ -0,0 +1,84 @@
+"""Show that censoring a message costs time linear in its length and
+independent of the size of the swear word list.
+
+For each list size and message length the benchmark censors a message of
+ordinary words with a few swear words mixed in, and reports the time per
+character. The SwearFilter rows should stay flat down each column and across
+list sizes. For comparison it also times the naive approach of running one
+regular expression per word, which grows with the size of the list.
+
+Usage: python benchmarks/censor_bench.py
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from qa_censor import SwearFilter
+
+WORD_LIST = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                         "swear_word_list", "swear_word_list.json")
+LENGTHS = [100, 1000, 10000, 100000]
+LIST_SIZES = [10, 245, 2500, 25000]
+FILLER = ("the quick brown fox jumps over a lazy dog while students ask "
+          "questions about their assignments in the lab").split()
+
+def best_of(function, repeat=5):
+    """Return the best time of <repeat> calls of <function>."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def word_list(size):
+    """Return <size> words, starting with the shipped list and padded out with
+    made up words."""
+    with open(WORD_LIST) as word_list:
+        words = [word.strip() for word in json.load(word_list)][:size]
+    rng = random.Random(size)
+    while len(words) < size:
+        words.append("".join(rng.choice("abcdefghijklmnopqrstuvwxyz")
+                             for _ in range(rng.randrange(4, 12))))
+    return words
+
+def message(length, words):
+    """Return a message of about <length> characters, one word in twenty of
+    which is from <words>."""
+    rng = random.Random(length)
+    parts = []
+    while sum(len(part) + 1 for part in parts) < length:
+        if rng.randrange(20):
+            parts.append(rng.choice(FILLER))
+        else:
+            parts.append(rng.choice(words))
+    return " ".join(parts)[:length]
+
+def naive_censor(patterns, text):
+    for pattern in patterns:
+        text = pattern.sub(lambda match: "*" * len(match.group()), text)
+    return text
+
+def main():
+    print("list_size,message_chars,filter,ns_per_char")
+    for size in LIST_SIZES:
+        words = word_list(size)
+        swear_filter = SwearFilter(words)
+        patterns = [re.compile(r"\b" + re.escape(word) + r"\b", re.IGNORECASE)
+                    for word in words]
+        for length in LENGTHS:
+            text = message(length, words)
+            print("{},{},aho-corasick,{:.1f}".format(
+                size, length,
+                best_of(lambda: swear_filter.censor(text)) / length * 1e9))
+            if length <= 10000:
+                print("{},{},regex-per-word,{:.1f}".format(
+                    size, length,
+                    best_of(lambda: naive_censor(patterns, text), repeat=1)
+                    / length * 1e9))
+
+if __name__ == '__main__':
+    main()
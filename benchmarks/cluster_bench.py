@@ -0,0 +1,106 @@
+"""Compare the throughput of a single process server with a multi-process
+one.
+
+For each worker count a server is started in its own process with the
+event loop engine, no speaking floor and rate limits high enough not to get
+in the way. Client processes log on, then every sender publishes its share
+of the messages as fast as it can while every receiver counts the public
+messages that reach it. Throughput is the number of messages delivered to
+receivers per second, from the first message sent to the last one received.
+
+With one worker every delivery is made by a single process. With more, the
+kernel spreads the connections between the workers with SO_REUSEPORT and
+each worker only writes to its own connections, so on a machine with a
+core to spare per worker throughput should grow with the worker count until
+the hub, which handles every message once, becomes the limit.
+
+Usage: python benchmarks/cluster_bench.py [messages per sender] [workers...]
+"""
+import os
+import sys
+import json
+import time
+import socket
+import multiprocessing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from qa_common import FrameDecoder, encode_frame
+from qa_loadgen import spawn_server
+
+SENDERS = 4
+RECEIVERS = 16
+
+def logon(port, username):
+    connection = socket.create_connection(("localhost", port))
+    connection.sendall(encode_frame(
+        {"type":"logon",
+         "user":{"username":username, "privileges":{"type":"user"}},
+         "server":{"protocol":"QAServ1.0", "client":"cluster_bench"}}))
+    decoder = FrameDecoder()
+    while decoder.next_frame() is None: # The room message
+        decoder.recv_into(connection)
+    return connection, decoder
+
+def receiver(port, number, expected, ready, start, results):
+    connection, decoder = logon(port, "receiver" + str(number))
+    ready.put(number)
+    start.wait()
+    received = 0
+    while received < expected:
+        message = decoder.next_frame()
+        if message is None:
+            if not decoder.recv_into(connection):
+                break
+        elif '"pubmsg"' in message:
+            received += 1
+    results.put((received, time.perf_counter()))
+
+def sender(port, number, count, ready, start):
+    connection, decoder = logon(port, "sender" + str(number))
+    ready.put(number)
+    start.wait()
+    frames = [encode_frame({"type":"pubmsg", "msg":str(sequence)})
+              for sequence in range(count)]
+    for frame in frames:
+        connection.sendall(frame)
+    time.sleep(60) # Keep the connection open until the receivers are done
+
+def run(workers, count):
+    server, (host, port) = spawn_server("eventloop", workers,
+                                        ["--send-queue-messages", "1000000"])
+    ready = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    start = multiprocessing.Event()
+    expected = SENDERS * count
+    clients = [multiprocessing.Process(target=receiver, args=(
+                   port, number, expected, ready, start, results))
+               for number in range(RECEIVERS)]
+    clients += [multiprocessing.Process(target=sender, args=(
+                    port, number, count, ready, start))
+                for number in range(SENDERS)]
+    for client in clients:
+        client.start()
+    for _ in clients:
+        ready.get(timeout=30)
+    started = time.perf_counter()
+    start.set()
+    finished = [results.get(timeout=120) for _ in range(RECEIVERS)]
+    elapsed = max(finish for received, finish in finished) - started
+    delivered = sum(received for received, finish in finished)
+    for client in clients:
+        client.terminate()
+    server.terminate()
+    server.wait()
+    return {"workers":workers,
+            "delivered":delivered,
+            "seconds":round(elapsed, 3),
+            "deliveries_per_second":round(delivered / elapsed)}
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    worker_counts = [int(workers) for workers in sys.argv[2:]] or \
+        [1, max(2, os.cpu_count() or 1)]
+    print(json.dumps([run(workers, count) for workers in worker_counts],
+                     indent=1))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Compare the JSON wire encoding with the binary one.
+
+For a few typical messages the benchmark times encoding a message, which
+the server does once per codec for every message it fans out, and decoding
+it off the wire with a FrameDecoder into a message dictionary, which the
+server does for everything a client sends. It also reports how many bytes
+each encoding puts on the wire. Screenshots are sent as base64 in JSON and
+as raw bytes in a binary frame.
+
+Usage: python benchmarks/codec_bench.py [repetitions]
+"""
+import os
+import sys
+import json
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from qa_common import (FrameDecoder, encode_frame, encode_binary_frame,
+                       attachment_to_base64)
+
+MESSAGES = {
+    "pubmsg":{"type":"pubmsg", "msg":"Is the answer to question 3 a tree?",
+              "username":"student12", "timestamp":1700000000, "seq":4812},
+    "room":{"type":"room", "room":"main", "topic":"Data structures lab",
+            "users":["student" + str(number) for number in range(40)],
+            "username":"student12", "history":0, "seq":4812, "roster":97,
+            "resumed":False, "timestamp":1700000000,
+            "server":{"protocol":"QAServ1.0", "features":["binary", "roster"]}},
+    "screenshot":{"type":"screenshot", "username":"student12",
+                  "timestamp":1700000000, "attachment":os.urandom(100 * 1024)},
+}
+
+def json_encode(message):
+    if "attachment" in message:
+        message = attachment_to_base64(message, message["type"])
+    return encode_frame(message)
+
+def json_decode(decoder, wire):
+    decoder.feed(wire)
+    return json.loads(decoder.next_frame())[1]
+
+def binary_decode(decoder, wire):
+    decoder.feed(wire)
+    return decoder.next_frame().message
+
+def rate(function, argument, repetitions):
+    """Return the best calls per second of <function> over three runs."""
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(repetitions):
+            function(argument)
+        best = min(best, time.perf_counter() - start)
+    return repetitions / best
+
+def main():
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print("message,codec,bytes,encodes_per_second,decodes_per_second")
+    for name, message in MESSAGES.items():
+        count = repetitions if name != "screenshot" else repetitions // 100
+        for codec, encode, decode in (("json", json_encode, json_decode),
+                                      ("binary", encode_binary_frame,
+                                       binary_decode)):
+            wire = encode(message)
+            decoder = FrameDecoder()
+            print("{},{},{},{:.0f},{:.0f}".format(
+                name, codec, len(wire), rate(encode, message, count),
+                rate(lambda wire: decode(decoder, wire), wire, count)))
+
+if __name__ == '__main__':
+    main()
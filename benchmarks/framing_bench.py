@@ -0,0 +1,87 @@
+"""Benchmark the cost of encoding and decoding MRC frames of increasing size.
+
+Each message is read into a FrameDecoder with recv_into() from a stand-in
+socket, READ_SIZE bytes at a time, the same way the receive loops read it off
+a real socket. If decoding is linear in the size of the message the time per
+kilobyte should stay flat as the message grows.
+
+Encoding is timed for encode_frame() against the old approach of dumping the
+message repeatedly until the length header stops changing.
+
+Usage: python benchmarks/framing_bench.py [read size]
+"""
+import os
+import sys
+import json
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from qa_common import FrameDecoder, encode_frame
+
+SIZES = [1024, 16 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+READ_SIZE = 1024
+
+class StreamSocket:
+    """Stand-in for a socket that hands out the bytes <wire> to recv_into()."""
+    def __init__(self, wire):
+        self._wire = memoryview(wire)
+        self._offset = 0
+
+    def recv_into(self, buffer):
+        size = min(len(buffer), len(self._wire) - self._offset)
+        buffer[:size] = self._wire[self._offset:self._offset + size]
+        self._offset += size
+        return size
+
+def make_frame(size):
+    """Return a pubmsg frame roughly <size> bytes long."""
+    message = {"type":"pubmsg", "msg":"x" * size}
+    body = json.dumps(message)
+    length = len(body) + 9
+    while len(json.dumps([length, message]) + "\r\n\r\n") != length:
+        length = len(json.dumps([length, message]) + "\r\n\r\n")
+    return (json.dumps([length, message]) + "\r\n\r\n").encode('utf-8')
+
+def decode_in_reads(wire):
+    """Read <wire> into a fresh decoder one read at a time and return the time
+    taken to get the message back out."""
+    connection = StreamSocket(wire)
+    decoder = FrameDecoder(read_size=READ_SIZE)
+    start = time.perf_counter()
+    message = None
+    while message is None:
+        decoder.recv_into(connection)
+        message = decoder.next_frame()
+    elapsed = time.perf_counter() - start
+    assert message is not None
+    return elapsed
+
+def time_call(function, argument):
+    """Return the best time of three calls of <function> with <argument>."""
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        function(argument)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    global READ_SIZE
+    if len(sys.argv) > 1:
+        READ_SIZE = int(sys.argv[1])
+    print("decode")
+    print("size_bytes,seconds,us_per_kb")
+    for size in SIZES:
+        wire = make_frame(size)
+        elapsed = min(decode_in_reads(wire) for _ in range(3))
+        print("{},{:.6f},{:.3f}".format(
+            len(wire), elapsed, elapsed * 1e6 / (len(wire) / 1024)))
+    print("encode")
+    print("size_bytes,recursive_seconds,encode_frame_seconds")
+    for size in SIZES:
+        message = {"type":"pubmsg", "msg":"x" * size}
+        print("{},{:.6f},{:.6f}".format(
+            len(make_frame(size)), time_call(make_frame, size),
+            time_call(encode_frame, message)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+"""Run the microbenchmarks of the hot paths of the server and compare them
+with a stored baseline.
+
+Each case times one operation: encoding and decoding frames with both
+codecs across message sizes, and PublishSubscribe filtering, broadcasting
+and dispatching a message through pub_sub_loop across subscriber counts.
+Screenshots are timed from filter_screenshot() through the screenshot store
+to the room's administrators.
+The cost of keeping metrics is measured by recording into a histogram and
+by dispatching with the server's Metrics enabled.
+A case is run for long enough to be timed reliably, five times over, and
+the best time per operation is kept. Its score is that time divided by 
+the time of the calibration workload.
+
+The first run on a machine stores its results as the baseline, as does any
+run given --save. Every other run is compared with the baseline and the
+script exits with status 1 if any case got slower by more than the
+threshold. Baselines only mean anything on the machine that made them, so
+they are kept out of the repository. Even on one machine the speed of a
+run can drift with the clock speed and whatever else is running, so right
+before each case a fixed calibration workload is timed as well, and what
+is compared with the baseline is the time of the case relative to it. A
+case that still looks slower is timed again, up to --retries more times,
+and only counts as a regression if it never gets back under the threshold.
+
+Usage: python benchmarks/run.py [--save] [--threshold PERCENT] [--retries N]
+                                [--baseline FILE] [--filter TEXT]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import threading
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from qa_common import (FrameDecoder, encode_frame, encode_binary_frame,
+                       frame_length, FEATURE_ATTACHMENTS,
+                       FEATURE_SCREENSHOT_REFS)
+from qa_censor import SwearFilter
+from qa_server import PublishSubscribe
+from qa_metrics import Metrics, MetricsRegistry
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "baseline.json")
+SIZES = [100, 10 * 1024, 1024 * 1024]
+SUBSCRIBERS = [1, 40, 400, 4000]
+ADMINS = [1, 10]
+SCREENSHOT_SIZE = 100 * 1024
+
+class NullConnection:
+    """Stands in for a connection handler, throwing away what it is sent."""
+    def __init__(self, number, privilege="user"):
+        self.user_info = {"username":"user" + str(number),
+                          "privileges":{"type":privilege}}
+        self.features = frozenset()
+
+    def put_msg(self, frame, kind=None):
+        pass
+
+    def logon_info(self):
+        return {"user_info":self.user_info, "server_info":{}}
+
+class CountingConnection(NullConnection):
+    """A NullConnection that lets a waiting thread know once it has been sent
+    <expected> messages."""
+    def __init__(self, number):
+        super().__init__(number)
+        self.expected = None
+        self.received = 0
+        self.done = threading.Event()
+
+    def put_msg(self, frame, kind=None):
+        self.received += 1
+        if self.received == self.expected:
+            self.done.set()
+
+def pubmsg(size):
+    return {"type":"pubmsg", "msg":"x" * size, "username":"user0",
+            "timestamp":1700000000}
+
+def room(subscribers, swear_filter=None, admins=0):
+    pubsub = PublishSubscribe(swear_filter=swear_filter)
+    connections = [NullConnection(number, "admin" if number < admins else "user")
+                   for number in range(subscribers)]
+    for connection in connections:
+        pubsub.subscribe(connection, connection.logon_info())
+    return pubsub, connections
+
+def encode_case(encode, size):
+    message = pubmsg(size)
+    return lambda: encode(message)
+
+def decode_case(encode, size):
+    wire = encode(pubmsg(size))
+    decoder = FrameDecoder()
+    def decode():
+        decoder.feed(wire)
+        return decoder.next_frame()
+    return decode
+
+def frame_length_case(size):
+    return lambda: frame_length(size)
+
+def filter_case(subscribers):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                           "swear_word_list", "swear_word_list.json")) as words_file:
+        words = json.load(words_file)
+    pubsub, connections = room(subscribers, SwearFilter(words))
+    message = pubmsg(100)
+    return lambda: pubsub.filter_pubmsg(pubsub.recipients, connections[0],
+                                        dict(message))
+
+def broadcast_case(subscribers):
+    pubsub, connections = room(subscribers)
+    message = pubmsg(100)
+    return lambda: pubsub.broadcast(dict(message))
+
+def screenshot_case(admins):
+    """Time a screenshot sent to a room of 40 with <admins> administrators,
+    every other one of which negotiated screenshot references while the rest
+    are sent the whole screenshot as an attachment."""
+    pubsub, connections = room(40, admins=admins)
+    for number, connection in enumerate(connections[:admins]):
+        features = [FEATURE_ATTACHMENTS]
+        if number % 2:
+            features.append(FEATURE_SCREENSHOT_REFS)
+        connection.features = frozenset(features)
+    body = os.urandom(SCREENSHOT_SIZE)
+    def screenshot():
+        pubsub.filter_screenshot(pubsub.recipients, connections[-1],
+                                 {"type":"screenshot", "username":"user39",
+                                  "timestamp":1700000000, "attachment":body})
+    return screenshot
+
+def dispatch_case(subscribers):
+    """Time messages going through the room's queue and pub_sub_loop to
+    every subscriber, measured as the time for a batch of them over the
+    batch size."""
+    pubsub, connections = room(subscribers - 1)
+    last = CountingConnection(subscribers)
+    pubsub.subscribe(last, last.logon_info())
+    pubsub.start()
+    sender = last if not connections else connections[0]
+    batch = 50
+    def dispatch():
+        last.received = 0
+        last.expected = batch
+        last.done.clear()
+        for _ in range(batch):
+            pubsub.put_msg_into_publish_queue((pubmsg(100), sender))
+        last.done.wait()
+    dispatch.batch = batch
+    return dispatch
+
+def metrics_dispatch_case(subscribers):
+    """dispatch_case() with the server's Metrics enabled while it runs."""
+    dispatch = dispatch_case(subscribers)
+    def timed_dispatch():
+        Metrics.enabled = True
+        try:
+            dispatch()
+        finally:
+            Metrics.enabled = False
+    timed_dispatch.batch = dispatch.batch
+    return timed_dispatch
+
+def metrics_record_case():
+    """Time one timing of the kind the server takes while metrics are on."""
+    histogram = MetricsRegistry(enabled=True).histogram("dispatch.pubmsg")
+    def record():
+        started = time.perf_counter()
+        histogram.record(time.perf_counter() - started)
+    return record
+
+def cases(selected=""):
+    """Return a list of (name, function) pairs, one for each case whose name
+    contains <selected>. Cases that aren't selected are never set up, so 
+    their rooms and threads aren't started."""
+    found = []
+    def add(name, make, *arguments):
+        if selected in name:
+            found.append((name, make(*arguments)))
+    for size in SIZES:
+        add("encode_frame[{}]".format(size), encode_case, encode_frame, size)
+        add("decode_frame[{}]".format(size), decode_case, encode_frame, size)
+        add("encode_binary[{}]".format(size),
+            encode_case, encode_binary_frame, size)
+        add("decode_binary[{}]".format(size),
+            decode_case, encode_binary_frame, size)
+        add("frame_length[{}]".format(size), frame_length_case, size)
+    for subscribers in SUBSCRIBERS:
+        add("filter_pubmsg[{}]".format(subscribers), filter_case, subscribers)
+        add("broadcast[{}]".format(subscribers), broadcast_case, subscribers)
+        add("dispatch[{}]".format(subscribers), dispatch_case, subscribers)
+    for admins in ADMINS:
+        add("filter_screenshot[{}]".format(admins), screenshot_case, admins)
+    add("metrics_record", metrics_record_case)
+    add("dispatch_metrics[40]", metrics_dispatch_case, 40)
+    return found
+
+def time_case(function, repeat=5, target=0.2):
+    """Return the best time in nanoseconds of one call of <function>, taken
+    from <repeat> runs of as many calls as fill <target> seconds."""
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= target / 10:
+            break
+        calls *= 10
+    calls = max(1, int(calls * target / max(elapsed, 1e-9)))
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        best = min(best, (time.perf_counter() - start) / calls)
+    return best * 1e9 / getattr(function, "batch", 1)
+
+def calibration():
+    """Return the time in nanoseconds of a fixed workload of the dictionary,
+    string and list operations the cases are made of."""
+    def workload():
+        parts = []
+        for number in range(100):
+            message = {"type":"pubmsg", "msg":str(number)}
+            parts.append(message["msg"] + message["type"])
+        return "".join(parts)
+    return time_case(workload, repeat=3, target=0.05)
+
+def compare(scores, baseline, threshold):
+    """Return the names of the cases whose <scores> are more than <threshold>
+    percent higher than in <baseline>."""
+    regressions = []
+    for name, score in scores.items():
+        before = baseline.get(name)
+        if before and score > before * (1 + threshold / 100.0):
+            regressions.append(name)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--save", action="store_true",
+                        help="Store the results as the new baseline.")
+    parser.add_argument("--threshold", default=25.0, type=float,
+                        help="Percent slower than the baseline a case may get"
+                        " before it counts as a regression.")
+    parser.add_argument("--baseline", default=BASELINE,
+                        help="File the baseline is kept in.")
+    parser.add_argument("--retries", default=2, type=int,
+                        help="How many more times to time a case that looks "
+                        "like it regressed.")
+    parser.add_argument("--filter", default="",
+                        help="Only run the cases whose names contain this.")
+    arguments = parser.parse_args(argv)
+    baseline = {}
+    if os.path.exists(arguments.baseline):
+        with open(arguments.baseline) as baseline_file:
+            baseline = json.load(baseline_file)["scores"]
+    results = {}
+    scores = {}
+    for name, function in cases(arguments.filter):
+        for attempt in range(arguments.retries + 1):
+            reference = calibration()
+            nanoseconds = time_case(function)
+            if name not in scores or nanoseconds / reference < scores[name]:
+                results[name] = nanoseconds
+                scores[name] = nanoseconds / reference
+            if not compare({name:scores[name]}, baseline, arguments.threshold):
+                break
+    regressions = compare(scores, baseline, arguments.threshold)
+    print("case,ns_per_op,score,baseline_score,change_percent")
+    for name, nanoseconds in results.items():
+        before = baseline.get(name)
+        change = "" if not before else "{:+.1f}".format(
+            (scores[name] / before - 1) * 100)
+        print("{},{:.0f},{:.4f},{}{}{}".format(
+            name, nanoseconds, scores[name],
+            "" if not before else "{:.4f}".format(before), "," + change,
+            " REGRESSION" if name in regressions else ""))
+    if arguments.save or not baseline:
+        with open(arguments.baseline, "w") as baseline_file:
+            json.dump({"machine":platform.platform(),
+                       "python":platform.python_version(),
+                       "scores":dict(baseline, **scores),
+                       "ns_per_op":results},
+                      baseline_file, indent=1, sort_keys=True)
+        print("Stored the results as the baseline in", arguments.baseline)
+    elif regressions:
+        print(len(regressions), "cases regressed by more than",
+              arguments.threshold, "percent.")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
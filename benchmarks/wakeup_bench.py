@@ -0,0 +1,63 @@
+"""Measure how long a published message takes to reach another client under
+light load.
+
+A threaded QAServer is started on loopback with two clients logged on. One
+client sends a pubmsg every few milliseconds and the other records how long
+each one took to arrive. Before connections could be woken when a message was
+queued for them every delivery waited for the next 100 ms select() timeout,
+so the histogram would sit around 50 ms with a tail near 100 ms.
+
+Usage: python benchmarks/wakeup_bench.py [message count]
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import threading
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from qa_server import RoomDirectory, QAServer, MRCStreamHandler
+from qa_common import FrameDecoder, LatencyHistogram, encode_frame
+
+def logon(address, username):
+    connection = socket.create_connection(address)
+    connection.sendall(encode_frame(
+        {"type":"logon",
+         "user":{"username":username, "privileges":{"type":"user"}},
+         "server":{"protocol":"QAServ1.0", "client":"wakeup_bench"}}))
+    return connection
+
+def receive(connection, decoder):
+    message = decoder.next_frame()
+    while message is None:
+        decoder.feed(connection.recv(65536))
+        message = decoder.next_frame()
+    return json.loads(message)[1]
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    RoomDirectory()
+    server = QAServer(("localhost", 0), MRCStreamHandler)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    sender = logon(server.server_address, "sender")
+    sender_decoder = FrameDecoder()
+    receive(sender, sender_decoder)
+    receiver = logon(server.server_address, "receiver")
+    receiver_decoder = FrameDecoder()
+    receive(receiver, receiver_decoder)
+    histogram = LatencyHistogram()
+    for sequence in range(count):
+        time.sleep(random.uniform(0.002, 0.01))
+        sent_at = time.perf_counter()
+        sender.sendall(encode_frame({"type":"pubmsg", "msg":str(sequence)}))
+        message = receive(receiver, receiver_decoder)
+        while message.get("msg") != str(sequence):
+            message = receive(receiver, receiver_decoder)
+        histogram.record(time.perf_counter() - sent_at)
+    print(json.dumps(histogram.summary(), indent=1))
+
+if __name__ == '__main__':
+    main()
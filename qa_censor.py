@@ -0,0 +1,110 @@
+# Swear word filter for public messages sent to the QA room
+import json
+
+class SwearFilter():
+    """Masks swear words in message text with asterisks.
+
+    Every word in the list is compiled into a single Aho-Corasick automaton,
+    so a message is censored in one pass over its text whose cost depends on
+    the length of the message and not on how many words are in the list.
+    Matching ignores case, and a word is only masked where it stands on its
+    own, so 'ass' is masked in 'kiss my ass' but not in 'class'.
+
+    The word list is a JSON list of strings, surrounding whitespace (such as
+    the trailing newlines in swear_word_list.json) is ignored. reload() reads
+    the list again and swaps the new automaton in without blocking messages
+    being censored with the old one.
+    """
+    def __init__(self, words=(), path=None):
+        self.path = path
+        self._automaton = self._compile(words)
+
+    @classmethod
+    def from_file(cls, path):
+        """Return a SwearFilter for the word list in the JSON file <path>."""
+        swear_filter = cls(path=path)
+        swear_filter.reload()
+        return swear_filter
+
+    def reload(self, words=None):
+        """Replace the word list with <words>, or with the contents of the
+        file the filter was loaded from if no words are given."""
+        if words is None:
+            with open(self.path) as word_file:
+                words = json.load(word_file)
+        self._automaton = self._compile(words)
+        return True
+
+    def __len__(self):
+        return self._automaton[3]
+
+    def censor(self, text):
+        """Return <text> with every swear word in it replaced by asterisks."""
+        transitions, failures, outputs, word_count = self._automaton
+        masks = []
+        state = 0
+        for position, character in enumerate(text):
+            character = _fold(character)
+            while state and character not in transitions[state]:
+                state = failures[state]
+            state = transitions[state].get(character, 0)
+            for length in outputs[state]:
+                start = position - length + 1
+                if (_is_boundary(text, start - 1) and
+                    _is_boundary(text, position + 1)):
+                    masks.append((start, position + 1))
+                    break # The longest word ending here covers the others
+        if not masks:
+            return text
+        censored = list(text)
+        for start, end in masks:
+            censored[start:end] = "*" * (end - start)
+        return "".join(censored)
+
+    @staticmethod
+    def _compile(words):
+        """Build the automaton for <words>, returned as a tuple of the goto
+        transitions, failure links and output word lengths of each state,
+        longest first, along with the number of words."""
+        transitions = [dict()]
+        lengths = [set()]
+        word_count = 0
+        for word in words:
+            word = "".join(_fold(character) for character in word.strip())
+            if not word:
+                continue
+            word_count += 1
+            state = 0
+            for character in word:
+                if character not in transitions[state]:
+                    transitions.append(dict())
+                    lengths.append(set())
+                    transitions[state][character] = len(transitions) - 1
+                state = transitions[state][character]
+            lengths[state].add(len(word))
+        # Breadth first so a state's failure link is finished before its
+        # children need it, and each state inherits the words ending at the
+        # state it fails to.
+        failures = [0] * len(transitions)
+        queue = list(transitions[0].values())
+        for state in queue:
+            for character, child in transitions[state].items():
+                failure = failures[state]
+                while failure and character not in transitions[failure]:
+                    failure = failures[failure]
+                failures[child] = transitions[failure].get(character, 0)
+                lengths[child] |= lengths[failures[child]]
+                queue.append(child)
+        outputs = [tuple(sorted(found, reverse=True)) for found in lengths]
+        return (transitions, failures, outputs, word_count)
+
+def _fold(character):
+    """Lower case <character> without changing the length of the text it is
+    part of, so match positions line up with the original text."""
+    folded = character.lower()
+    return folded if len(folded) == 1 else character
+
+def _is_boundary(text, position):
+    """Return whether <position> is just outside a word in <text>."""
+    return (position < 0 or position >= len(text) or
+            not (text[position].isalnum() or text[position] == "_"))
@@ -6,8 +6,15 @@ import socket
 import random
 import json
 import base64
+import itertools
 # import pyscreenshot
 import cmd
+from qa_common import (FrameDecoder, DEFAULT_READ_SIZE, encode_message, 
+                       encode_binary_frame, Attachment, BinaryMessage,
+                       ATTACHMENT_PREFIX, FEATURE_ATTACHMENTS, FEATURE_BINARY,
+                       FEATURE_STREAMS, FEATURE_SCREENSHOT_REFS, FEATURE_ROSTER,
+                       FEATURE_DEFLATE, CHUNK_SIZE, STREAM_WINDOW, OutputBuffer,
+                       StreamError, JSONDecodeError)
 
 class QAClientLogic():
     """Question Answer client that provides both administrator and user interfaces.
@@ -20,7 +27,11 @@ class QAClientLogic():
     You have been warned.
 
     """
-    def __init__(self):
+    # Messages the server numbers with the room's sequence numbers
+    sequenced_types = frozenset(["pubmsg"])
+
+    def __init__(self, read_size=DEFAULT_READ_SIZE):
+        self.read_size = read_size
         if os.name == 'posix':
             self.confpath = os.path.join(os.path.expanduser("~"), ".mrc/qa_system/",
                                          "client/settings.conf")
@@ -28,7 +39,22 @@ class QAClientLogic():
             self.confpath = os.path.join(os.environ['APPDATA'] + "\\mrc\\qa_system\\",
                                          "client\\settings.conf")
         self.registry = {}
+        self.connection = None
+        self.host = None
+        self.port = 9665
+        self.username = None # Chosen at the first logon and kept after that
+        self.room = None # The name of the room to join or that was joined
+        self.resume_token = None # Given by the server to resume the session
+        self.last_seq = None # Sequence number of the last message seen
+        self.roster_version = None # Version of the room roster last seen
+        self.features = frozenset() # Protocol features the server agreed to
+        self._streams = {} # Outgoing streams by stream id
+        self._streams_lock = threading.Lock()
+        self._stream_ids = itertools.count()
+        self._incoming_streams = {} # Chunks of incoming streams by stream id
         self.pubmsg_queue = queue.Queue()
+        self.send_queue = queue.Queue()
+        self._unsent = [] # Encoded messages a stopped send loop didn't send
         self.connection_error = threading.Event()
         self._shutdown = self.Shutdown()
 
@@ -36,6 +62,7 @@ class QAClientLogic():
         """Make a connection to a given host. If host not given make a connection
         to the address specified in the config file."""
         # Try connecting to given host
+        self.port = port
         self.connection = self.make_connection(hostname, port)
         if self.connection:
             self.host = hostname
@@ -60,18 +87,37 @@ class QAClientLogic():
         self.instantiate_components(self.connection)
         return True
 
-    def reconnect(self, hostname, port=9665):
+    def reconnect(self, hostname=None, port=None):
         """Reconnect a running QAClientLogic instance to the host given by 
-        hostname on the given port."""
-        self._shutdown.set()
-        self._shutdown.synchronize_restart().wait()
-        del(self.Sender)
-        del(self.Receive)
-        if self.connection:
-            self.connection = self.make_connection(hostname, port)
-        else:
+        hostname on the given port, or to the one it was connected to.
+
+        The old connection is closed and its send and receive loops stop,
+        handing any messages that weren't sent over to the new connection.
+        If the client had logged on it logs on again with the resume token
+        the server gave it and the sequence number of the last message it 
+        saw, so it keeps its username and room and is sent only what it
+        missed while it was disconnected."""
+        hostname = hostname or self.host
+        port = port or self.port
+        connection = self.make_connection(hostname, port)
+        if not connection:
             return False
-        self.instantiate_components(self, self.connection)
+        old_connection = self.connection
+        self.connection = connection
+        self.host, self.port = hostname, port
+        if old_connection:
+            try:
+                old_connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            old_connection.close()
+            self.send_queue.put(None) # Wake the old send loop so it stops
+            self.Sender.join()
+            self.Receiver.join()
+        if self.resume_token is not None:
+            self._unsent.insert(0, encode_message(self.build_initial_connect_msg()))
+        self.connection_error.clear()
+        self.instantiate_components(connection)
         return True
 
     def make_connection(self, hostname=None, port=9665):
@@ -100,8 +146,12 @@ class QAClientLogic():
         self.registry['Receiver'].wait()
         return True
 
-    def logon(self):
-        """Logon to the server."""
+    def logon(self, room=None):
+        """Logon to the server, joining the room called <room>. If no room is
+        given the one in the config file is joined if there is one, otherwise
+        the server's default room."""
+        if room is not None:
+            self.room = room
         logon_msg = self.build_initial_connect_msg()
         try:
             self.put_msg(logon_msg)
@@ -115,19 +165,54 @@ class QAClientLogic():
         Send a pubmsg to the server over this connection.
         """
         json_dict = {"type":"pubmsg", "msg":message_text}
-        message = [self._calculate_recursive_length(json_dict), json_dict]
-        self.put_msg(message)
+        self.put_msg(json_dict)
+        return True
+
+    def typing(self):
+        """Let the server know the user is typing, which takes the speaking 
+        floor for them if it's free and keeps hold of it if they have it."""
+        self.put_msg({"type":"typing"})
         return True
 
     def screenshot(self, screenshot_bytes):
         """Send a screenshot to the server given as the parameter 
-        <screenshot_bytes>."""
-        json_dict = {"type":"screenshot", 
-                     "screenshot":str(base64.b64encode(screenshot_bytes))}
-        message = [self._calculate_recursive_length(json_dict), json_dict]
-        self.put_msg(message)
+        <screenshot_bytes>. 
+
+        If the server agreed to the attachments feature at logon the bytes are
+        sent as they are in an attachment frame, otherwise they are base64 
+        encoded into an ordinary message."""
+        if FEATURE_ATTACHMENTS in self.features:
+            json_dict = {"type":"screenshot", "attachment":screenshot_bytes}
+        else:
+            json_dict = {"type":"screenshot", 
+                         "screenshot":base64.b64encode(screenshot_bytes).decode('ascii')}
+        self.put_msg(json_dict)
+        return True
+
+    def screenshot_file(self, filepath):
+        """Send the screenshot in the file at <filepath> to the server.
+
+        If the server agreed to the streams feature at logon the file is sent
+        a chunk at a time as the server gives credit for more, so it is never
+        read into memory whole and other messages can be sent in between its
+        chunks. Otherwise it is read and sent with screenshot()."""
+        screenshot_file = open(filepath, 'rb')
+        if FEATURE_STREAMS not in self.features:
+            with screenshot_file:
+                return self.screenshot(screenshot_file.read())
+        with self._streams_lock:
+            stream = self.OutgoingStream(next(self._stream_ids), "screenshot",
+                                         screenshot_file)
+            self._streams[stream.stream_id] = stream
+        self.put_msg(None) # Wake the send loop so it starts on the stream
+        return True
+
+    def fetch_screenshot(self, digest):
+        """Ask the server for the screenshot with the hash <digest> given in a 
+        screenshot_ref message. It arrives as an ordinary screenshot message
+        with the same hash."""
+        self.put_msg({"type":"fetch_screenshot", "hash":digest})
         return True
-        
 
     def quit(self):
         """Send a quit message to the server and close the connection."""
@@ -138,7 +223,8 @@ class QAClientLogic():
         #return True
 
     def get_msg(self):
-        """Get and return a pubmsg from the logic instances pubmsg queue."""
+        """Get and return a pubmsg from the logic instances pubmsg queue. 
+        Messages are lists of the form [<LENGTH>, <MESSAGE DICTIONARY>]."""
         return self.pubmsg_queue.get(block=False)
 
     def queue_msg(self, message):
@@ -169,8 +255,8 @@ class QAClientLogic():
         return True
 
     def build_initial_connect_msg(self):
-        """Create and return the string that is sent as the initial connect message
-        to the server."""
+        """Create and return the dictionary that is sent as the initial connect
+        message to the server."""
         connect_msg = {
             "user":{},
             "server":{}
@@ -183,33 +269,30 @@ class QAClientLogic():
         config = json.load(config_file)
         connect_msg["type"] = "logon"
         # Create user connect info
-        connect_msg["user"]["username"] = "Guest" + str(random.randrange(10000))
+        if self.username is None:
+            self.username = (config["user"].get("username") or
+                             "Guest" + str(random.randrange(10000)))
+        connect_msg["user"]["username"] = self.username
         connect_msg["user"]["privileges"] = dict()
         connect_msg["user"]["privileges"]["type"] = config["user"]["type"]
         if connect_msg["user"]["privileges"]["type"] not in ["user", "admin"]:
             raise ConfigurationError("User access was not 'user' or 'admin'.")
+        if config["user"].get("admin_key"):
+            connect_msg["server"]["admin_key"] = config["user"]["admin_key"]
         # Create server connect info
         connect_msg["server"]["protocol"] = "QAServ1.0"
         connect_msg["server"]["client"] = "QA_QT1.0"
-        recursive_length = self._calculate_recursive_length(connect_msg)
-        return [recursive_length, connect_msg]
+        connect_msg["server"]["features"] = [FEATURE_ATTACHMENTS, FEATURE_STREAMS,
+                                             FEATURE_SCREENSHOT_REFS, FEATURE_ROSTER,
+                                             FEATURE_DEFLATE, FEATURE_BINARY]
+        room = self.room or config["client"].get("room")
+        if room:
+            connect_msg["server"]["room"] = room
+        if self.resume_token is not None:
+            connect_msg["server"]["resume"] = self.resume_token
+            connect_msg["server"]["last_seq"] = self.last_seq or 0
+        return connect_msg
         
-    def _calculate_recursive_length(self, json_dict):
-        """Calculate the length of a dictionary represented as JSON once a length
-        field has been added as a key."""
-        delimiter = "\r\n\r\n"
-        initial_length = len(
-            json.dumps(json_dict) + delimiter)
-        initial_list = [initial_length, json_dict]
-        recursive_length = len(
-            json.dumps(initial_list) + delimiter)
-        recursive_list = [recursive_length, json_dict]
-        while len(json.dumps(recursive_list) + delimiter) != recursive_list[0]:
-            recursive_length = len(
-                json.dumps(recursive_list) + delimiter)
-            recursive_list = [recursive_length, json_dict]
-        return recursive_list[0]
-
     def send_loop(self, connection):
         """
         Manages messages sent from the client to the server.
@@ -226,30 +309,84 @@ class QAClientLogic():
         by this object. This method continually grabs items from that queue and
         uses the send() method of the connection object given as argument to send
         messages to the server. Messages are first dumped as a string and then
-        encoded as utf-8 before transfer.
+        encoded as utf-8 before transfer, except for messages carrying raw bytes
+        which are sent as attachment frames. Once the server has agreed to 
+        binary frames every message is sent as one instead.
+
+        Everything waiting in the queue is taken at once and written to the
+        socket together, see send_msg().
+
+        Chunks of outgoing streams are only sent when the queue is empty and
+        the stream has credit left, so messages put into the queue never wait
+        behind more than one chunk. A None put into the queue just wakes the
+        loop up to look at the streams again.
+
+        The loop stops once <connection> is no longer the client's connection
+        or can't be written to, leaving whatever it didn't send for the send
+        loop of the next connection to send first.
         """
-        self.send_queue = queue.Queue()
+        output = OutputBuffer()
+        for frame in self._unsent:
+            output.append(frame)
+        self._unsent = []
         self.registry['Sender'].set()
-        while not self._shutdown.is_set():
-            message = self.send_queue.get()
-            json_message = json.dumps(message) + '\r\n\r\n'
-            utf8_message = json_message.encode("utf-8")
-            self.send_msg(connection, utf8_message)
+        while not self._shutdown.is_set() and connection is self.connection:
+            if not output:
+                stream = self._ready_stream()
+                try:
+                    message = self.send_queue.get(block=stream is None)
+                except queue.Empty:
+                    message = self._next_chunk(stream)
+                encode = (encode_binary_frame if FEATURE_BINARY in self.features
+                          else encode_message)
+                while message is not None:
+                    output.append(encode(message))
+                    try:
+                        message = self.send_queue.get_nowait()
+                    except queue.Empty:
+                        message = None
+                if not output or connection is not self.connection:
+                    continue
+            if not self.send_msg(connection, output):
+                break
+        self._unsent.extend(output.clear())
         if self._shutdown.type() == 'restart':
             self._shutdown.synchronize_restart().wait()
         else:
             return True
             
 
-    def send_msg(self, connection, utf8_message):
-        """Send a message that the connection mainloop has in its send queue."""
-        while utf8_message:
-            print(utf8_message) #DEBUG
-            try:
-                sent = connection.send(utf8_message)
-            except socket.timeout:
-                self.handle_quit("Timeout occurred.")
-            utf8_message = utf8_message[sent:]
+    def _ready_stream(self):
+        """Return an outgoing stream which has credit to send a chunk, or None
+        if there isn't one."""
+        with self._streams_lock:
+            for stream in self._streams.values():
+                if stream.credit > 0:
+                    return stream
+        return None
+
+    def _next_chunk(self, stream):
+        """Return the next chunk of the outgoing <stream> as a message, and 
+        forget about the stream once its final chunk has been taken. Returns
+        None if the stream was dropped in the meantime."""
+        with self._streams_lock:
+            if self._streams.get(stream.stream_id) is not stream:
+                return None
+            chunk = stream.next_chunk()
+            if chunk["final"]:
+                self._streams.pop(stream.stream_id)
+        return chunk
+
+    def send_msg(self, connection, output):
+        """Send the messages in the OutputBuffer <output> that the mainloop 
+        took from its send queue, with as few system calls as possible. 
+        Returns False if the connection failed."""
+        try:
+            output.write_all(connection)
+        except OSError:
+            if connection is self.connection:
+                self.connection_error.set()
+            return False
         return True
 
     def put_msg(self, message):
@@ -259,76 +396,142 @@ class QAClientLogic():
     def receive_loop(self, connection):
         """Manages messages sent from the server to the client.
         The mainloop for the ReceiveLoop thread."""
-        msg_buffer = bytes() # The message input buffer
+        decoder = FrameDecoder(self.read_size) # The message input buffer
         self.registry['Receiver'].set()
         while not self._shutdown.is_set():
-            if msg_buffer:
-                try:
-                    msg_length = self.determine_length_of_json_msg(msg_buffer)
-                except InvalidLengthHeader:
-                    msg_length = float("inf")
-                if len(msg_buffer) >= msg_length:
-                    message = self.extract_msg(msg_buffer, msg_length)
-                    self.queue_msg(message)
-                    print("Message put into queue!",
-                          str(len(message)) + " bytes long!",
-                          repr(message)) #DEBUG
-                    msg_buffer = msg_buffer[msg_length:]
-                else:
-                    try:
-                        msg_buffer += connection.recv(1024)
-                    except socket.timeout:
-                        pass
+            message = decoder.next_frame()
+            if message is not None:
+                wrapped_msg = self.handle_server_msg(self.unwrap_msg(message))
+                if wrapped_msg is not None:
+                    self.queue_msg(wrapped_msg)
             else:
                 try:
-                    msg_buffer += connection.recv(1024)
+                    received = decoder.recv_into(connection)
                 except socket.timeout:
-                    pass
+                    continue
+                except socket.error:
+                    received = 0
+                if not received:
+                    if connection is self.connection:
+                        self.connection_error.set()
+                    return False
         if self._shutdown.type() == 'restart':
             self._shutdown.synchronize_restart().wait()
         else:
             return True
 
-    def determine_length_of_json_msg(self, message_bytes):
-        """Incrementally parse a JSON message to extract the length header.
-
-        message_bytes: The bytes that represent the portion of the message 
-        recieved.
-        """
-        # All messages must be written in utf-8
-        message = message_bytes.decode('utf-8')
-        # Check that the message we have been given looks like a valid length header
-        if "," not in message:
-            raise InvalidLengthHeader(message)
-        length_portion = message.split(",")[0]
-        left_bracket = length_portion[0] == "["
-        number_before_comma = length_portion[-1] in "1234567890"
-        if left_bracket and number_before_comma:
-            for character in enumerate(length_portion):
-                if character[1] not in "[ \n\t\r1234567890,":
-                    raise InvalidLengthHeader(length_portion)
-                elif character[1] in "1234567890":
-                    length_start = character[0]
-                    return int(length_portion[length_start:])
-        elif left_bracket:
-            raise InvalidLengthHeader(length_portion)
-        else:
-            raise MissingLengthHeader(length_portion)
-        return False
-
-    def extract_msg(self, msg_buffer, length):
-        message = msg_buffer[:length].decode()
+    def unwrap_msg(self, message):
+        """Decode a <message> pulled off the wire by the receive loop into a
+        list of the form [<LENGTH>, <MESSAGE DICTIONARY>]. The raw bytes of an
+        attachment frame are put into the dictionary under 'attachment'."""
+        if isinstance(message, BinaryMessage):
+            return [message.length, message.message]
+        if isinstance(message, Attachment):
+            header = json.loads(message.header)
+            header["attachment"] = message.body
+            length = (ATTACHMENT_PREFIX.size + len(message.header.encode('utf-8'))
+                      + len(message.body))
+            return [length, header]
         try:
-            right_curly_bracket = message[-6] == "}" or message[-2] == "}"
-        except IndexError:
-            print(message, msg_buffer, length)
-        valid_delimiter = message[-6:] == "}]\r\n\r\n"
-        if right_curly_bracket and valid_delimiter:
-            return message
-        elif right_curly_bracket:
-            raise InvalidMessageDelimiter(message)
-        else:
-            raise MissingMessageDelimiter(message)
+            return json.loads(message)
+        except ValueError:
+            raise JSONDecodeError(message)
+
+    def handle_server_msg(self, wrapped_msg):
+        """Update the logic instance's own state from a message sent by the
+        server and return the message that should be passed on to the client
+        interface, or None if there isn't one.
+
+        The room message sent in reply to a logon lists the optional protocol
+        features the server agreed to use for this connection and gives the
+        resume token for reconnect(). The number of the last sequenced 
+        message received is kept for reconnect() too, and is only ever 
+        taken from the messages themselves, history included, so a 
+        connection dropped part way through the history resumes from where
+        it got to. It starts again unless the room says we resumed. The
+        version of the room's roster is kept the same way from the entrance
+        and exit deltas. A delta older than the roster is dropped, and if one
+        turns out to have been missed the whole roster is asked for again and
+        the deltas are dropped until it arrives. Credit messages
+        let outgoing streams send more chunks, and an error about a stream 
+        means the server refused it so it is dropped. Chunks of incoming 
+        streams are collected until the final one arrives, which is passed
+        on as a whole message."""
+        message = wrapped_msg[1]
+        if "seq" in message and message["type"] in self.sequenced_types:
+            self.last_seq = max(self.last_seq or 0, message["seq"])
+        if message["type"] == "room" and "server" in message:
+            self.features = frozenset(message["server"].get("features", []))
+            self.room = message.get("room")
+            self.username = message.get("username", self.username)
+            self.resume_token = message.get("resume")
+            if not message.get("resumed"):
+                self.last_seq = None # Set again by the history that follows
+            self.roster_version = message.get("roster")
+        elif message["type"] in ("entrance", "exit") and "roster" in message:
+            if self.roster_version is None or message["roster"] <= self.roster_version:
+                return None
+            if message["roster"] != self.roster_version + 1:
+                self.roster_version = None # Until the roster arrives
+                self.put_msg({"type":"roster"})
+                return None
+            self.roster_version = message["roster"]
+        elif message["type"] == "roster":
+            self.roster_version = message["roster"]
+        elif message["type"] == "credit":
+            with self._streams_lock:
+                if message["stream"] in self._streams:
+                    self._streams[message["stream"]].credit += message["chunks"]
+            self.put_msg(None) # Wake the send loop
+            return None
+        elif message["type"] == "error" and "stream" in message:
+            with self._streams_lock:
+                stream = self._streams.pop(message["stream"], None)
+            if stream is not None:
+                stream.file.close()
+        elif message["type"].endswith("_chunk"):
+            body = self._incoming_streams.setdefault(message["stream"], bytearray())
+            body.extend(message.pop("attachment"))
+            if not message["final"]:
+                return None
+            del(self._incoming_streams[message["stream"]])
+            whole = {key:message[key] for key in message 
+                     if key not in ("stream", "seq", "final")}
+            whole["type"] = message["type"][:-len("_chunk")]
+            whole["attachment"] = bytes(body)
+            return [len(body), whole]
+        return wrapped_msg
+
+    class OutgoingStream():
+        """A file being streamed to the server a chunk at a time.
+
+        The stream starts out with STREAM_WINDOW chunks of credit, each chunk
+        sent uses one up and the server gives it back once the room has taken
+        the chunk in."""
+        def __init__(self, stream_id, msg_type, stream_file):
+            self.stream_id = stream_id
+            self.msg_type = msg_type
+            self.file = stream_file
+            self.size = os.fstat(stream_file.fileno()).st_size
+            self.offset = 0
+            self.seq = 0
+            self.credit = STREAM_WINDOW
+
+        def next_chunk(self):
+            """Read the next chunk from the file and return it as a message."""
+            body = self.file.read(CHUNK_SIZE)
+            self.offset += len(body)
+            final = self.offset >= self.size or len(body) < CHUNK_SIZE
+            chunk = {"type":self.msg_type + "_chunk",
+                     "stream":self.stream_id,
+                     "seq":self.seq,
+                     "final":final,
+                     "attachment":body}
+            self.seq += 1
+            self.credit -= 1
+            if final:
+                self.file.close()
+            return chunk
 
     class Shutdown(threading.Event):
         """Represents a shutdown event, a shutdown event has a type which is set
@@ -406,11 +609,9 @@ class DebugMenu(cmd.Cmd):
     def do_screenshot(self, filepath):
         """Send a screenshot taken from the file given by <filepath> to a QA server."""
         try:
-            screenshot_file = open(filepath, 'br')
+            self.logic.screenshot_file(filepath)
         except IOError:
             print("File not found.")
-        screenshot = screenshot_file.read()
-        self.logic.screenshot(screenshot)
 
 
     def do_pull_msg(self, arg):
@@ -430,10 +631,6 @@ class ConfigurationError(Exception):
     def __str__(self):
         return repr(self.error_message)
 
-class StreamError(Exception):
-    """Errors related to handling MRC streams."""
-    pass
-
 class ConnectionError(StreamError):
     """Error raised when a connection is broken or nonexistent."""
     def __init__(self, error_message):
@@ -441,43 +638,6 @@ class ConnectionError(StreamError):
     def __str__(self):
         return repr(self.error_message)
 
-class LengthHeaderError(StreamError):
-    """Abstract length header error class."""
-    def __init__(self, length_portion="Portion not given"):
-        self.length_portion = length_portion
-    def __str__(self):
-        return repr(self.length_portion)
-
-class MissingLengthHeader(LengthHeaderError):
-    """Error raised when a length header appears to be missing."""
-    pass
-
-class InvalidLengthHeader(LengthHeaderError):
-    """Error raised when a length header appears to be present but
-    garbled."""
-    pass
-
-class MessageDelimiterError(LengthHeaderError):
-    """Abstract message delimiter error class."""
-    pass
-
-class MissingMessageDelimiter(MessageDelimiterError):
-    """Error raised when a message delimiter appears to be missing."""
-    pass
-
-class InvalidMessageDelimiter(MessageDelimiterError):
-    """Error raised when a message delimiter appears to be present but
-    garbled."""
-    pass
-
-class JSONDecodeError(Exception):
-    """Error raised when a json encoded message fails to decode to a valid JSON
-    document."""
-    def __init__(self, invalid_json="JSON not given."):
-        self.invalid_json = invalid_json
-    def __str__(self):
-        return repr(self.invalid_json)
-
 if __name__ == "__main__":
     debug = DebugMenu()
     debug.cmdloop()
@@ -0,0 +1,271 @@
+# Message bus linking the worker processes of a multi-process QA server
+import os
+import json
+import socket
+import logging
+import threading
+import itertools
+import collections
+from qa_common import FrameDecoder, Attachment, encode_attachment_frame, encode_frame
+
+log = logging.getLogger("qa_cluster")
+
+class Hub():
+    """The centre of the message bus, run by the parent process of a multi-
+    process server.
+
+    Every worker connects to the hub's Unix domain socket at <path>. Messages
+    a worker publishes are sent to the hub as attachment frames, a JSON header
+    saying what to do with the message and its already encoded bytes as the
+    body. The hub numbers each one sent to a whole room with the next 
+    sequence number of the room, and sends every message on to every 
+    worker, including the one it came from. The hub handles one message at
+    a time and queues it for every worker before taking the next, so all 
+    the workers see the messages of a room in the same order. Each worker's
+    queue is written out by a thread of its own, so a slow worker never 
+    holds up the others. A worker that falls more than max_worker_bytes
+    behind is disconnected.
+
+    If a qa_journal Journal is given as <journal> the messages sent to whole
+    rooms whose kind is in <journal_kinds> are appended to it, once for all 
+    the workers, with the sequence numbers the hub gave them. The numbering
+    of each room carries on from the last <restore_records> records of the
+    journal, and every worker is sent those records when it connects, 
+    before it is sent anything else, to fill the history of its rooms.
+    """
+    restore_records = 10000
+    max_worker_bytes = 64 * 1024 * 1024
+
+    def __init__(self, path, journal=None, journal_kinds=()):
+        self.path = path
+        self.journal = journal
+        self.journal_kinds = journal_kinds
+        if os.path.exists(path):
+            os.remove(path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(path)
+        self.socket.listen(64)
+        self._workers = []
+        self._sequences = {} # room name -> itertools.count
+        self._lock = threading.Lock()
+        self._journaled = 0 # The last journal record appended
+        if journal is not None:
+            self._journaled = journal.last_seq()
+            last_seqs = {}
+            for record in journal.tail(self.restore_records):
+                seq = json.loads(record.frame)[1].get("seq", 0)
+                last_seqs[record.room] = max(last_seqs.get(record.room, 0), seq)
+            for room, last_seq in last_seqs.items():
+                self._sequences[room] = itertools.count(last_seq + 1)
+
+    def serve_forever(self):
+        """Accept workers until the hub is closed, reading from each one in a
+        thread of its own."""
+        while True:
+            try:
+                worker, address = self.socket.accept()
+            except OSError:
+                return
+            with self._lock:
+                # Every message published from now on is queued for the 
+                # worker, so it is restored from the journal up to here
+                link = _WorkerLink(worker, self.max_worker_bytes,
+                                   self._restore_frames(self._journaled))
+                self._workers.append(link)
+            reader = threading.Thread(target=self._read_worker, args=(link,))
+            reader.daemon = True
+            reader.start()
+
+    def _restore_frames(self, through):
+        """Yield the frames a worker is sent before anything published: the
+        journal records up to record number <through>, at most 
+        restore_records of them, and then the ready frame. The journal is
+        written out first so they can be read."""
+        if self.journal is not None and through:
+            self.journal.sync()
+            since = max(1, through - self.restore_records + 1)
+            for record in self.journal.read(since, through - since + 1):
+                if record.seq > through: # Older records had expired
+                    break
+                yield encode_attachment_frame(
+                    {"room":record.room, "audience":"restore",
+                     "timestamp":record.timestamp}, record.frame)
+        yield encode_attachment_frame({"ready":True}, b"")
+
+    def close(self):
+        self.socket.close()
+        with self._lock:
+            for link in self._workers:
+                link.close()
+            self._workers = []
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _read_worker(self, link):
+        decoder = FrameDecoder()
+        while True:
+            message = decoder.next_frame()
+            if message is None:
+                try:
+                    if decoder.recv_into(link.connection):
+                        continue
+                except OSError:
+                    pass
+                self._remove_worker(link)
+                return
+            if isinstance(message, Attachment):
+                self.publish(json.loads(message.header), message.body)
+
+    def publish(self, header, body):
+        """Number the message if it is for a whole room and send it to every
+        worker."""
+        with self._lock:
+            if header.get("audience") == "all":
+                sequence = self._sequences.setdefault(header["room"],
+                                                      itertools.count(1))
+                header["seq"] = next(sequence)
+            if (self.journal is not None and header.get("audience") == "all" 
+                and header.get("kind") in self.journal_kinds):
+                # The worker encoded the message before it had a number
+                message = json.loads(body)[1]
+                message["seq"] = header["seq"]
+                self._journaled = self.journal.append(
+                    header["room"], header["timestamp"], encode_frame(message))
+            frame = encode_attachment_frame(header, body)
+            for link in list(self._workers):
+                if not link.put(frame):
+                    self._workers.remove(link)
+
+    def _remove_worker(self, link):
+        with self._lock:
+            if link in self._workers:
+                self._workers.remove(link)
+        link.close()
+
+class _WorkerLink():
+    """The hub's connection to one worker. 
+
+    Frames are queued with put() and written to the worker's <connection>
+    by a thread of its own, after every frame <first> yields. Once more 
+    than <max_bytes> are queued or being written the worker has fallen too
+    far behind and the connection is closed."""
+    def __init__(self, connection, max_bytes, first):
+        self.connection = connection
+        self.max_bytes = max_bytes
+        self._first = first
+        self._frames = collections.deque()
+        self._bytes = 0
+        self._closed = False
+        self._queued = threading.Condition()
+        self._writer = threading.Thread(target=self._write_loop)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def put(self, frame):
+        """Queue <frame> for the worker. Returns False if the connection 
+        has been closed."""
+        with self._queued:
+            if self._closed:
+                return False
+            if self._bytes + len(frame) <= self.max_bytes:
+                self._frames.append(frame)
+                self._bytes += len(frame)
+                self._queued.notify()
+                return True
+        log.error("Disconnecting a worker more than %d bytes behind.",
+                  self.max_bytes)
+        self.close()
+        return False
+
+    def close(self):
+        with self._queued:
+            self._closed = True
+            self._queued.notify()
+        try:
+            # Wakes the writer if it is stuck in sendall()
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.connection.close()
+
+    def _write_loop(self):
+        try:
+            for frame in self._first:
+                self.connection.sendall(frame)
+            while True:
+                with self._queued:
+                    while not self._frames and not self._closed:
+                        self._queued.wait()
+                    if self._closed:
+                        return
+                    frames = self._frames
+                    self._frames = collections.deque()
+                for frame in frames:
+                    self.connection.sendall(frame)
+                with self._queued:
+                    self._bytes -= sum(len(frame) for frame in frames)
+        except OSError:
+            self.close()
+
+class Bus():
+    """A worker's connection to the hub at <path>.
+
+    publish() sends a message to the hub, and every message the hub sends
+    back, from this worker or any other, is passed to <on_message> as a
+    header dictionary and a body of bytes by a thread reading from the hub.
+    That thread is the only one delivering bus messages, so they are handled
+    in the order the hub numbered them. Creating a Bus waits until the hub
+    has taken it on, after which it receives every message published. The
+    journal records the hub sends before that are kept in <restored> as a
+    list of (header, body) pairs.
+    """
+    def __init__(self, path, on_message):
+        self.on_message = on_message
+        self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.connection.connect(path)
+        self._decoder = FrameDecoder()
+        self.restored = []
+        while True:
+            message = self._decoder.next_frame()
+            if message is None:
+                if not self._decoder.recv_into(self.connection):
+                    raise ConnectionError("The hub closed the bus.")
+                continue
+            header = json.loads(message.header)
+            if header.get("ready"):
+                break
+            self.restored.append((header, message.body))
+        self._send_lock = threading.Lock()
+        self._closing = False
+        self._reader = threading.Thread(target=self._receive_loop)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def publish(self, header, body):
+        """Send the bytes <body> to every worker, with the dictionary <header>
+        saying what they are. The header must name the 'room' they are for."""
+        frame = encode_attachment_frame(header, body)
+        with self._send_lock:
+            self.connection.sendall(frame)
+        return True
+
+    def close(self):
+        self._closing = True
+        self.connection.close()
+
+    def _receive_loop(self):
+        decoder = self._decoder
+        while True:
+            message = decoder.next_frame()
+            if message is None:
+                try:
+                    if decoder.recv_into(self.connection):
+                        continue
+                except OSError:
+                    pass
+                if not self._closing:
+                    log.error("The hub closed the bus, messages from other "
+                              "workers will no longer arrive.")
+                return
+            if isinstance(message, Attachment):
+                self.on_message(json.loads(message.header), message.body)
@@ -0,0 +1,137 @@
+# Compact binary encoding of the messages of the QA system
+import struct
+
+# Every value is a one byte tag followed by what the tag says:
+#
+# NONE, FALSE, TRUE:  nothing
+# INT32, INT64:       the integer, 4 or 8 bytes
+# FLOAT:              an IEEE 754 double, 8 bytes
+# SHORT_TEXT:         <LENGTH: 1 BYTE> <UTF-8 TEXT>
+# TEXT:               <LENGTH: 4 BYTES> <UTF-8 TEXT>
+# BYTES:              <LENGTH: 4 BYTES> <RAW BYTES>
+# LIST:               <NUMBER OF ITEMS: 4 BYTES> <ITEMS>
+# MAP:                <NUMBER OF ITEMS: 4 BYTES> <KEY> <VALUE> <KEY> <VALUE>...
+#
+# with everything big endian. Keys are always text. Unlike JSON raw bytes
+# are a value of their own, so an attachment needs no base64 and no frame
+# of its own.
+(NONE, FALSE, TRUE, INT32, INT64, FLOAT, SHORT_TEXT, TEXT, BYTES, LIST,
+ MAP) = range(11)
+
+_TAG = struct.Struct(">B")
+_INT32 = struct.Struct(">Bi")
+_INT64 = struct.Struct(">Bq")
+_FLOAT = struct.Struct(">Bd")
+_SHORT = struct.Struct(">BB")
+_LONG = struct.Struct(">BI")
+_CONSTANTS = {None:_TAG.pack(NONE), False:_TAG.pack(FALSE), True:_TAG.pack(TRUE)}
+
+def dumps(value):
+    """Encode <value>, made of dictionaries, lists, text, bytes, numbers,
+    booleans and None, as bytes."""
+    parts = []
+    _encode(value, parts)
+    return b"".join(parts)
+
+def loads(data):
+    """Decode the bytes <data> holding exactly one encoded value."""
+    with memoryview(data) as view:
+        value, end = _decode(view, 0)
+    if end != len(data):
+        raise CodecError("Trailing bytes after the value.")
+    return value
+
+def _encode(value, parts):
+    kind = type(value)
+    if kind is str:
+        text = value.encode('utf-8')
+        if len(text) < 256:
+            parts.append(_SHORT.pack(SHORT_TEXT, len(text)))
+        else:
+            parts.append(_LONG.pack(TEXT, len(text)))
+        parts.append(text)
+    elif kind is dict:
+        parts.append(_LONG.pack(MAP, len(value)))
+        for key, item in value.items():
+            if type(key) is not str:
+                raise CodecError("Keys must be text: " + repr(key))
+            _encode(key, parts)
+            _encode(item, parts)
+    elif kind is bool or value is None:
+        parts.append(_CONSTANTS[value])
+    elif kind is int:
+        if -2 ** 31 <= value < 2 ** 31:
+            parts.append(_INT32.pack(INT32, value))
+        elif -2 ** 63 <= value < 2 ** 63:
+            parts.append(_INT64.pack(INT64, value))
+        else:
+            raise CodecError("Integer too large: " + str(value))
+    elif kind is float:
+        parts.append(_FLOAT.pack(FLOAT, value))
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        parts.append(_LONG.pack(BYTES, len(value)))
+        parts.append(value)
+    elif isinstance(value, (list, tuple)):
+        parts.append(_LONG.pack(LIST, len(value)))
+        for item in value:
+            _encode(item, parts)
+    else:
+        raise CodecError("Can't encode a " + kind.__name__)
+
+def _decode(view, offset):
+    """Return the value encoded at <offset> in the memoryview <view> and the
+    offset after it."""
+    try:
+        tag = view[offset]
+        if tag == SHORT_TEXT:
+            start = offset + 2
+            end = start + view[offset + 1]
+            return str(view[start:end], 'utf-8'), _checked(view, end)
+        elif tag == MAP:
+            count = _LONG.unpack_from(view, offset)[1]
+            offset += _LONG.size
+            value = {}
+            for _ in range(count):
+                key, offset = _decode(view, offset)
+                value[key], offset = _decode(view, offset)
+            return value, offset
+        elif tag == INT32:
+            return _INT32.unpack_from(view, offset)[1], offset + _INT32.size
+        elif tag == TEXT:
+            start = offset + _LONG.size
+            end = start + _LONG.unpack_from(view, offset)[1]
+            return str(view[start:end], 'utf-8'), _checked(view, end)
+        elif tag == NONE:
+            return None, offset + 1
+        elif tag == TRUE:
+            return True, offset + 1
+        elif tag == FALSE:
+            return False, offset + 1
+        elif tag == INT64:
+            return _INT64.unpack_from(view, offset)[1], offset + _INT64.size
+        elif tag == FLOAT:
+            return _FLOAT.unpack_from(view, offset)[1], offset + _FLOAT.size
+        elif tag == BYTES:
+            start = offset + _LONG.size
+            end = start + _LONG.unpack_from(view, offset)[1]
+            return bytes(view[start:end]), _checked(view, end)
+        elif tag == LIST:
+            count = _LONG.unpack_from(view, offset)[1]
+            offset += _LONG.size
+            value = []
+            for _ in range(count):
+                item, offset = _decode(view, offset)
+                value.append(item)
+            return value, offset
+    except (IndexError, struct.error, UnicodeDecodeError) as error:
+        raise CodecError("Truncated or garbled value: " + str(error))
+    raise CodecError("Unknown tag " + str(tag))
+
+def _checked(view, end):
+    if end > len(view):
+        raise CodecError("Truncated value.")
+    return end
+
+class CodecError(ValueError):
+    """A value couldn't be encoded or the bytes given aren't a valid encoding."""
+    pass
@@ -1,5 +1,13 @@
 # Constructs that are common to multiple portions of the QA system
+import os
 import json
+import math
+import base64
+import struct
+import zlib
+import collections
+import threading
+import qa_codec
 
 class Configuration:
     """Represents a configuration file. Provides an easy interface to modify the
@@ -23,3 +31,659 @@ class Configuration:
         json.dump(self._data, config_file)
         config_file.close()
         return True
+
+# The delimiter that ends every MRC message on the wire.
+MESSAGE_DELIMITER = "\r\n\r\n"
+
+def frame_length(body_length):
+    """Return the value of the length header for a message whose JSON encoded
+    dictionary is <body_length> bytes long.
+
+    The length header counts the whole message including itself, so its value
+    depends on its own number of digits. The characters around the dictionary
+    ("[", ", ", "]" and the delimiter) add eight bytes, and adding the digits of
+    the header can only ever carry it over into one more digit."""
+    base = body_length + 8
+    digits = len(str(base))
+    if len(str(base + digits)) > digits:
+        digits += 1
+    return base + digits
+
+def encode_frame(message):
+    """Encode the dictionary <message> as an MRC message ready to be sent
+    across the wire.
+
+    The dictionary is serialized exactly once. The result is byte for byte the
+    same as json.dumps([length, message]) plus the delimiter."""
+    body = json.dumps(message)
+    return ("[" + str(frame_length(len(body))) + ", " + body + "]" + 
+            MESSAGE_DELIMITER).encode('utf-8')
+
+# Attachment frames carry raw bytes alongside a small JSON header. They are
+# only sent to peers that asked for the "attachments" feature at logon, 
+# everybody else gets the bytes base64 encoded inside an ordinary message.
+#
+# An attachment frame is laid out as:
+#
+# <0x01> <HEADER LENGTH: 4 BYTES> <BODY LENGTH: 4 BYTES> <JSON HEADER> <BODY>
+#
+# with both lengths big endian. An ordinary message always begins with "["
+# so the first byte is enough to tell the two apart.
+FEATURE_ATTACHMENTS = "attachments"
+ATTACHMENT_FRAME = 0x01
+ATTACHMENT_PREFIX = struct.Struct(">BII")
+
+Attachment = collections.namedtuple("Attachment", ["header", "body"])
+Attachment.__doc__ = """An attachment frame pulled off the wire by a FrameDecoder.
+header is the JSON text of the message dictionary and body the raw bytes."""
+
+def encode_attachment_frame(header, body):
+    """Encode the dictionary <header> and the bytes <body> as an attachment
+    frame ready to be sent across the wire."""
+    header_bytes = json.dumps(header).encode('utf-8')
+    return b"".join((ATTACHMENT_PREFIX.pack(ATTACHMENT_FRAME, len(header_bytes), 
+                                            len(body)),
+                     header_bytes, body))
+
+def encode_message(message):
+    """Encode the dictionary <message> for the wire, as an attachment frame if
+    it carries raw bytes under the key 'attachment' and an ordinary message
+    otherwise."""
+    if "attachment" in message:
+        header = dict(message)
+        body = header.pop("attachment")
+        return encode_attachment_frame(header, body)
+    return encode_frame(message)
+
+def attachment_to_base64(message, key):
+    """Return a copy of the dictionary <message> with the raw bytes under its
+    'attachment' key moved to <key> as base64 text, for peers that don't 
+    understand attachment frames."""
+    legacy = dict(message)
+    legacy[key] = base64.b64encode(legacy.pop("attachment")).decode('ascii')
+    return legacy
+
+# Peers that negotiated "binary" may send each other messages encoded with
+# qa_codec instead of JSON, in a binary frame laid out as:
+#
+# <0x02> <LENGTH OF THE ENCODED MESSAGE: 4 BYTES> <ENCODED MESSAGE>
+#
+# big endian. Raw bytes travel in a binary frame as they are, under the
+# 'attachment' key just like in an attachment frame. Having negotiated the
+# feature a peer may still be sent messages in any of the other frames.
+FEATURE_BINARY = "binary"
+BINARY_FRAME = 0x02
+BINARY_PREFIX = struct.Struct(">BI")
+
+BinaryMessage = collections.namedtuple("BinaryMessage", ["length", "message"])
+BinaryMessage.__doc__ = """A binary frame pulled off the wire by a FrameDecoder.
+length is the length of the whole frame and message the decoded dictionary."""
+
+def encode_binary_frame(message):
+    """Encode the dictionary <message> as a binary frame ready to be sent
+    across the wire."""
+    body = qa_codec.dumps(message)
+    return BINARY_PREFIX.pack(BINARY_FRAME, len(body)) + body
+
+# Large attachments can be streamed as a series of chunks by peers that 
+# negotiated the "streams" feature. Each chunk is an attachment frame of type 
+# '<type>_chunk' whose header gives the stream it belongs to, its sequence 
+# number and whether it is the final chunk. Chunks are small enough that chat
+# and control messages can be sent in between them on the same connection.
+#
+# Streams are flow controlled with credit. The uploader may have at most
+# STREAM_WINDOW chunks of a stream in flight, and the server sends back a 
+# message of the form:
+#
+# {"type":"credit", "stream":<STREAM ID>, "chunks":<NUMBER OF CHUNKS>}
+#
+# once it has taken in the chunks it was sent. The server streams to its
+# own recipients the same way, queueing at most STREAM_WINDOW chunks on a 
+# connection and the next one each time a chunk has been written out, so a
+# slow recipient holds a few chunks in the server's memory and not a whole 
+# encoded copy of the stream.
+FEATURE_STREAMS = "streams"
+CHUNK_SIZE = 65536
+STREAM_WINDOW = 4
+
+# Administrators that negotiated "screenshot_refs" are sent a reference to 
+# each screenshot instead of the screenshot itself:
+#
+# {"type":"screenshot_ref", "hash":<SHA256 HEX DIGEST>, "size":<BYTES>,
+#  "username":<SENDER>, "timestamp":<UNIX TIMESTAMP>}
+#
+# and fetch the ones they want to look at with a message of the form:
+#
+# {"type":"fetch_screenshot", "hash":<SHA256 HEX DIGEST>}
+FEATURE_SCREENSHOT_REFS = "screenshot_refs"
+
+# Every change to the users of a room gives its roster a new version, sent in
+# the room message under 'roster'. Clients that negotiated "roster" are told
+# of each change with a delta of the form:
+#
+# {"type":"entrance" or "exit", "username":<USERNAME>,
+#  "roster":<VERSION AFTER THE CHANGE>, "timestamp":<UNIX TIMESTAMP>}
+#
+# A client that finds it missed a version, for instance because deltas were
+# dropped from its send queue, asks for the whole roster again with:
+#
+# {"type":"roster"}
+#
+# and is sent {"type":"roster", "roster":<VERSION>, "users":<USERNAMES>}
+FEATURE_ROSTER = "roster"
+
+# Connections that negotiated "deflate" compress the frames they send of at
+# least COMPRESS_THRESHOLD bytes, smaller ones aren't worth the trouble. A
+# compressed frame is laid out as:
+#
+# <0x03> <LENGTH OF THE DATA: 4 BYTES> <DEFLATE DATA>
+#
+# big endian, where the data is one whole frame compressed with raw deflate
+# and flushed with Z_SYNC_FLUSH. Every compressed frame sent on a connection
+# is part of the same deflate stream, so each one can refer back to the
+# frames compressed before it, which is what makes the small and very 
+# repetitive messages of a room compress well. Frames under the threshold 
+# are sent as they are in between.
+FEATURE_DEFLATE = "deflate"
+COMPRESSED_FRAME = 0x03
+COMPRESSED_PREFIX = struct.Struct(">BI")
+COMPRESS_THRESHOLD = 256
+
+class FrameCompressor:
+    """Compresses the frames written to one connection as a single deflate
+    stream. Frames must be compressed in the order they are written and the
+    compressor belongs to the one thread writing them."""
+    def __init__(self, threshold=COMPRESS_THRESHOLD, level=6):
+        self.threshold = threshold
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    def compress(self, frame):
+        """Return <frame> as a compressed frame, or unchanged if it is below
+        the threshold. A TrackedFrame stays tracked."""
+        if len(frame) < self.threshold:
+            return frame
+        data = (self._compressor.compress(frame) + 
+                self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        compressed = b"".join((COMPRESSED_PREFIX.pack(COMPRESSED_FRAME, 
+                                                      len(data)), data))
+        if isinstance(frame, TrackedFrame):
+            return TrackedFrame(compressed, frame.tracker)
+        return compressed
+
+class DeliveryTracker:
+    """Counts down the connections a message still has to be written to and
+    calls <on_sent> once it has been written to all of them."""
+    def __init__(self, pending, on_sent):
+        self._pending = pending
+        self._on_sent = on_sent
+        self._lock = threading.Lock()
+        if not pending:
+            on_sent()
+
+    def sent(self):
+        """Record that one more connection has written the message, or given
+        up on it because it closed."""
+        with self._lock:
+            self._pending -= 1
+            done = self._pending == 0
+        if done:
+            self._on_sent()
+
+class TrackedFrame(bytes):
+    """An encoded message which reports to a DeliveryTracker once a connection
+    has written it to its socket. Connections call sent() on any TrackedFrame
+    they finish sending or drop."""
+    def __new__(cls, data, tracker):
+        frame = super().__new__(cls, data)
+        frame.tracker = tracker
+        return frame
+
+    def sent(self):
+        self.tracker.sent()
+
+def frame_sent(frame):
+    """Report that <frame> has been written or dropped if it is tracked."""
+    if isinstance(frame, TrackedFrame):
+        frame.sent()
+
+# The most buffers a single sendmsg() may be given.
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+if IOV_MAX <= 0:
+    IOV_MAX = 16
+
+class OutputBuffer:
+    """Encoded messages waiting to be written to a socket.
+
+    Everything in the buffer is written with a single vectored sendmsg()
+    call of up to IOV_MAX messages, so a burst of messages costs one system
+    call instead of one each and is never joined into a new string first.
+    How much of the first message has already been written is kept as an 
+    offset into it, so a partial write doesn't copy what is left either. 
+    Messages are reported with frame_sent() once they have been written in
+    full. Platforms without sendmsg() write one message at a time.
+
+    Once a connection has negotiated compression a FrameCompressor is set as
+    the buffer's <compressor>, and every message is passed through it as it
+    is added.
+
+    A buffer belongs to the single thread writing to its socket and is not
+    locked.
+    """
+    def __init__(self):
+        self._frames = collections.deque()
+        self._offset = 0 # Bytes of the first frame already written
+        self.pending_bytes = 0
+        self.compressor = None
+
+    def append(self, frame):
+        if self.compressor is not None:
+            frame = self.compressor.compress(frame)
+        self._frames.append(frame)
+        self.pending_bytes += len(frame)
+
+    def __len__(self):
+        return len(self._frames)
+
+    def write_to(self, connection):
+        """Write as much of the buffer as <connection> will take in one call,
+        returning the number of bytes written. Exceptions raised by the 
+        socket, such as BlockingIOError, are passed on."""
+        if not self._frames:
+            return 0
+        first = memoryview(self._frames[0])[self._offset:]
+        if hasattr(connection, "sendmsg") and len(self._frames) > 1:
+            buffers = [first]
+            for index in range(1, min(len(self._frames), IOV_MAX)):
+                buffers.append(self._frames[index])
+            sent = connection.sendmsg(buffers)
+        else:
+            sent = connection.send(first)
+        first.release()
+        self._advance(sent)
+        return sent
+
+    def write_all(self, connection):
+        """Write the whole buffer to the blocking socket <connection>."""
+        while self._frames:
+            self.write_to(connection)
+
+    def clear(self):
+        """Empty the buffer, returning the messages that were in it."""
+        frames = list(self._frames)
+        self._frames.clear()
+        self._offset = 0
+        self.pending_bytes = 0
+        return frames
+
+    def _advance(self, sent):
+        self.pending_bytes -= sent
+        sent += self._offset
+        while self._frames and sent >= len(self._frames[0]):
+            frame = self._frames.popleft()
+            sent -= len(frame)
+            frame_sent(frame)
+        self._offset = sent
+
+# How many bytes a receive loop asks the socket for at a time by default.
+DEFAULT_READ_SIZE = 65536
+# The longest frame a decoder accepts by default. The buffer is grown to fit
+# a frame as soon as its length is known, so without a bound a peer could
+# make it allocate whatever it liked with nothing but a length header.
+DEFAULT_MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+class FrameDecoder:
+    """Incrementally split a stream of bytes from an MRC connection into
+    messages.
+
+    Every MRC message on the wire is a JSON list of the form:
+
+    [<LENGTH OF THE WHOLE MESSAGE IN BYTES>, {<MESSAGE DICTIONARY>}]\\r\\n\\r\\n
+
+    or, between peers that negotiated them, an attachment frame which is 
+    returned as an Attachment, a binary frame which is returned as a 
+    BinaryMessage or a compressed frame which is returned as whatever frame
+    it holds. Compressed frames are inflated with a single
+    decompressor kept for the life of the decoder, since each one continues 
+    the deflate stream of those before it.
+
+    Bytes are read straight from the socket into the decoders buffer with
+    recv_into(), or handed to it with feed(), and complete messages are pulled
+    off with next_frame(). The length header is parsed once per message, after
+    which the decoder only has to count bytes until the rest of the message has
+    arrived. Unlike reparsing the whole input buffer every time more data is 
+    recieved this keeps the cost of decoding a message linear in its size.
+
+    The buffer is a preallocated bytearray. Consumed messages are not cut off
+    the front of it, instead the decoder keeps track of where the unread bytes
+    start and only moves them back to the beginning when it runs out of room at
+    the end. Once the length of a message is known the buffer is grown to fit
+    the whole of it, so even very large messages are recieved in place and are
+    decoded from a view of the buffer without being copied. A message whose 
+    length is over <max_frame_size> raises FrameTooLarge before anything is 
+    allocated for it.
+    """
+    # The longest prefix that can hold a valid length header, anything
+    # longer than this without a comma in it is garbage.
+    MAX_HEADER_LENGTH = 32
+
+    def __init__(self, read_size=DEFAULT_READ_SIZE,
+                 max_frame_size=DEFAULT_MAX_FRAME_SIZE):
+        self.read_size = read_size
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray(read_size)
+        self._start = 0 # Where the unread bytes in the buffer start
+        self._end = 0 # Where the unread bytes in the buffer end
+        self._length = None
+        self._decompressor = None # Created with the first compressed frame
+
+    def recv_into(self, connection):
+        """Read up to read_size bytes from the socket <connection> directly
+        into the buffer. Returns the number of bytes read, which is zero once
+        the other end has closed the connection."""
+        self._reserve(self.read_size)
+        with memoryview(self._buffer) as view:
+            received = connection.recv_into(
+                view[self._end:self._end + self.read_size])
+        self._end += received
+        return received
+
+    def feed(self, data):
+        """Add the bytes <data> recieved from the wire to the decoders buffer."""
+        self._reserve(len(data))
+        self._buffer[self._end:self._end + len(data)] = data
+        self._end += len(data)
+        return True
+
+    def buffered(self):
+        """Return the number of bytes waiting in the decoders buffer."""
+        return self._end - self._start
+
+    def next_frame(self):
+        """Return the next complete message in the buffer as a string, or as an
+        Attachment if it is an attachment frame. Returns None if a complete 
+        message has not been recieved yet."""
+        if self._length is None:
+            if not self.buffered():
+                return None
+            if self._buffer[self._start] == ATTACHMENT_FRAME:
+                self._length = self._parse_attachment_prefix()
+            elif self._buffer[self._start] in (BINARY_FRAME, COMPRESSED_FRAME):
+                self._length = self._parse_short_prefix()
+            else:
+                self._length = self._parse_length_header()
+            if self._length is None:
+                return None
+        if self.buffered() < self._length:
+            return None
+        start = self._start
+        end = start + self._length
+        self._start = end
+        self._length = None
+        with memoryview(self._buffer) as view:
+            frame = view[start:end]
+            try:
+                if frame[0] == COMPRESSED_FRAME:
+                    message = self._inflate(frame)
+                else:
+                    message = self._decode_frame(frame)
+            finally:
+                frame.release()
+        if self._start == self._end:
+            self._start = self._end = 0
+            if len(self._buffer) > 16 * self.read_size:
+                # Don't hold on to the memory a huge message needed forever
+                self._buffer = bytearray(self.read_size)
+        return message
+
+    def _reserve(self, size):
+        """Make sure there are at least <size> free bytes at the end of the
+        buffer, and room for the whole of the current message if its length is
+        known."""
+        needed = max(size, (self._length or 0) - self.buffered())
+        if len(self._buffer) - self._end >= needed:
+            return
+        if self._start:
+            unread = self.buffered()
+            self._buffer[:unread] = self._buffer[self._start:self._end]
+            self._start, self._end = 0, unread
+        if len(self._buffer) - self._end < needed:
+            self._buffer.extend(bytes(needed - (len(self._buffer) - self._end)))
+
+    def _parse_length_header(self):
+        """Return the length given in the header of the message at the start of
+        the buffer, or None if the whole header has not been recieved yet."""
+        header_end = min(self._end, self._start + self.MAX_HEADER_LENGTH)
+        comma = self._buffer.find(b",", self._start, header_end)
+        if comma == -1:
+            if self.buffered() >= self.MAX_HEADER_LENGTH:
+                raise InvalidLengthHeader(bytes(self._buffer[self._start:header_end]))
+            return None
+        length_portion = self._buffer[self._start:comma].decode('utf-8')
+        left_bracket = length_portion[:1] == "["
+        number_before_comma = length_portion[-1:] in "1234567890"
+        if left_bracket and number_before_comma:
+            digits = length_portion[1:].lstrip(" \n\t\r")
+            if not digits.isdigit():
+                raise InvalidLengthHeader(length_portion)
+            length = int(digits)
+            if length <= comma - self._start:
+                raise InvalidLengthHeader(length_portion)
+            return self._check_size(length)
+        elif left_bracket:
+            raise InvalidLengthHeader(length_portion)
+        else:
+            raise MissingLengthHeader(length_portion)
+
+    def _check_size(self, length):
+        """Return <length> if a frame that long is allowed."""
+        if length > self.max_frame_size:
+            raise FrameTooLarge(length, self.max_frame_size)
+        return length
+
+    def _parse_attachment_prefix(self):
+        """Return the length of the attachment frame at the start of the buffer,
+        or None if its whole prefix has not been recieved yet."""
+        if self.buffered() < ATTACHMENT_PREFIX.size:
+            return None
+        (kind, header_length, body_length) = ATTACHMENT_PREFIX.unpack_from(
+            self._buffer, self._start)
+        return self._check_size(ATTACHMENT_PREFIX.size + header_length + 
+                                body_length)
+
+    def _parse_short_prefix(self):
+        """Return the length of the binary or compressed frame at the start of
+        the buffer, or None if its whole prefix has not been recieved yet. 
+        Both have the same prefix."""
+        if self.buffered() < COMPRESSED_PREFIX.size:
+            return None
+        (kind, data_length) = COMPRESSED_PREFIX.unpack_from(self._buffer,
+                                                            self._start)
+        return self._check_size(COMPRESSED_PREFIX.size + data_length)
+
+    def _inflate(self, frame):
+        """Decompress the memoryview <frame> of a compressed frame and return
+        the frame inside it decoded. The frame inside is held to the same 
+        limit as any other, however small it was compressed."""
+        if self._decompressor is None:
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        try:
+            inner = self._decompressor.decompress(frame[COMPRESSED_PREFIX.size:],
+                                                  self.max_frame_size)
+        except zlib.error as error:
+            raise CompressedFrameError(str(error))
+        if self._decompressor.unconsumed_tail:
+            raise FrameTooLarge(len(inner) + 1, self.max_frame_size)
+        if not inner or inner[0] == COMPRESSED_FRAME:
+            raise CompressedFrameError("Compressed frame holds no frame.")
+        with memoryview(inner) as view:
+            return self._decode_frame(view)
+
+    def _decode_frame(self, frame):
+        """Return the memoryview <frame> of a whole uncompressed frame decoded."""
+        if frame[0] == ATTACHMENT_FRAME:
+            return self._split_attachment(frame)
+        if frame[0] == BINARY_FRAME:
+            return self._decode_binary(frame)
+        return self._check_delimiter(frame)
+
+    def _decode_binary(self, frame):
+        """Return the memoryview <frame> of a binary frame as a BinaryMessage."""
+        try:
+            message = qa_codec.loads(frame[BINARY_PREFIX.size:])
+        except qa_codec.CodecError as error:
+            raise BinaryFrameError(str(error))
+        if not isinstance(message, dict):
+            raise BinaryFrameError("Binary frame doesn't hold a message.")
+        return BinaryMessage(len(frame), message)
+
+    def _split_attachment(self, frame):
+        """Return the memoryview <frame> of an attachment frame as an Attachment.
+        The body is copied out of the buffer since the buffer gets reused."""
+        (kind, header_length, body_length) = ATTACHMENT_PREFIX.unpack_from(frame)
+        header_end = ATTACHMENT_PREFIX.size + header_length
+        return Attachment(str(frame[ATTACHMENT_PREFIX.size:header_end], 'utf-8'),
+                          bytes(frame[header_end:]))
+
+    def _check_delimiter(self, frame):
+        """Check that the memoryview <frame> ends with the message delimiter and
+        return it decoded as a string."""
+        right_curly_bracket = frame[-6:-5] == b"}" or frame[-2:-1] == b"}"
+        valid_delimiter = frame[-6:] == b"}]\r\n\r\n"
+        if right_curly_bracket and valid_delimiter:
+            return str(frame, 'utf-8')
+        elif right_curly_bracket:
+            raise InvalidMessageDelimiter(str(frame, 'utf-8', 'replace'))
+        else:
+            raise MissingMessageDelimiter(str(frame, 'utf-8', 'replace'))
+
+class LatencyHistogram:
+    """A histogram of durations with logarithmic buckets.
+
+    Durations are recorded in seconds and sorted into buckets that grow by a
+    factor of 2**(1/4) starting at one microsecond, so percentiles come back
+    accurate to within about nineteen percent no matter how long or short the
+    durations are. Recording a duration is a few arithmetic operations and a
+    dictionary update, cheap enough to do on every message.
+    """
+    BUCKETS_PER_OCTAVE = 4
+
+    def __init__(self):
+        self._buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        """Add a duration of <seconds> to the histogram."""
+        microseconds = seconds * 1e6
+        if microseconds <= 1:
+            bucket = 0
+        else:
+            bucket = int(math.log2(microseconds) * self.BUCKETS_PER_OCTAVE) + 1
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        """Add the durations recorded in the histogram <other> to this one."""
+        for bucket, count in other._buckets.items():
+            self._buckets[bucket] = self._buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """Return the upper bound in seconds of the bucket holding the duration
+        at <percent> (0-100) of the way through the recorded durations."""
+        if not self.count:
+            return 0.0
+        rank = math.ceil(self.count * percent / 100.0) or 1
+        seen = 0
+        for bucket in sorted(self._buckets):
+            seen += self._buckets[bucket]
+            if seen >= rank:
+                return min(self._upper_bound(bucket), self.max)
+        return self.max
+
+    def mean(self):
+        """Return the mean of the recorded durations in seconds."""
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+    def summary(self):
+        """Return a dictionary describing the histogram, suitable for dumping
+        as JSON. Durations are given in milliseconds."""
+        return {"count":self.count,
+                "mean_ms":self.mean() * 1e3,
+                "p50_ms":self.percentile(50) * 1e3,
+                "p90_ms":self.percentile(90) * 1e3,
+                "p99_ms":self.percentile(99) * 1e3,
+                "p999_ms":self.percentile(99.9) * 1e3,
+                "max_ms":self.max * 1e3}
+
+    def _upper_bound(self, bucket):
+        return 2 ** (bucket / self.BUCKETS_PER_OCTAVE) / 1e6
+
+class StreamError(Exception):
+    """Errors related to handling MRC streams."""
+    pass
+
+class LengthHeaderError(StreamError):
+    """Abstract length header error class."""
+    def __init__(self, length_portion="Portion not given"):
+        self.length_portion = length_portion
+    def __str__(self):
+        return repr(self.length_portion)
+
+class MissingLengthHeader(LengthHeaderError):
+    """Error raised when a length header appears to be missing."""
+    pass
+
+class InvalidLengthHeader(LengthHeaderError):
+    """Error raised when a length header appears to be present but
+    garbled."""
+    pass
+
+class MessageDelimiterError(LengthHeaderError):
+    """Abstract message delimiter error class."""
+    pass
+
+class MissingMessageDelimiter(MessageDelimiterError):
+    """Error raised when a message delimiter appears to be missing."""
+    pass
+
+class InvalidMessageDelimiter(MessageDelimiterError):
+    """Error raised when a message delimiter appears to be present but
+    garbled."""
+    pass
+
+class FrameTooLarge(StreamError):
+    """Error raised when a frame is longer than the decoder accepts."""
+    def __init__(self, length, max_frame_size):
+        self.length = length
+        self.max_frame_size = max_frame_size
+    def __str__(self):
+        return "Frame of {} bytes is over the limit of {}.".format(
+            self.length, self.max_frame_size)
+
+class BinaryFrameError(StreamError):
+    """A binary frame couldn't be decoded into a message."""
+    pass
+
+class CompressedFrameError(StreamError):
+    """A compressed frame couldn't be inflated into a frame."""
+    pass
+
+class JSONDecodeError(Exception):
+    """Error raised when a json encoded message fails to decode to a valid JSON
+    document."""
+    def __init__(self, invalid_json="JSON not given."):
+        self.invalid_json = invalid_json
+    def __str__(self):
+        return repr(self.invalid_json)
@@ -0,0 +1,299 @@
+# Durable, append-only record of the messages published on the QA server
+import os
+import mmap
+import time
+import zlib
+import queue
+import bisect
+import struct
+import threading
+import collections
+
+# A journal is a directory of segment files, each named after the sequence
+# number of its first record, holding records laid out as:
+#
+# <CRC32> <SEQUENCE NUMBER> <TIMESTAMP> <ROOM LENGTH> <FRAME LENGTH> <ROOM> <FRAME>
+#
+# big endian, where the CRC covers everything after itself. Alongside each
+# segment is an index file of (sequence number, offset) pairs for every
+# record that starts at least index_interval bytes after the last one indexed.
+RECORD_HEADER = struct.Struct(">IQdHI")
+INDEX_ENTRY = struct.Struct(">QQ")
+SEGMENT_SUFFIX = ".log"
+INDEX_SUFFIX = ".idx"
+
+Record = collections.namedtuple("Record", ["seq", "timestamp", "room", "frame"])
+Record.__doc__ = """A message read back from a Journal. frame is the message
+exactly as it was encoded for the wire."""
+
+class _Segment():
+    """One segment file of a journal and its sparse index."""
+    def __init__(self, directory, first_seq):
+        self.first_seq = first_seq
+        name = "%020d" % first_seq
+        self.path = os.path.join(directory, name + SEGMENT_SUFFIX)
+        self.index_path = os.path.join(directory, name + INDEX_SUFFIX)
+        self.size = 0 # Bytes of whole records written and synced
+        self.last_seq = first_seq - 1
+        self.index_seqs = []
+        self.index_offsets = []
+
+    def add_to_index(self, seq, offset):
+        self.index_seqs.append(seq)
+        self.index_offsets.append(offset)
+
+    def offset_of(self, seq):
+        """Return an offset to start scanning from for the record <seq>."""
+        position = bisect.bisect_right(self.index_seqs, seq) - 1
+        return self.index_offsets[position] if position >= 0 else 0
+
+class Journal():
+    """An append-only journal of the messages published on the server, kept
+    in segment files in <directory>.
+
+    append() only puts the message in a queue, so it adds no disk latency to
+    the thread publishing it. A writer thread takes everything waiting in the
+    queue, writes it and then calls fsync once for the whole batch. The
+    busier the server the more messages share each fsync. sync() waits until
+    everything appended so far is on disk.
+
+    Once the segment being written reaches <segment_bytes> a new one is
+    started. The oldest segments are deleted while the journal is larger
+    than <max_bytes> or once they are older than <max_age> seconds.
+
+    read() returns the records from a sequence number onwards. The sparse
+    index finds the place in the segment to start from and the segment is
+    read through mmap. Opening an existing journal carries on from its last
+    record and throws away a record left half written by a crash.
+    """
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024,
+                 max_bytes=1024 * 1024 * 1024, max_age=7 * 24 * 60 * 60,
+                 index_interval=4096):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.index_interval = index_interval
+        os.makedirs(directory, exist_ok=True)
+        self._segments = self._load_segments()
+        self._next_seq = self._segments[-1].last_seq + 1
+        self._synced_seq = self._next_seq - 1
+        self._lock = threading.Lock()
+        self._synced = threading.Condition(self._lock)
+        self._queue = queue.Queue()
+        self._expire()
+        self._open_active()
+        self._writer = threading.Thread(target=self._write_loop, name="journal")
+        self._writer.daemon = True
+        self._writer.start()
+
+    def append(self, room, timestamp, frame):
+        """Queue the encoded message <frame> published in <room> at
+        <timestamp> to be written, returning its sequence number."""
+        with self._lock:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._queue.put((seq, room, timestamp, frame))
+        return seq
+
+    def sync(self, timeout=None):
+        """Wait until every message appended so far is on disk. Returns False
+        if <timeout> seconds passed first."""
+        with self._synced:
+            target = self._next_seq - 1
+            return self._synced.wait_for(lambda: self._synced_seq >= target,
+                                         timeout)
+
+    def last_seq(self):
+        """Return the sequence number of the last record on disk, 0 if there
+        are none."""
+        with self._lock:
+            return self._synced_seq
+
+    def read(self, since=1, limit=None):
+        """Return a list of up to <limit> Records on disk, starting with the
+        record numbered <since>."""
+        with self._lock:
+            segments = [(segment, segment.size) for segment in self._segments
+                        if segment.last_seq >= since]
+        records = []
+        for segment, size in segments:
+            if not size:
+                continue
+            try:
+                segment_file = open(segment.path, "rb")
+            except FileNotFoundError:
+                continue # Expired while we were reading
+            with segment_file, mmap.mmap(segment_file.fileno(), size,
+                                         access=mmap.ACCESS_READ) as data:
+                offset = segment.offset_of(since)
+                while offset < size:
+                    record, offset = self._read_record(data, offset)
+                    if record.seq >= since:
+                        records.append(record)
+                        if limit is not None and len(records) >= limit:
+                            return records
+        return records
+
+    def tail(self, count):
+        """Return the last <count> Records on disk."""
+        return self.read(max(1, self.last_seq() - count + 1))
+
+    def close(self):
+        """Write out everything appended so far and stop the writer."""
+        self._queue.put(None)
+        self._writer.join()
+
+    def _write_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            closing = batch[-1] is None
+            if closing:
+                batch.pop()
+            if batch:
+                self._write_batch(batch)
+            if closing:
+                self._file.close()
+                self._index_file.close()
+                return
+
+    def _write_batch(self, batch):
+        segment = self._segments[-1]
+        offset = segment.size
+        last_indexed = segment.index_offsets[-1] if segment.index_offsets else None
+        entries = []
+        for seq, room, timestamp, frame in batch:
+            room_bytes = room.encode('utf-8')
+            header = RECORD_HEADER.pack(0, seq, timestamp, len(room_bytes),
+                                        len(frame))
+            crc = zlib.crc32(header[4:])
+            crc = zlib.crc32(room_bytes, crc)
+            crc = zlib.crc32(frame, crc)
+            self._file.write(struct.pack(">I", crc) + header[4:])
+            self._file.write(room_bytes)
+            self._file.write(frame)
+            if last_indexed is None or offset - last_indexed >= self.index_interval:
+                entries.append((seq, offset))
+                last_indexed = offset
+            offset += RECORD_HEADER.size + len(room_bytes) + len(frame)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        for seq, entry_offset in entries:
+            self._index_file.write(INDEX_ENTRY.pack(seq, entry_offset))
+        self._index_file.flush()
+        with self._synced:
+            for seq, entry_offset in entries:
+                segment.add_to_index(seq, entry_offset)
+            segment.size = offset
+            segment.last_seq = batch[-1][0]
+            self._synced_seq = segment.last_seq
+            self._synced.notify_all()
+        if offset >= self.segment_bytes:
+            self._roll()
+
+    def _roll(self):
+        """Start a new segment and expire old ones."""
+        self._file.close()
+        self._index_file.close()
+        with self._lock:
+            self._segments.append(_Segment(self.directory, self._synced_seq + 1))
+        self._open_active()
+        self._expire()
+
+    def _expire(self):
+        now = time.time()
+        with self._lock:
+            total = sum(segment.size for segment in self._segments)
+            while len(self._segments) > 1:
+                oldest = self._segments[0]
+                try:
+                    age = now - os.path.getmtime(oldest.path)
+                except OSError:
+                    age = 0
+                if total <= self.max_bytes and age <= self.max_age:
+                    break
+                self._segments.pop(0)
+                total -= oldest.size
+                for path in (oldest.path, oldest.index_path):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+    def _open_active(self):
+        segment = self._segments[-1]
+        self._file = open(segment.path, "ab")
+        self._index_file = open(segment.index_path, "ab")
+
+    def _load_segments(self):
+        """Find the segments already in the directory, recovering the last
+        one, or start the first segment if there are none."""
+        first_seqs = sorted(int(name[:-len(SEGMENT_SUFFIX)])
+                            for name in os.listdir(self.directory)
+                            if name.endswith(SEGMENT_SUFFIX))
+        segments = []
+        for first_seq in first_seqs:
+            segment = _Segment(self.directory, first_seq)
+            if os.path.exists(segment.index_path):
+                with open(segment.index_path, "rb") as index_file:
+                    index = index_file.read()
+                for position in range(0, len(index) - INDEX_ENTRY.size + 1,
+                                      INDEX_ENTRY.size):
+                    segment.add_to_index(*INDEX_ENTRY.unpack_from(index, position))
+            self._recover(segment)
+            segments.append(segment)
+        if not segments:
+            segments.append(_Segment(self.directory, 1))
+        return segments
+
+    def _recover(self, segment):
+        """Find the end of the last whole record in <segment>, scanning on
+        from its last index entry, and cut off anything after it."""
+        file_size = os.path.getsize(segment.path)
+        # Index entries are written after their records, but be careful anyway
+        while segment.index_offsets and segment.index_offsets[-1] >= file_size:
+            segment.index_seqs.pop()
+            segment.index_offsets.pop()
+        offset = segment.index_offsets[-1] if segment.index_offsets else 0
+        last_seq = segment.first_seq - 1
+        if file_size:
+            with open(segment.path, "rb") as segment_file, \
+                 mmap.mmap(segment_file.fileno(), file_size,
+                           access=mmap.ACCESS_READ) as data:
+                while offset < file_size:
+                    try:
+                        record, end = self._read_record(data, offset)
+                    except ValueError:
+                        break
+                    last_seq = record.seq
+                    offset = end
+        if offset < file_size:
+            with open(segment.path, "r+b") as segment_file:
+                segment_file.truncate(offset)
+        with open(segment.index_path, "wb") as index_file:
+            for entry in zip(segment.index_seqs, segment.index_offsets):
+                index_file.write(INDEX_ENTRY.pack(*entry))
+        segment.size = offset
+        segment.last_seq = last_seq
+
+    @staticmethod
+    def _read_record(data, offset):
+        """Return the record starting at <offset> in <data> and the offset of
+        the one after it. Raises ValueError if the record isn't whole."""
+        if offset + RECORD_HEADER.size > len(data):
+            raise ValueError("Truncated record header.")
+        (crc, seq, timestamp, room_length,
+         frame_length) = RECORD_HEADER.unpack_from(data, offset)
+        room_start = offset + RECORD_HEADER.size
+        frame_start = room_start + room_length
+        end = frame_start + frame_length
+        if end > len(data) or zlib.crc32(data[offset + 4:end]) != crc:
+            raise ValueError("Torn or corrupt record.")
+        return (Record(seq, timestamp,
+                       str(data[room_start:frame_start], 'utf-8'),
+                       data[frame_start:end]), end)
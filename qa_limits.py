@@ -0,0 +1,265 @@
+# Rate limiting, floor control and output bounds for the QA server
+import time
+import threading
+import collections
+from qa_common import encode_frame, frame_sent
+
+class TokenBucket():
+    """Allows an action <rate> times a second on average, with bursts of up
+    to <burst> at once.
+
+    The bucket is refilled lazily from the time since it was last used, so
+    checking it is a couple of arithmetic operations and it needs no timer.
+    A bucket belongs to a single connection and is not locked."""
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._tokens = burst
+        self._updated = clock()
+
+    def take(self, tokens=1):
+        """Take <tokens> from the bucket and return True if there are enough,
+        otherwise leave the bucket alone and return False."""
+        now = self._clock()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens < tokens:
+            return False
+        self._tokens -= tokens
+        return True
+
+    def retry_after(self, tokens=1):
+        """Return how many seconds until <tokens> can be taken."""
+        missing = tokens - self._tokens - (self._clock() - self._updated) * self.rate
+        return max(0.0, missing / self.rate)
+
+class SpeakingFloor():
+    """The floor of a room, which only one speaker may hold at a time.
+
+    A speaker takes the floor by typing or speaking while nobody else holds
+    it, and holds it for <lock_seconds>. Every typing keepalive or line
+    spoken restarts that timer. Once the speaker has spoken <max_lines>
+    lines, or let the timer run out, the floor is free again and that
+    speaker has to wait <cooldown_seconds> before taking it again.
+
+    Speakers are only ever compared with each other, anything hashable
+    (such as a connection) will do. The floor is shared by every connection
+    in a room and may be used from any thread.
+    """
+    def __init__(self, lock_seconds=3, cooldown_seconds=30, max_lines=3,
+                 clock=time.monotonic):
+        self.lock_seconds = lock_seconds
+        self.cooldown_seconds = cooldown_seconds
+        self.max_lines = max_lines
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._holder = None
+        self._expires = 0
+        self._lines = 0
+        self._cooldowns = {} # speaker -> time their cooldown ends
+
+    def typing(self, speaker):
+        """Take or keep the floor for <speaker> because they are typing.
+        Returns a tuple (allowed, retry_after) like speak()."""
+        with self._lock:
+            return self._claim(speaker, self._clock())
+
+    def speak(self, speaker):
+        """Use up one of <speaker>'s lines, taking the floor if it's free.
+
+        Returns a tuple of whether they may speak and, if not, how many
+        seconds until they can try again."""
+        with self._lock:
+            now = self._clock()
+            claim = self._claim(speaker, now)
+            if not claim[0]:
+                return claim
+            self._lines += 1
+            if self._lines >= self.max_lines:
+                self._release(now)
+            return claim
+
+    def holder(self):
+        """Return the speaker holding the floor, or None if it's free."""
+        with self._lock:
+            self._expire(self._clock())
+            return self._holder
+
+    def forget(self, speaker):
+        """Let go of the floor and any cooldown for a <speaker> that left."""
+        with self._lock:
+            if self._holder == speaker:
+                self._holder = None
+            self._cooldowns.pop(speaker, None)
+
+    def _claim(self, speaker, now):
+        self._expire(now)
+        if self._holder is None:
+            cooldown = self._cooldowns.get(speaker, 0)
+            if cooldown > now:
+                return (False, cooldown - now)
+            self._cooldowns.pop(speaker, None)
+            self._holder = speaker
+            self._lines = 0
+        elif self._holder != speaker:
+            return (False, self._expires - now)
+        self._expires = now + self.lock_seconds
+        return (True, 0.0)
+
+    def _expire(self, now):
+        if self._holder is not None and self._expires <= now:
+            self._release(self._expires)
+
+    def _release(self, released):
+        self._cooldowns[self._holder] = released + self.cooldown_seconds
+        self._holder = None
+
+class OutboundQueue():
+    """The messages waiting to be sent to a single connection, bounded by 
+    both <max_messages> and <max_bytes>.
+
+    Each message is put along with its kind, normally its message type. Chat
+    and notifications, the kinds in DROPPABLE, may be thrown away when a 
+    client falls behind. Anything else, such as errors, credit and stream
+    chunks, is always kept since it is bounded some other way. When a put 
+    takes the queue over either bound <policy> decides what happens:
+
+    drop_oldest: The oldest droppable messages are thrown away until the 
+    queue is back within its bounds.
+
+    coalesce: As drop_oldest, but the messages thrown away are replaced by a
+    single message of the form {"type":"missed", "count":<NUMBER OF MESSAGES>}
+    so the client knows it missed something.
+
+    disconnect: put() returns False and the connection should be closed.
+
+    TrackedFrames that are thrown away are reported with frame_sent(). The
+    queue is filled from PubSub and other threads and emptied by the 
+    connection, so every method takes the queue's lock.
+
+    The droppable messages are also kept in a queue of their own, so the 
+    oldest is found without looking past everything that can't be dropped.
+    A message thrown away is only marked as such and left where it is for
+    get() to skip, so overflowing costs the same however long the queue is.
+    Once the marked entries outnumber the rest the queue is rebuilt without
+    them, which keeps a client that never reads from growing it for good.
+    """
+    DROPPABLE = frozenset(["pubmsg", "entrance", "exit", "screenshot",
+                           "screenshot_ref"])
+    POLICIES = ("drop_oldest", "coalesce", "disconnect")
+    _DROPPED = object() # The kind of entries thrown away
+
+    def __init__(self, max_messages=10000, max_bytes=16 * 1024 * 1024,
+                 policy="drop_oldest"):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown slow consumer policy: " + repr(policy))
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self._entries = collections.deque() # [frame, kind] lists, oldest first
+        self._droppable = collections.deque() # The droppable ones of those
+        self._count = 0 # Entries not thrown away
+        self._bytes = 0
+        self._missed = None # The queued entry drops are being coalesced into
+        self._lock = threading.Lock()
+        self.overflows = 0
+        self.dropped = 0
+        self.dropped_bytes = 0
+        self.peak_bytes = 0
+
+    def put(self, frame, kind=None):
+        """Add the encoded message <frame> of <kind> to the queue. Returns 
+        False if the queue overflowed and the connection should be closed."""
+        with self._lock:
+            entry = [frame, kind]
+            self._entries.append(entry)
+            if kind in self.DROPPABLE:
+                self._droppable.append(entry)
+            self._count += 1
+            self._bytes += len(frame)
+            self.peak_bytes = max(self.peak_bytes, self._bytes)
+            if self._within_bounds():
+                return True
+            self.overflows += 1
+            if self.policy == "disconnect":
+                return False
+            dropped = self._drop_oldest()
+        for frame in dropped:
+            frame_sent(frame)
+        return True
+
+    def get(self):
+        """Remove and return the oldest message in the queue, or None if the
+        queue is empty."""
+        with self._lock:
+            while self._entries:
+                entry = self._entries.popleft()
+                if entry[1] is self._DROPPED:
+                    continue
+                self._count -= 1
+                if entry[0] is None:
+                    self._missed = None
+                    return encode_frame({"type":"missed", "count":entry[2]})
+                if entry[1] in self.DROPPABLE:
+                    self._droppable.popleft() # Always this entry
+                self._bytes -= len(entry[0])
+                return entry[0]
+            return None
+
+    def clear(self):
+        """Empty the queue, returning the messages that were in it."""
+        with self._lock:
+            frames = [entry[0] for entry in self._entries 
+                      if entry[0] is not None]
+            self._entries.clear()
+            self._droppable.clear()
+            self._count = 0
+            self._bytes = 0
+            self._missed = None
+        return frames
+
+    def __len__(self):
+        return self._count
+
+    def stats(self):
+        """Return a dictionary describing how far behind the connection is
+        and how much has been thrown away because of it."""
+        with self._lock:
+            return {"queued_messages":self._count,
+                    "queued_bytes":self._bytes,
+                    "peak_bytes":self.peak_bytes,
+                    "overflows":self.overflows,
+                    "dropped":self.dropped,
+                    "dropped_bytes":self.dropped_bytes}
+
+    def _within_bounds(self):
+        return (self._count <= self.max_messages and 
+                self._bytes <= self.max_bytes)
+
+    def _drop_oldest(self):
+        """Throw away the oldest droppable messages until the queue is within
+        its bounds or there are none left, returning the frames dropped."""
+        dropped = []
+        while not self._within_bounds() and self._droppable:
+            entry = self._droppable.popleft()
+            frame = entry[0]
+            self._bytes -= len(frame)
+            self.dropped += 1
+            self.dropped_bytes += len(frame)
+            dropped.append(frame)
+            if self.policy == "coalesce" and self._missed is None:
+                # The first message dropped becomes the missed message
+                entry[:] = [None, "missed", 0]
+                self._missed = entry
+            else:
+                entry[:] = [None, self._DROPPED]
+                self._count -= 1
+            if self.policy == "coalesce":
+                self._missed[2] += 1
+        if len(self._entries) > 2 * self._count + 64:
+            self._entries = collections.deque(
+                entry for entry in self._entries 
+                if entry[1] is not self._DROPPED)
+        return dropped
@@ -0,0 +1,372 @@
+# Load generator speaking the QA wire protocol from many simulated clients
+import os
+import sys
+import json
+import time
+import base64
+import random
+import socket
+import struct
+import argparse
+import selectors
+import subprocess
+import collections
+import multiprocessing
+from qa_common import (FrameDecoder, OutputBuffer, LatencyHistogram, Attachment,
+                       BinaryMessage, encode_message, encode_binary_frame,
+                       FEATURE_ATTACHMENTS, FEATURE_BINARY)
+try:
+    import resource
+except ImportError: # Not on Windows
+    resource = None
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "qa_server.py")
+
+# Every message sent carries the number of the client that sent it and when
+# it was sent on the monotonic clock, which every process on the machine
+# shares, so whichever process receives it can tell how long it took. A
+# pubmsg starts with "<CLIENT>:<SECONDS>|" and is padded out to its size, a
+# screenshot starts with the same two numbers packed as STAMP.
+STAMP = struct.Struct(">Id")
+
+class SimulatedClient():
+    """One connection to the server, logged on as user <number>, or as an
+    administrator if <admin> is true so that it is sent screenshots."""
+    def __init__(self, address, number, admin, features):
+        self.number = number
+        self.connection = socket.create_connection(address)
+        self.connection.setblocking(False)
+        self.decoder = FrameDecoder()
+        self.output = OutputBuffer()
+        self.features = frozenset()
+        self.logged_on = False
+        self.next_pubmsg = None
+        self.next_screenshot = None
+        self.queue(encode_message(
+            {"type":"logon",
+             "user":{"username":"load" + str(number),
+                     "privileges":{"type":"admin" if admin else "user"}},
+             "server":{"protocol":"QAServ1.0", "client":"qa_loadgen",
+                       "features":list(features)}}))
+
+    def queue(self, frame):
+        self.output.append(frame)
+
+    def send(self, message):
+        if FEATURE_BINARY in self.features:
+            self.queue(encode_binary_frame(message))
+        else:
+            self.queue(encode_message(message))
+
+    def pubmsg(self, size):
+        text = "{}:{!r}|".format(self.number, time.monotonic())
+        self.send({"type":"pubmsg", "msg":text + "x" * (size - len(text))})
+
+    def screenshot(self, size):
+        data = STAMP.pack(self.number, time.monotonic()) + os.urandom(
+            max(0, size - STAMP.size))
+        if FEATURE_ATTACHMENTS in self.features or FEATURE_BINARY in self.features:
+            self.send({"type":"screenshot", "attachment":data})
+        else:
+            self.send({"type":"screenshot",
+                       "screenshot":base64.b64encode(data).decode('ascii')})
+
+class LoadResults():
+    """What one process of simulated clients saw."""
+    def __init__(self):
+        self.logged_on = 0
+        self.sent = collections.Counter()
+        self.delivered = collections.Counter()
+        self.latency = collections.defaultdict(LatencyHistogram)
+        self.errors = collections.Counter()
+        self.disconnected = 0
+
+    def merge(self, other):
+        self.logged_on += other.logged_on
+        self.sent.update(other.sent)
+        self.delivered.update(other.delivered)
+        for kind, histogram in other.latency.items():
+            self.latency[kind].merge(histogram)
+        self.errors.update(other.errors)
+        self.disconnected += other.disconnected
+
+def decode(message):
+    """Return a message pulled off the wire by a FrameDecoder as a dictionary."""
+    if isinstance(message, BinaryMessage):
+        return message.message
+    if isinstance(message, Attachment):
+        decoded = json.loads(message.header)
+        decoded["attachment"] = message.body
+        return decoded
+    return json.loads(message)[1]
+
+def sent_at(message):
+    """Return when the pubmsg or screenshot <message> was sent, or None if no
+    simulated client sent it."""
+    try:
+        if message["type"] == "pubmsg":
+            return float(message["msg"].split("|", 1)[0].split(":")[1])
+        if "attachment" in message:
+            data = message["attachment"]
+        else:
+            data = base64.b64decode(message["screenshot"][:24])
+        return STAMP.unpack_from(data)[1]
+    except (KeyError, IndexError, ValueError, struct.error):
+        return None
+
+def read(client, results, selector):
+    """Take in whatever the server sent <client>, timing the messages it was
+    waiting for."""
+    try:
+        received = client.decoder.recv_into(client.connection)
+    except (BlockingIOError, InterruptedError):
+        return
+    except OSError:
+        received = 0
+    if not received:
+        results.disconnected += 1
+        selector.unregister(client.connection)
+        client.connection.close()
+        return
+    arrived = time.monotonic()
+    frame = client.decoder.next_frame()
+    while frame is not None:
+        message = decode(frame)
+        kind = message["type"]
+        if kind == "room" and not client.logged_on:
+            client.logged_on = True
+            client.features = frozenset(message.get("server", {}).get("features", []))
+            results.logged_on += 1
+        elif kind == "error":
+            results.errors[message.get("reason", "")] += 1
+        elif kind in ("pubmsg", "screenshot"):
+            sent = sent_at(message)
+            if sent is not None:
+                results.delivered[kind] += 1
+                results.latency[kind].record(arrived - sent)
+        frame = client.decoder.next_frame()
+
+def write(client, selector):
+    """Write as much of the output of <client> as its socket takes, waiting
+    for it to become writable if anything is left."""
+    try:
+        while len(client.output):
+            client.output.write_to(client.connection)
+    except (BlockingIOError, InterruptedError):
+        pass
+    except OSError:
+        client.output.clear()
+    events = selectors.EVENT_READ
+    if len(client.output):
+        events |= selectors.EVENT_WRITE
+    try:
+        selector.modify(client.connection, events, client)
+    except (KeyError, ValueError):
+        pass # Already closed
+
+def poll(selector, results, timeout):
+    for key, mask in selector.select(timeout):
+        if mask & selectors.EVENT_READ:
+            read(key.data, results, selector)
+        if mask & selectors.EVENT_WRITE and key.fileobj.fileno() != -1:
+            write(key.data, selector)
+
+def run_clients(settings, address, numbers, ready, start, report):
+    """Run the simulated clients <numbers> in this process, reporting what
+    they saw to the queue <report> once the run is over."""
+    raise_file_limit()
+    results = LoadResults()
+    selector = selectors.DefaultSelector()
+    clients = []
+    for number in numbers:
+        client = SimulatedClient(address, number, number < settings.admins,
+                                 settings.features)
+        selector.register(client.connection, selectors.EVENT_READ, client)
+        write(client, selector)
+        clients.append(client)
+    deadline = time.monotonic() + settings.connect_timeout
+    while results.logged_on < len(clients) and time.monotonic() < deadline:
+        poll(selector, results, 0.05)
+    ready.put(results.logged_on)
+    start.wait()
+    begin = time.monotonic()
+    end = begin + settings.duration
+    senders = [client for client in clients if client.number < settings.senders
+               and client.logged_on]
+    for client in senders:
+        # Spread the first messages out so the senders don't all go at once
+        if settings.rate:
+            client.next_pubmsg = begin + random.uniform(0, 1 / settings.rate)
+        if settings.screenshot_rate:
+            client.next_screenshot = begin + random.uniform(
+                0, 1 / settings.screenshot_rate)
+    now = begin
+    while now < end + settings.drain:
+        timeout = end + settings.drain - now
+        if now < end:
+            for client in senders:
+                sent = False
+                while client.next_pubmsg is not None and client.next_pubmsg <= now:
+                    client.pubmsg(settings.size)
+                    client.next_pubmsg += 1 / settings.rate
+                    results.sent["pubmsg"] += 1
+                    sent = True
+                while (client.next_screenshot is not None and
+                       client.next_screenshot <= now):
+                    client.screenshot(settings.screenshot_size)
+                    client.next_screenshot += 1 / settings.screenshot_rate
+                    results.sent["screenshot"] += 1
+                    sent = True
+                if sent:
+                    write(client, selector)
+                for next_send in (client.next_pubmsg, client.next_screenshot):
+                    if next_send is not None:
+                        timeout = min(timeout, next_send - now)
+        poll(selector, results, max(0, timeout))
+        now = time.monotonic()
+    for client in clients:
+        client.connection.close()
+    report.put(results)
+
+def run_load(settings, address):
+    """Run a load against the server at <address> and return a dictionary
+    describing how it went."""
+    processes = max(1, min(settings.processes, settings.clients))
+    ready = multiprocessing.Queue()
+    report = multiprocessing.Queue()
+    start = multiprocessing.Event()
+    workers = [multiprocessing.Process(
+                   target=run_clients,
+                   args=(settings, address, range(part, settings.clients, processes),
+                         ready, start, report))
+               for part in range(processes)]
+    connect_started = time.monotonic()
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    logged_on = sum(ready.get(timeout=settings.connect_timeout + 30)
+                    for _ in workers)
+    connect_seconds = time.monotonic() - connect_started
+    start.set()
+    results = LoadResults()
+    for _ in workers:
+        results.merge(report.get(timeout=settings.duration + settings.drain + 60))
+    for worker in workers:
+        worker.join()
+    receivers = {"pubmsg":logged_on, "screenshot":min(settings.admins, logged_on)}
+    return {"settings":{key:value for key, value in vars(settings).items()
+                        if key not in ("host", "port")},
+            "logged_on":logged_on,
+            "connect_seconds":round(connect_seconds, 3),
+            "sent":dict(results.sent),
+            "expected":{kind:count * receivers[kind]
+                        for kind, count in results.sent.items()},
+            "delivered":dict(results.delivered),
+            "deliveries_per_second":round(sum(results.delivered.values()) /
+                                          settings.duration),
+            "latency":{kind:histogram.summary()
+                       for kind, histogram in results.latency.items()},
+            "errors":dict(results.errors),
+            "disconnected":results.disconnected}
+
+def raise_file_limit():
+    """Allow this process as many open files as the system lets it have."""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("localhost", 0))
+        return probe.getsockname()[1]
+
+def spawn_server(engine, workers, arguments=()):
+    """Start a server on a free port in a process of its own with <engine>
+    and <workers> worker processes, no speaking floor, pubmsg rate limits
+    too high to get in the way and any other command line <arguments>. 
+    Returns the process and the server's address once it takes connections.
+    Used by --spawn and by the benchmarks."""
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, SERVER, "--engine", engine, "-p", str(port),
+         "--workers", str(workers), "--no-floor",
+         "--pubmsg-rate", "1000000", "--pubmsg-burst", "1000000"] +
+        list(arguments),
+        stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("localhost", port)).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    time.sleep(0.5 * workers) # Give every worker time to listen
+    return server, ("localhost", port)
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Put a QA server under load from many simulated clients "
+        "and report throughput and publish to delivery latency as JSON.")
+    parser.add_argument("--host", default="localhost",
+                        help="Host of the server to put under load.")
+    parser.add_argument("-p", "--port", default=9665, type=int,
+                        help="Port of the server to put under load.")
+    parser.add_argument("--spawn", default=None,
+                        choices=["threads", "eventloop"],
+                        help="Start a server with this engine to put under "
+                        "load instead of using a running one.")
+    parser.add_argument("--workers", default=1, type=int,
+                        help="Worker processes of the server started with "
+                        "--spawn.")
+    parser.add_argument("-c", "--clients", default=40, type=int,
+                        help="Clients to log on.")
+    parser.add_argument("--senders", default=4, type=int,
+                        help="How many of the clients publish messages.")
+    parser.add_argument("--admins", default=1, type=int,
+                        help="How many of the clients log on as administrators"
+                        " and are sent screenshots.")
+    parser.add_argument("--rate", default=10.0, type=float,
+                        help="Public messages per second from each sender.")
+    parser.add_argument("--size", default=64, type=int,
+                        help="Characters in each public message.")
+    parser.add_argument("--screenshot-rate", default=0.0, type=float,
+                        help="Screenshots per second from each sender.")
+    parser.add_argument("--screenshot-size", default=100 * 1024, type=int,
+                        help="Bytes in each screenshot.")
+    parser.add_argument("--features", default=[], action="append",
+                        choices=["attachments", "binary", "deflate"],
+                        help="Protocol feature for the clients to ask for, "
+                        "may be given more than once.")
+    parser.add_argument("-d", "--duration", default=10.0, type=float,
+                        help="Seconds to send messages for.")
+    parser.add_argument("--drain", default=2.0, type=float,
+                        help="Seconds to wait for deliveries after sending "
+                        "stops.")
+    parser.add_argument("--processes", default=os.cpu_count() or 1, type=int,
+                        help="Processes to spread the clients over.")
+    parser.add_argument("--connect-timeout", default=30.0, type=float,
+                        help="Seconds to wait for every client to log on.")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    settings = parse_arguments(argv)
+    raise_file_limit()
+    server = None
+    address = (settings.host, settings.port)
+    if settings.spawn:
+        server, address = spawn_server(settings.spawn, settings.workers,
+                                       ["--screenshot-interval", "0.000001"])
+    try:
+        print(json.dumps(run_load(settings, address), indent=1))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,4 @@
-from qa_common import Configuration
+from qa_common import Configuration, FrameDecoder, encode_frame, StreamError
 from Crypto.PublicKey import DSA
 from Crypto.Hash import SHA256
 from Crypto.Random import random
@@ -240,9 +240,7 @@ class P2PNode(socketserver.ThreadingMixIn, socketserver.TCPServer):
         while not self._shutdown.is_set():
             message_tuple = self._send_queue.get()
             message = message_tuple[0]
-            message_length = self._calculate_recursive_length(message)
-            wrapped_message = [message_length, message]
-            wire_message = (json.dumps(wrapped_message) + "\r\n\r\n").encode('utf-8')
+            wire_message = encode_frame(message)
             message_tuple[1].sendall(wire_message)
         return True
 
@@ -259,31 +257,22 @@ class P2PNode(socketserver.ThreadingMixIn, socketserver.TCPServer):
         The method self.handle_test(message) would be called with the message
         dictionary object passed along.
         """
-        msg_buffer = bytes() # The message input buffer
+        decoder = FrameDecoder() # The message input buffer
         while not self._shutdown.is_set():
-            if msg_buffer:
+            message = decoder.next_frame()
+            if message is not None:
+                message = json.loads(message)[1]
                 try:
-                    msg_length = self.determine_length_of_json_msg(msg_buffer)
-                except InvalidLengthHeader:
-                    msg_length = float("inf")
-                if len(msg_buffer) >= msg_length:
-                    message = self.extract_msg(msg_buffer, msg_length)
-                    try:
-                        handler = getattr(self, "handle_" + message['type'])
-                    except AttributeError:
-                        print("Can't handle message of type: " +
-                              str(message['type']))
-                        continue
-                    handler(message)
-                    msg_buffer = msg_buffer[msg_length:]
-                else:
-                    try:
-                        msg_buffer += connection.recv(1024)
-                    except socket.timeout:
-                        pass
+                    handler = getattr(self, "handle_" + message['type'])
+                except AttributeError:
+                    print("Can't handle message of type: " +
+                          str(message['type']))
+                    continue
+                handler(message)
             else:
                 try:
-                    msg_buffer += connection.recv(1024)
+                    if not decoder.recv_into(connection):
+                        return False
                 except socket.timeout:
                     pass
     
@@ -324,107 +313,9 @@ class P2PNode(socketserver.ThreadingMixIn, socketserver.TCPServer):
             return False
 
     
-    def determine_length_of_json_msg(self, message_bytes):
-        """Incrementally parse a JSON message to extract the length header.
-
-        message_bytes: The bytes that represent the portion of the message 
-        recieved.
-        """
-        # All messages must be written in utf-8
-        message = message_bytes.decode('utf-8')
-        # Check that the message we have been given looks like a valid length header
-        if "," not in message:
-            raise InvalidLengthHeader(message)
-        length_portion = message.split(",")[0]
-        left_bracket = length_portion[0] == "["
-        number_before_comma = length_portion[-1] in "1234567890"
-        if left_bracket and number_before_comma:
-            for character in enumerate(length_portion):
-                if character[1] not in "[ \n\t\r1234567890,":
-                    raise InvalidLengthHeader(length_portion)
-                elif character[1] in "1234567890":
-                    length_start = character[0]
-                    return int(length_portion[length_start:])
-        elif left_bracket:
-            raise InvalidLengthHeader(length_portion)
-        else:
-            raise MissingLengthHeader(length_portion)
-        return False
-
-    def extract_msg(self, msg_buffer, length):
-        message = msg_buffer[:length].decode()
-        try:
-            right_curly_bracket = message[-6] == "}" or message[-2] == "}"
-        except IndexError:
-            print(message, msg_buffer, length)
-        valid_delimiter = message[-6:] == "}]\r\n\r\n"
-        if right_curly_bracket and valid_delimiter:
-            return message
-        elif right_curly_bracket:
-            raise InvalidMessageDelimiter(message)
-        else:
-            raise MissingMessageDelimiter(message)
-
-    def _calculate_recursive_length(self, msg_dict):
-        """Calculate the length of a dictionary represented as JSON once a length
-        field has been added as a key."""
-        delimiter = "\r\n\r\n"
-        initial_length = len(
-            json.dumps(msg_dict) + delimiter)
-        initial_list = [initial_length, msg_dict]
-        recursive_length = len(
-            json.dumps(initial_list) + delimiter)
-        recursive_list = [recursive_length, msg_dict]
-        while len(json.dumps(recursive_list) + delimiter) != recursive_list[0]:
-            recursive_length = len(
-                json.dumps(recursive_list) + delimiter)
-            recursive_list = [recursive_length, msg_dict]
-        return recursive_list[0]
-
-class StreamError(Exception):
-    """Errors related to handling MRC streams."""
-    pass
-
 class ConnectionError(StreamError):
     """Error raised when a connection is broken or nonexistent."""
     def __init__(self, error_message):
         self.error_message = error_message
     def __str__(self):
         return repr(self.error_message)
-
-class LengthHeaderError(StreamError):
-    """Abstract length header error class."""
-    def __init__(self, length_portion="Portion not given"):
-        self.length_portion = length_portion
-    def __str__(self):
-        return repr(self.length_portion)
-
-class MissingLengthHeader(LengthHeaderError):
-    """Error raised when a length header appears to be missing."""
-    pass
-
-class InvalidLengthHeader(LengthHeaderError):
-    """Error raised when a length header appears to be present but
-    garbled."""
-    pass
-
-class MessageDelimiterError(LengthHeaderError):
-    """Abstract message delimiter error class."""
-    pass
-
-class MissingMessageDelimiter(MessageDelimiterError):
-    """Error raised when a message delimiter appears to be missing."""
-    pass
-
-class InvalidMessageDelimiter(MessageDelimiterError):
-    """Error raised when a message delimiter appears to be present but
-    garbled."""
-    pass
-
-class JSONDecodeError(Exception):
-    """Error raised when a json encoded message fails to decode to a valid JSON
-    document."""
-    def __init__(self, invalid_json="JSON not given."):
-        self.invalid_json = invalid_json
-    def __str__(self):
-        return repr(self.invalid_json)
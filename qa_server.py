@@ -1,38 +1,268 @@
 import socketserver
 import socket
-import select
+import selectors
 import threading
 import queue
+import itertools
 import time
 import calendar
+import os
+import sys
 import json
+import base64
+import hmac
+import hashlib
+import signal
 import argparse
+import logging
+import tempfile
+import multiprocessing
+from qa_common import (FrameDecoder, DEFAULT_READ_SIZE, encode_frame, 
+                       encode_message, attachment_to_base64, Attachment,
+                       DeliveryTracker, TrackedFrame, frame_sent, OutputBuffer,
+                       FrameCompressor, FEATURE_DEFLATE, COMPRESS_THRESHOLD,
+                       BinaryMessage, encode_binary_frame, FEATURE_BINARY,
+                       FEATURE_ATTACHMENTS, FEATURE_STREAMS, 
+                       FEATURE_SCREENSHOT_REFS, FEATURE_ROSTER, CHUNK_SIZE,
+                       STREAM_WINDOW, DEFAULT_MAX_FRAME_SIZE, IOV_MAX,
+                       JSONDecodeError, StreamError)
+from qa_store import ScreenshotStore, MessageHistory
+from qa_censor import SwearFilter
+from qa_limits import TokenBucket, SpeakingFloor, OutboundQueue
+from qa_cluster import Hub, Bus
+from qa_journal import Journal
+from qa_metrics import Metrics, MetricsEndpoint
+
+log = logging.getLogger("qa_server")
 
 class PublishSubscribe():
-    """Publish Subscribe mechanism for the QA system.
-
-    Each thread spawned by the QAServer registers itself with an instance of this
-    class by calling its subscribe() method with itself as an argument and 
-    associated logon info. When a thread wants to send a message to the room it 
-    is put into a central queue using the send_pubmsg() method of this class which 
-    puts it into a FIFO queue. PublishSubscribe runs in its own thread and pulls
-    each of these messages from the queue and timestamps them in utc before sending
-    them to each relevant subscriber in the subscription list.
+    """Publish Subscribe mechanism for a single QA room.
+
+    Each thread spawned by the QAServer registers itself with the instance of 
+    this class for the room it joined by calling its subscribe() method with 
+    itself as an argument and associated logon info. When a thread wants to 
+    send a message to the room it is put into the room's queue using the 
+    put_msg_into_publish_queue() method of this class which puts it into a 
+    FIFO queue. Once start() has been called PublishSubscribe runs in its own
+    thread and pulls each of these messages from the queue and timestamps them
+    in utc before sending them to each relevant subscriber in the subscription
+    list. Every room has its own queue and thread, see RoomDirectory.
+
+    Alongside the subscription list PublishSubscribe keeps indexes that are
+    rebuilt whenever a subscription or privilege changes: <recipients>, a 
+    tuple of every subscribed connection, and the frozensets <admins> and 
+    <muted>. They are replaced rather than modified, so any thread can use 
+    them without a lock and routing a message costs no more than walking 
+    its recipients. The usernames of the subscribers are kept the same way 
+    as the tuple <roster>, with a <roster_version> that goes up every time
+    it changes. Connections that negotiated the roster feature are sent an
+    entrance or exit delta for each change instead of the whole roster, 
+    which is only encoded when a connection asks for it, see roster_frame().
+
+    Screenshots are kept in the ScreenshotStore <screenshot_store>, or a new
+    one with the default limits if none is given. Public messages are 
+    censored by the SwearFilter <swear_filter> if one is given. If a 
+    SpeakingFloor is given as <speaking_floor> users must hold it to speak,
+    connection handlers check it before messages are put into the queue.
+
+    If the room is given a qa_cluster Bus as <bus> it is one of several 
+    copies of the same room in the worker processes of a multi-process 
+    server. Anything sent to the whole room or to its admins is then 
+    published on the bus rather than sent straight to the subscribers, and
+    every copy of the room, this one included, sends it to its own 
+    subscribers when the bus delivers it. Since the bus delivers messages in
+    the same order to every worker all the subscribers of a room see the 
+    same conversation whichever worker they are connected to.
+
+    The messages of the kinds in <history_kinds> sent to the whole room are
+    kept in the MessageHistory <history>, or a new one with the default 
+    limits if none is given, and replayed to every connection that joins.
+    They are also appended to the qa_journal Journal <journal> if one is 
+    given, which writes them to disk from a thread of its own.
     """
-    def __init__(self):
-        global PubSub
-        PubSub = self
+    history_kinds = frozenset(["pubmsg"])
+
+    def __init__(self, name="main", topic=None, screenshot_store=None, 
+                 swear_filter=None, speaking_floor=None, bus=None,
+                 history=None, journal=None):
+        self.name = name
+        self.topic = name if topic is None else topic
         self.Subscriptions = {}
+        self.recipients = tuple()
+        self.admins = frozenset()
+        self.muted = frozenset()
+        self.roster = tuple()
+        self.roster_version = 0
+        self._roster_frame = None # Encoded roster, until the roster changes
+        self._subscriptions_lock = threading.Lock()
         self.Messages = queue.Queue()
-        self.swear_words_list = None #TODO: Make this point to a real file in the config.
-        self.pub_sub_loop()
+        self.screenshots = screenshot_store or ScreenshotStore()
+        self._stream_counter = itertools.count()
+        self._reassembly = {} # (connection, client stream id) -> bytearray
+        self.swear_filter = swear_filter
+        self.floor = speaking_floor
+        self.bus = bus
+        self.history = MessageHistory() if history is None else history
+        self.journal = journal
+        self._last_seq = 0 # The sequence number of the last message broadcast
+        # Held while sending to the whole room or joining it, so a joining
+        # connection gets each message either live or replayed, never both
+        self._broadcast_lock = threading.RLock()
+        self._thread = None
+
+    def start(self):
+        """Start publishing the room's messages from a thread of its own."""
+        self._thread = threading.Thread(target=self.pub_sub_loop,
+                                        name="room " + self.name)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
 
     def subscribe(self, connection, logon_info):
         """Add a QAServer <connection> to the subscriber list with the logon info
-        given in the dictionary <logon_info>."""
-        self.Subscriptions[connection] = logon_info
+        given in the dictionary <logon_info>, and tell the others it entered."""
+        with self._broadcast_lock:
+            with self._subscriptions_lock:
+                self.Subscriptions[connection] = logon_info
+                self._reindex()
+            self.send_roster_delta("entrance", logon_info["user_info"]["username"],
+                                   connection)
         return True
 
+    def join(self, connection, logon_info, since=None, last_seq=None):
+        """Subscribe <connection> like subscribe() and send it the room 
+        message, followed by the messages in the room's history sent at or
+        after the timestamp <since>, or all of them if it is None.
+
+        A connection resuming a session gives the sequence number of the 
+        last message it saw as <last_seq> instead, and is only sent the
+        messages in the history numbered after it.
+
+        The room message is made by the connection's generate_room_msg(). 
+        The room adds how many messages of history follow it under the key
+        'history', its latest sequence number under 'seq', under 'resumed' 
+        whether the history held everything a resuming connection missed and
+        the version of its roster under 'roster'. A connection that saw 
+        later messages than the room has isn't told it resumed, as the room
+        can't know what it missed. 
+
+        Each message of the history is queued as a frame of its own, so a
+        connection that compresses its frames compresses them one at a time,
+        and the connection's output buffer still writes them all out 
+        together."""
+        with self._broadcast_lock:
+            self.subscribe(connection, logon_info)
+            if last_seq is None:
+                history = self.history.since(since)
+                resumed = False
+            else:
+                history = self.history.after(last_seq)
+                resumed = (last_seq <= self._last_seq and
+                           self.history.complete_after(last_seq))
+            room_msg = connection.generate_room_msg()
+            room_msg["history"] = len(history)
+            room_msg["seq"] = self._last_seq
+            room_msg["resumed"] = resumed
+            room_msg["roster"] = self.roster_version
+            room_msg["timestamp"] = calendar.timegm(time.gmtime())
+            connection.put_msg(encode_frame(room_msg), "room")
+            for frame in history:
+                connection.put_msg(frame, "history")
+        return True
+
+    def unsubscribe(self, connection):
+        """Remove a QAServer <connection> from the subscriber list and tell 
+        the others it left."""
+        with self._broadcast_lock:
+            with self._subscriptions_lock:
+                logon_info = self.Subscriptions.pop(connection, None)
+                if logon_info is not None:
+                    self._reindex()
+            if logon_info is not None:
+                self.send_roster_delta("exit",
+                                       logon_info["user_info"]["username"])
+        if self.floor is not None:
+            self.floor.forget(connection)
+        for stream_key in list(self._reassembly):
+            if stream_key[0] is connection:
+                self._reassembly.pop(stream_key, None)
+        return True
+
+    def set_privilege(self, connection, privilege, value):
+        """Set <privilege> in the privileges of a subscribed <connection> to
+        <value>, returning False if it isn't subscribed."""
+        with self._subscriptions_lock:
+            if connection not in self.Subscriptions:
+                return False
+            self.Subscriptions[connection]["user_info"]["privileges"][privilege] = value
+            self._reindex()
+        return True
+
+    def mute(self, username, muted, from_bus=False):
+        """Set whether every connection of <username> is <muted>, returning
+        whether there were any.
+
+        If the room has a bus the mute is published on it instead, since the
+        user may be connected to any worker, and None is returned. The bus 
+        delivers it back with <from_bus> set and every worker then mutes its
+        own connections of the user."""
+        if self.bus is not None and not from_bus:
+            self.bus.publish({"room":self.name, "audience":"mute",
+                              "username":username, "muted":muted}, b"")
+            return None
+        found = False
+        for subscriber in self.recipients:
+            if subscriber.user_info["username"] == username:
+                found = self.set_privilege(subscriber, "muted", muted)
+        return found
+
+    def _reindex(self):
+        """Rebuild the recipient, admin and muted indexes from the subscription
+        list. Must be called with the subscriptions lock held."""
+        recipients = tuple(self.Subscriptions)
+        admins = []
+        muted = []
+        for connection in recipients:
+            privileges = self.Subscriptions[connection]["user_info"]["privileges"]
+            if privileges.get("type") == "admin":
+                admins.append(connection)
+            if privileges.get("muted"):
+                muted.append(connection)
+        self.recipients = recipients
+        self.admins = frozenset(admins)
+        self.muted = frozenset(muted)
+        roster = tuple(self.Subscriptions[connection]["user_info"]["username"]
+                       for connection in recipients)
+        if roster != self.roster:
+            self.roster = roster
+            self.roster_version += 1
+            self._roster_frame = None
+
+    def roster_frame(self):
+        """Return the room's roster encoded as a roster message, encoding it
+        only if it has changed since the last time it was asked for."""
+        with self._subscriptions_lock:
+            if self._roster_frame is None:
+                self._roster_frame = encode_frame(
+                    {"type":"roster", "roster":self.roster_version,
+                     "users":list(self.roster)})
+            return self._roster_frame
+
+    def send_roster_delta(self, kind, username, skip=None):
+        """Send an entrance or exit message for <username> to every recipient
+        but <skip> that negotiated the roster feature. Must be called with 
+        the broadcast lock held, right after the change, so the deltas go out
+        in the order of the versions they carry."""
+        frame = None
+        for recipient in self.recipients:
+            if recipient is skip or FEATURE_ROSTER not in recipient.features:
+                continue
+            if frame is None:
+                frame = encode_frame({"type":kind, "username":username,
+                                      "roster":self.roster_version,
+                                      "timestamp":calendar.timegm(time.gmtime())})
+            recipient.put_msg(frame, kind)
+
     def put_msg_into_publish_queue(self, message):
         """Put a <message> into this objects publish queue."""
         self.Messages.put(message)
@@ -52,83 +282,491 @@ class PublishSubscribe():
 
         How it is handled is that a function corresponding to the type of message
         is grabbed as an attribute from PublishSubscribe. Passed to this function
-        is all the information necessary to determine whether or not it should be
+        is the current recipients snapshot along with all the information necessary to determine whether or not it should be
         sent and if so to whom. A seperate communication channel is opened in the
         returned values for error messages such as those informing a user they are
-        muted to be sent to the client.
+        muted to be sent to the client. A filter may return a fourth value, a
+        function to call once the message has been written out to every one
+        of its recipients.
 
         The message is grabbed, then the privilege checks are applied, finally
-        if applicable the message is sent to the entire subscriber list.
+        if applicable the message is sent to the entire subscriber list. Each
+        message is encoded for the wire once after filtering and the same bytes
+        are put into the send queue of every recipient, so the cost of 
+        serializing a message does not grow with the size of the room. (See
+        encode_for() for the one exception, messages with attachments.)
+
+        A message that can't be published is logged and dropped, the room
+        carries on with the next one.
         """
         while True:
-            message_tuple = self.Messages.get()
-            print("Pubsub got a message!") #DEBUG
-            message = message_tuple[0]
-            connection = message_tuple[1]
-            message["timestamp"] = calendar.timegm(time.gmtime())
+            message, connection = self.Messages.get()
             try:
-                if not message["username"]: # Reject messages from clients which have not logged in
-                    print("Not logged in.") #DEBUG
-                    continue
-            except KeyError:
-                raise ImproperHandlingError(
-                    message, 
-                    "No 'username' key was added by handler.")
-            msg_type = message["type"]
-            msg_filter = getattr(self, "filter_" + msg_type)
-            filtered = msg_filter(self.Subscriptions.copy(), connection, message)
-            filtered_recipients = filtered[0]
-            error_notifications = filtered[1]
-            message = filtered[2]
-            print(filtered_recipients, error_notifications, message) #DEBUG
+                self.publish(message, connection)
+            except Exception:
+                log.exception("Room %s dropped a %r message.", self.name,
+                              message.get("type"))
+
+    def publish(self, message, connection):
+        """Filter and send one <message> taken from the publish queue along
+        with the <connection> it came from."""
+        message["timestamp"] = calendar.timegm(time.gmtime())
+        try:
+            if not message["username"]: # Reject messages from clients which have not logged in
+                return
+        except KeyError:
+            raise ImproperHandlingError(
+                message, 
+                "No 'username' key was added by handler.")
+        if connection not in self.Subscriptions:
+            return # The connection left before its message was published
+        msg_type = message["type"]
+        msg_filter = getattr(self, "filter_" + msg_type)
+        recipients = self.recipients
+        timed = Metrics.enabled
+        if timed:
+            started = time.perf_counter()
+            filtered = msg_filter(recipients, connection, message)
+            fanout_started = time.perf_counter()
+            Metrics.histogram("filter." + msg_type).record(
+                fanout_started - started)
+        else:
+            filtered = msg_filter(recipients, connection, message)
+        filtered_recipients = filtered[0]
+        error_notifications = filtered[1]
+        message = filtered[2]
+        tracker = None
+        if len(filtered) > 3:
+            tracker = DeliveryTracker(len(filtered_recipients), filtered[3])
+        if (filtered_recipients is recipients and tracker is None and
+            "attachment" not in message):
+            # Sent to the whole room, on every worker if there are several
+            if self.bus is not None:
+                self.bus.publish({"room":self.name, "audience":"all",
+                                  "kind":message["type"],
+                                  "timestamp":message["timestamp"]}, 
+                                 encode_message(message))
+            else:
+                self.broadcast(message)
+        elif filtered_recipients:
+            encoded = {}
             for recipient in filtered_recipients:
-                recipient.put_msg(message)
-            for error in error_notifications:
-                self.put_msg_into_publish_queue(error)
+                recipient.put_msg(
+                    self.encode_for(recipient, message, encoded, tracker),
+                    message["type"])
+        if timed:
+            Metrics.histogram("fanout").record(
+                time.perf_counter() - fanout_started)
+        for error in error_notifications:
+            self.put_msg_into_publish_queue(error)
+
+    def deliver(self, header, body):
+        """Send a message the bus delivered to this room to its subscribers.
+
+        <header> says who the message is for, and <body> is either the
+        encoded message to send to all of them or the bytes of a screenshot
+        to publish to the admins."""
+        if header["audience"] == "admins":
+            self.publish_screenshot(header["screenshot"], body, from_bus=True)
+            return
+        if header["audience"] == "mute":
+            self.mute(header["username"], header["muted"], from_bus=True)
+            return
+        self.broadcast(json.loads(body)[1], header["seq"])
+
+    def broadcast(self, message, seq=None):
+        """Send <message> to every subscriber, keeping it in the room's 
+        history if it is one of the history_kinds.
+
+        The message is numbered with the room's next sequence number under
+        the key 'seq', or with <seq> if the bus has already numbered it, and
+        encoded once for the subscribers that read binary frames and once for
+        everybody else. The history and journal keep the ordinary encoding,
+        which every client can read."""
+        kind = message["type"]
+        with self._broadcast_lock:
+            if seq is None:
+                seq = self._last_seq + 1
+            self._advance_seq(seq)
+            message["seq"] = seq
+            frame = encode_message(message)
+            binary_frame = None
+            if kind in self.history_kinds:
+                self.history.append(message["timestamp"], frame, seq)
+                if self.journal is not None:
+                    self.journal.append(self.name, message["timestamp"], frame)
+            for recipient in self.recipients:
+                if FEATURE_BINARY in recipient.features:
+                    if binary_frame is None:
+                        binary_frame = encode_binary_frame(message)
+                    recipient.put_msg(binary_frame, kind)
+                else:
+                    recipient.put_msg(frame, kind)
+
+    def restore(self, timestamp, frame):
+        """Put the encoded message <frame> read back from the journal into
+        the history, carrying on numbering messages after it."""
+        seq = json.loads(frame)[1].get("seq", 0)
+        with self._broadcast_lock:
+            self._advance_seq(seq)
+            self.history.append(timestamp, frame, seq)
+
+    def _advance_seq(self, seq):
+        """Make <seq> the room's latest sequence number if it is later. If 
+        numbers were skipped to get to it, which happens when a worker opens
+        a room other workers were already using or the journal didn't hold
+        everything, the room never saw those messages and its history can't
+        be complete before <seq>."""
+        if seq > self._last_seq + 1:
+            self.history.forget_through(seq - 1)
+        self._last_seq = max(self._last_seq, seq)
+
+    def encode_for(self, recipient, message, encoded, tracker=None):
+        """Return <message> encoded for the wire in the form <recipient> can
+        read. 
+
+        Connections that negotiated binary frames get one, raw bytes and all.
+        Otherwise messages carrying raw bytes go out as attachment frames to
+        connections that negotiated them and as base64 inside an ordinary 
+        message to everybody else. Each form is built the first time a 
+        recipient needs it and kept in the dictionary <encoded>, so a message
+        is never encoded more than once per form. If a DeliveryTracker is 
+        given as <tracker> the encoded forms are TrackedFrames reporting to 
+        it."""
+        if FEATURE_BINARY in recipient.features:
+            form = "binary"
+        elif "attachment" in message and FEATURE_ATTACHMENTS not in recipient.features:
+            form = "base64"
+        else:
+            form = "wire"
+        if form not in encoded:
+            if form == "binary":
+                encoded[form] = encode_binary_frame(message)
+            elif form == "base64":
+                encoded[form] = encode_frame(
+                    attachment_to_base64(message, message["type"]))
+            else:
+                encoded[form] = encode_message(message)
+            if tracker is not None:
+                encoded[form] = TrackedFrame(encoded[form], tracker)
+        return encoded[form]
 
-    def filter_pubmsg(self, subscriptions, connection, pubmsg):
+    def filter_pubmsg(self, recipients, connection, pubmsg):
         """Filter a public message sent to the entire room.
 
         Public messages are filtered on swear words and privileges such as whether
-        a given user is currently muted.
+        a given user is currently muted. The connection handler already turns
+        away muted users, this catches anyone muted while their message was
+        in the queue.
         """
-        if "muted" in subscriptions[connection]["user_info"]["privileges"]:
-            print("Muted.") #DEBUG
-            muted = subscriptions[connection]["user_info"]["privileges"]["muted"]
-            if muted:
-                return (list(), list(), None) 
-                #TODO: Make this send a message back to the client that
-                # their message was not sent.
-        # pubmsg["msg"] = censor_swear_words(pubmsg["msg"]) TODO: Implement this.
+        if connection in self.muted:
+            return (list(), list(), None) 
+        pubmsg["msg"] = self.censor_swear_words(pubmsg["msg"])
+        return (recipients, list(), pubmsg)
+
+    def filter_screenshot(self, recipients, connection, screenshot):
+        """Filter a screenshot sent to the administrators. 
+
+        The screenshot is put into the screenshot store and published from 
+        there by publish_screenshot(), so nothing is left for the mainloop to
+        send."""
+        body = screenshot.pop("attachment")
+        self.publish_screenshot(screenshot, body)
+        return (list(), list(), None)
+
+    def filter_screenshot_chunk(self, recipients, connection, chunk):
+        """Filter one chunk of a screenshot being streamed to the administrators.
+
+        Chunks are collected until the final one arrives and the whole 
+        screenshot is then published like any other. The uploader is given 
+        credit for another chunk as soon as this one has been taken in. The
+        connection handler bounds how large a stream may grow and how many
+        a connection may have open, and sends an 'abort' chunk in place of
+        the rest of a stream it refuses, which throws away what was 
+        collected.
+        """
+        stream_key = (connection, chunk["stream"])
+        if chunk.get("abort"):
+            self._reassembly.pop(stream_key, None)
+            return (list(), list(), None)
+        self._reassembly.setdefault(stream_key, bytearray()).extend(
+            chunk["attachment"])
+        if chunk["final"]:
+            body = bytes(self._reassembly.pop(stream_key))
+            screenshot = {"type":"screenshot",
+                          "username":chunk["username"],
+                          "timestamp":chunk["timestamp"]}
+            self.publish_screenshot(screenshot, body)
+        connection.put_msg(encode_frame(
+            {"type":"credit", "stream":chunk["stream"], "chunks":1}))
+        return (list(), list(), None)
+
+    def publish_screenshot(self, screenshot, body, from_bus=False):
+        """Put the bytes <body> of a screenshot into the screenshot store and
+        let every administrator know about it.
+
+        Admins that negotiated screenshot references are sent a small 
+        screenshot_ref message and fetch the screenshot from the store if and
+        when they want it. Any other admins are sent the whole screenshot 
+        straight away with send_screenshot(). Sending the same screenshot 
+        twice only stores it once.
+
+        If the room has a bus the screenshot is published on it instead and
+        nothing is returned. The bus delivers it back with <from_bus> set and
+        every worker then stores it and tells its own admins about it."""
+        if self.bus is not None and not from_bus:
+            self.bus.publish({"room":self.name, "audience":"admins",
+                              "kind":"screenshot", "screenshot":screenshot},
+                             body)
+            return None
+        digest = self.screenshots.put(body)
+        reference = {"type":"screenshot_ref",
+                     "hash":digest,
+                     "size":len(body),
+                     "username":screenshot["username"],
+                     "timestamp":screenshot["timestamp"]}
+        screenshot = dict(screenshot, hash=digest, attachment=body)
+        encoded_reference = None
+        encoded = {}
+        for subscriber in self.admins:
+            if FEATURE_SCREENSHOT_REFS in subscriber.features:
+                if encoded_reference is None:
+                    encoded_reference = encode_frame(reference)
+                subscriber.put_msg(encoded_reference, "screenshot_ref")
+            else:
+                self.send_screenshot(subscriber, screenshot, encoded)
+        return digest
+
+    def send_screenshot(self, recipient, screenshot, encoded):
+        """Send the message <screenshot> with its bytes under 'attachment' to
+        <recipient>.
+
+        Screenshots larger than a single chunk are streamed to recipients that
+        negotiated streams, anyone else is sent one message encoded by 
+        encode_for() into the dictionary <encoded>."""
+        if (FEATURE_STREAMS in recipient.features and 
+            len(screenshot["attachment"]) > CHUNK_SIZE):
+            header = dict(screenshot)
+            body = header.pop("attachment")
+            OutgoingStream(recipient, next(self._stream_counter),
+                           header, body).start()
         else:
-            return (subscriptions, list(), pubmsg)
-
-    def filter_screenshot(self, subscriptions, connection, screenshot):
-        recipients = []
-        for subscriber in subscriptions:
-            if subscriptions[subscriber]["user_info"]["privileges"]["type"] == "admin":
-                recipients.append(subscriber)
-        return (recipients, list(), screenshot)
-
-    def filter_room(self, subscriptions, connection, room):
-        return ([connection], list(), room)
-
-    def filter_entrance(self, subscriptions, connection, entrance):
-        #TODO: Add a timestamp to the message
-        outmsg = {"type":"entrance",
-                  "username":subscriptions[connection]["user_info"]["username"]}
-        return (subscriptions, list(), outmsg)
-
-    def filter_exit(self, subscriptions, connection, _exit):
-        #TODO: YOU MUST VALIDATE THIS SO IT CAN'T BE SPOOFED
-        outmsg = {"type":"exit",
-                  "username":subscriptions[connection]["user_info"]["username"]}
-        return (subscriptions, list(), outmsg)
-        
+            recipient.put_msg(self.encode_for(recipient, screenshot, encoded),
+                              screenshot["type"])
+
 
     def censor_swear_words(self, message_text):
         """Replace swear words in the text of a message with astericks."""
-        pass
+        if self.swear_filter is None:
+            return message_text
+        return self.swear_filter.censor(message_text)
+
+class RoomDirectory():
+    """The rooms on a QA server.
+
+    Each room is a PublishSubscribe with its own subscriptions, queue and 
+    thread, so traffic in one room never waits behind traffic in another and
+    several lab sections can share a server. A logon names the room to join
+    under its server_info key 'room', or joins <default_room> if it doesn't.
+
+    The rooms in <topics>, a dictionary of room names to topics, are opened
+    straight away. If <open_rooms> is set naming any other room opens it, up
+    to a total of <max_rooms>. Every room shares the screenshot store and the
+    swear filter, and if <floor_settings> is not None each room gets its own
+    SpeakingFloor built with it as keyword arguments. Each room's 
+    MessageHistory is built the same way with <history_settings>.
+
+    If a qa_journal Journal is given as <journal> every room journals its
+    history, and the histories are filled from the last <restore_records>
+    records in the journal so a restart doesn't lose the conversation.
+
+    If <bus_path> is given the server is one worker of a multi-process 
+    server and the rooms are linked to the same rooms in the other workers
+    through a qa_cluster Bus connected to the hub at that path. The hub 
+    keeps the journal, and the histories are filled from the records it 
+    sends when the bus connects. Mutes are passed to every worker over the
+    bus. Rosters and rate limits stay local
+    to each worker, and since a speaking floor would too the rooms can't 
+    have one, giving <floor_settings> along with <bus_path> is a ValueError.
+
+    Every logon is given a resume token naming the user and their room,
+    signed with <session_secret> (random unless given). A client that lost
+    its connection presents the token when it logs on again to carry on as
+    the same user in the same room. The tokens aren't stored anywhere, so
+    any worker sharing the secret can check them.
+
+    Creating a RoomDirectory makes it the server's global Rooms.
+    """
+    max_name_length = 64
+    restore_records = 10000
+
+    def __init__(self, topics=None, default_room="main", open_rooms=True,
+                 max_rooms=64, screenshot_store=None, swear_filter=None,
+                 floor_settings=None, history_settings=None, journal=None,
+                 bus_path=None, session_secret=None):
+        if bus_path is not None and floor_settings is not None:
+            raise ValueError("A speaking floor can't be shared between "
+                             "workers.")
+        self.default_room = default_room
+        self.open_rooms = open_rooms
+        self.max_rooms = max_rooms
+        self.screenshots = screenshot_store or ScreenshotStore()
+        self.swear_filter = swear_filter
+        self.floor_settings = floor_settings
+        self.history_settings = history_settings or {}
+        self.journal = journal
+        self.session_secret = session_secret or os.urandom(32)
+        self._rooms = {}
+        self._lock = threading.Lock()
+        self.bus = None
+        if bus_path is not None:
+            self.bus = Bus(bus_path, self.deliver)
+        topics = dict(topics or {})
+        topics.setdefault(default_room, None)
+        for name, topic in topics.items():
+            self._open(name, topic)
+        if journal is not None:
+            self._restore((record.room, record.timestamp, record.frame)
+                          for record in journal.tail(self.restore_records))
+        elif self.bus is not None:
+            self._restore((header["room"], header["timestamp"], body)
+                          for header, body in self.bus.restored)
+            self.bus.restored = []
+        self.send_queue_gauges()
+        global Rooms
+        Rooms = self
+
+    def join(self, name=None):
+        """Return the room called <name>, or the default room if no name is 
+        given, opening it if that's allowed. Returns None if there is no such
+        room and it can't be opened."""
+        if name is None:
+            name = self.default_room
+        if not isinstance(name, str) or not 0 < len(name) <= self.max_name_length:
+            return None
+        with self._lock:
+            room = self._rooms.get(name)
+            if room is None and self.open_rooms and len(self._rooms) < self.max_rooms:
+                room = self._open(name, None)
+            return room
+
+    def rooms(self):
+        """Return a list of the open rooms."""
+        with self._lock:
+            return list(self._rooms.values())
+
+    def issue_token(self, username, room):
+        """Return a resume token for <username> in the room called <room>."""
+        session = base64.urlsafe_b64encode(
+            json.dumps([username, room]).encode('utf-8')).decode('ascii')
+        return session + "." + self._sign(session)
+
+    def check_token(self, token):
+        """Return the username and room name of the resume token <token> as a
+        tuple, or None if the token isn't valid."""
+        if not isinstance(token, str) or "." not in token:
+            return None
+        session, _, signature = token.rpartition(".")
+        if not hmac.compare_digest(signature.encode('utf-8'),
+                                   self._sign(session).encode('ascii')):
+            return None
+        username, room = json.loads(base64.urlsafe_b64decode(session))
+        return (username, room)
+
+    def _sign(self, session):
+        return hmac.new(self.session_secret, session.encode('utf-8'),
+                        hashlib.sha256).hexdigest()
+
+    def deliver(self, header, body):
+        """Pass a message from the bus on to the room it is for. Rooms that
+        aren't open in this worker have nobody to send it to."""
+        with self._lock:
+            room = self._rooms.get(header["room"])
+        if room is not None:
+            room.deliver(header, body)
+
+    def _restore(self, records):
+        """Fill the histories of the rooms from the end of the journal, read
+        from it or sent by the hub, given as (room, timestamp, frame) 
+        <records>."""
+        for name, timestamp, frame in records:
+            room = self.join(name)
+            if room is not None:
+                room.restore(timestamp, frame)
+
+    def _open(self, name, topic):
+        floor = None
+        if self.floor_settings is not None:
+            floor = SpeakingFloor(**self.floor_settings)
+        room = PublishSubscribe(name, topic, self.screenshots, 
+                                self.swear_filter, floor, self.bus,
+                                MessageHistory(**self.history_settings),
+                                self.journal)
+        self._rooms[name] = room
+        Metrics.gauge("room." + name + ".publish_queue", room.Messages.qsize)
+        Metrics.gauge("room." + name + ".subscribers", 
+                      lambda: len(room.recipients))
+        return room.start()
+
+    def send_queue_gauges(self):
+        """Report the number of connections and the state of their send 
+        queues, summed over every room, as gauges of the global Metrics."""
+        def connections():
+            return [connection for room in self.rooms() 
+                    for connection in room.recipients]
+        def total(figure):
+            return lambda: sum(connection.send_queue.stats()[figure]
+                               for connection in connections())
+        Metrics.gauge("connections", lambda: len(connections()))
+        Metrics.gauge("send_queue.messages", total("queued_messages"))
+        Metrics.gauge("send_queue.bytes", total("queued_bytes"))
+        Metrics.gauge("send_queue.dropped", total("dropped"))
+        Metrics.gauge("send_queue.max_bytes", 
+                      lambda: max([connection.send_queue.stats()["queued_bytes"]
+                                   for connection in connections()] or [0]))
+
+class OutgoingStream():
+    """An attachment being streamed to a single connection a chunk at a time.
+
+    At most STREAM_WINDOW chunks of the stream are in the connection's send
+    queue at once. Each chunk is a TrackedFrame and the next one is queued 
+    when it has been written out, so the stream goes at the pace of the 
+    connection. <header> is the message the attachment belongs to, each 
+    chunk is sent as a copy of it with the stream fields added and its type
+    changed to '<type>_chunk'."""
+    def __init__(self, connection, stream_id, header, body):
+        self.connection = connection
+        self.stream_id = stream_id
+        self.header = header
+        self.body = memoryview(body)
+        self.offset = 0
+        self.seq = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Queue the first window of chunks on the connection."""
+        for _ in range(STREAM_WINDOW):
+            if not self._send_next():
+                break
+
+    def _send_next(self):
+        """Queue the next chunk if there is one and the connection is still
+        open, returning whether a chunk was queued."""
+        with self._lock:
+            if self.connection.closed or self.offset >= len(self.body):
+                return False
+            part = self.body[self.offset:self.offset + CHUNK_SIZE]
+            self.offset += len(part)
+            chunk = dict(self.header)
+            chunk.update({"type":self.header["type"] + "_chunk",
+                          "stream":self.stream_id,
+                          "seq":self.seq,
+                          "final":self.offset >= len(self.body),
+                          "attachment":part})
+            self.seq += 1
+        self.connection.put_msg(TrackedFrame(
+            encode_message(chunk), DeliveryTracker(1, self._send_next)))
+        return True
 
 class QAServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     """Questions and answer server for demonstrations in a computer lab.
@@ -141,8 +779,8 @@ class QAServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     up to two more lines.
 
     Once those three lines have been typed or the lock has expired that user
-    cannot type again for thirty seconds. This is all configurable in 
-    qa_config.json. The swear filter is applied before messages are sent
+    cannot type again for thirty seconds. This is all configurable on the
+    command line. The swear filter is applied before messages are sent
     to channel, filters are applied over all messages before being sent
     including the admins. 
 
@@ -156,7 +794,16 @@ class QAServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     document.
     """
     daemon_threads = True
-    
+    allow_reuse_port = False
+    request_queue_size = 1024
+
+    def server_bind(self):
+        """Bind the server's socket, with SO_REUSEPORT if allow_reuse_port 
+        is set so several workers can listen on the same port. TCPServer 
+        only looks at allow_reuse_port itself from Python 3.11 on."""
+        if self.allow_reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
 
 class MRCStreamHandler(socketserver.BaseRequestHandler):
         """Handles incoming requests for MRC connections for the question
@@ -168,10 +815,54 @@ class MRCStreamHandler(socketserver.BaseRequestHandler):
         before cutting the cord.
         """
 
+        read_size = DEFAULT_READ_SIZE
+        # Longest message a client may send, see FrameDecoder
+        max_frame_size = DEFAULT_MAX_FRAME_SIZE
+        # Messages that may be sent before logging on
+        before_logon = frozenset(["logon", "rooms"])
+        # How often users may send each type of message, as a pair of 
+        # (messages per second, burst) keyed by message type. Types that 
+        # aren't listed aren't limited, and neither are administrators.
+        message_limits = {}
+        # Bounds on each connection's send queue and what to do when a client
+        # falls so far behind that it hits them, see OutboundQueue.
+        send_queue_messages = 10000
+        send_queue_bytes = 16 * 1024 * 1024
+        slow_consumer_policy = "drop_oldest"
+        # How much the output buffer takes from the send queue at a time
+        output_bytes = 64 * 1024
+        # Messages sent to clients that negotiated compression are compressed
+        # if they are at least this many bytes long
+        compress_threshold = COMPRESS_THRESHOLD
+        # How large a streamed screenshot may grow and how many streams a 
+        # connection may be sending at once
+        max_stream_bytes = 16 * 1024 * 1024
+        max_open_streams = 4
+        # The key administrators give at logon under the server_info key 
+        # 'admin_key' to be exempt from rate limits and the speaking floor.
+        # Privileges are whatever the client says they are, so without a key
+        # nobody is exempt.
+        admin_key = None
+        # Optional protocol features a client may ask for in its logon message
+        supported_features = frozenset([FEATURE_ATTACHMENTS, FEATURE_STREAMS,
+                                        FEATURE_SCREENSHOT_REFS, FEATURE_ROSTER,
+                                        FEATURE_DEFLATE, FEATURE_BINARY])
+
+        def setup(self):
+            """Create the socket pair other threads use to wake the connection
+            mainloop when they put a message into its send queue."""
+            self._wakeup_receiver, self._wakeup_sender = socket.socketpair()
+            self._wakeup_receiver.setblocking(False)
+            self._wakeup_sender.setblocking(False)
+
+        def finish(self):
+            self._wakeup_receiver.close()
+            self._wakeup_sender.close()
+
         def handle(self):
             """Handle a QA connection.
 
-            Messages are taken in by an input buffer 1024 bytes at a time until
+            Messages are read into an input buffer read_size bytes at a time until
             they are fully recieved. All messages are JSON documents. Once a 
             message has been recieved by the server it is sent to select_and_handle_msg()
             to be parsed as JSON and then passed on to a message handler. The
@@ -183,17 +874,23 @@ class MRCStreamHandler(socketserver.BaseRequestHandler):
             method. The handle_logon() method initializes a connection, setting
             its privileges and registering client information.
 
-            The QA system only supports one chatroom on-server. Each public
-            message sent to the server is handled by the handle_pubmsg() method
-            which puts messages into the PublishSubscribe system. The Publish
-            Subscribe system keeps a queue of all messages to be sent to clients
-            and a subscriber list. Each message in the queue is put in every 
-            clients send queue.
+            The QA system supports several chatrooms on-server, each client 
+            joins one of them at logon. Each public message sent to the server
+            is handled by the handle_pubmsg() method which puts messages into 
+            the PublishSubscribe system of the client's room. Each room's 
+            Publish Subscribe system keeps a queue of all messages to be sent 
+            to its clients and a subscriber list. Each message in the queue is
+            put in every clients send queue.
 
             The mainloop for each client connection handles both input and output.
             Input is prioritized over output so that if the room is flooded by a
             malicious client an administrator can send the messages to the server
-            necessary to silence them.
+            necessary to silence them. When there is nothing to do the mainloop
+            blocks in poll() on both the client socket and a wakeup socket that
+            put_msg() writes to, so queued messages are sent immediately rather 
+            than on the next polling interval. Unlike select() poll() has no
+            limit on the numbers of the sockets, which run past it once a few
+            hundred clients are connected.
 
             The QA system also supports sending images to the room. When an image
             is sent to the room it is only sent to administrators. This is because
@@ -201,138 +898,178 @@ class MRCStreamHandler(socketserver.BaseRequestHandler):
             instructor of the computer lab. For example if you are demonstrating
             a piece of software and the demonstration is based on the state of the
             software at a given time, a screenshot can be sent to the instructor
-            so he can see the state without having to get up and look. Images
-            are encoded as base64 so that they can be sent as JSON documents.
+            so he can see the state without having to get up and look. Clients
+            that negotiated the attachments feature send and recieve images as
+            raw bytes in attachment frames, older clients encode them as base64
+            so that they can be sent as JSON documents.
             """
-            self.send_queue = queue.Queue() # The message output queue
-            self.user_info = {"username":None, "privileges":dict()}
-            self.server_info = {"protocol":None, "client":None}
-            msg_buffer = bytes() # The message input buffer
-            while 1:
-                if not self.send_queue.empty():
-                    print("Queue message detected!") #DEBUG
+            self.init_connection_state()
+            decoder = FrameDecoder(self.read_size, self.max_frame_size)
+            poller = getattr(selectors, "PollSelector", selectors.SelectSelector)()
+            poller.register(self.request, selectors.EVENT_READ)
+            poller.register(self._wakeup_receiver, selectors.EVENT_READ)
+            reason = "Connection handler stopped."
+            try:
+                while 1:
                     message = self.send_queue.get()
-                    self.send_msg(message)
-                elif msg_buffer:
-                    print("Message buffer has " + str(len(msg_buffer)) + " of content!") #DEBUG
+                    if message is not None:
+                        if not self.send_msg(message):
+                            return
+                        continue
                     try:
-                        msg_length = self.determine_length_of_json_msg(msg_buffer)
-                    except InvalidLengthHeader:
-                        msg_length = float("inf")
-                    if len(msg_buffer) >= msg_length:
-                        message = self.extract_msg(msg_buffer, msg_length)
+                        message = decoder.next_frame()
+                    except StreamError as error:
+                        # There's no telling where the next message would start
+                        self.handle_quit(str(error))
+                        return
+                    if message is not None:
                         self.select_and_handle_msg(message)
-                        msg_buffer = msg_buffer[msg_length:]
-                    else:
-                        if select.select([self.request], [], [], 0.1)[0]:
-                            msg_buffer += self.request.recv(1024)
-                        else:
-                            continue
-                else:
-                    if select.select([self.request], [], [], 0.1)[0]:
-                        msg_buffer += self.request.recv(1024)
-                    else:
                         continue
-                        
-
-        def extract_msg(self, msg_buffer, length):
-            message = msg_buffer[:length].decode()
-            try:
-                right_curly_bracket = message[-6] == "}" or message[-2] == "}"
-            except IndexError:
-                print(message, msg_buffer, length)
-            valid_delimiter = message[-6:] == "}]\r\n\r\n"
-            if right_curly_bracket and valid_delimiter:
-                return message
-            elif right_curly_bracket:
-                raise InvalidMessageDelimiter(message)
-            else:
-                raise MissingMessageDelimiter(message)
-
-        def determine_length_of_json_msg(self, message_bytes):
-            """Incrementally parse a JSON message to extract the length header.
+                    readable = [key.fileobj for key, events in poller.select()]
+                    if self._wakeup_receiver in readable:
+                        self._drain_wakeups()
+                    if self.request in readable:
+                        try:
+                            received = decoder.recv_into(self.request)
+                        except OSError as error:
+                            self.handle_quit(str(error))
+                            return
+                        if not received:
+                            self.handle_quit("Connection closed by client.")
+                            return
+                        if Metrics.enabled:
+                            Metrics.counter("bytes_received").inc(received)
+            except Exception as error:
+                # A bad client must not leave its user behind in the room
+                log.exception("Dropping connection from %s.", 
+                              self.client_address)
+                reason = repr(error)
+            finally:
+                poller.close()
+                self.handle_quit(reason)
 
-            message_bytes: The bytes that represent the portion of the message 
-            recieved.
-            """
-            # All messages must be written in utf-8
-            message = message_bytes.decode('utf-8')
-            # Check that the message we have been given looks like a valid length header
-            if "," not in message:
-                raise InvalidLengthHeader(message)
-            length_portion = message.split(",")[0]
-            left_bracket = length_portion[0] == "["
-            number_before_comma = length_portion[-1] in "1234567890"
-            if left_bracket and number_before_comma:
-                for character in enumerate(length_portion):
-                    if character[1] not in "[ \n\t\r1234567890,":
-                        raise InvalidLengthHeader(length_portion)
-                    elif character[1] in "1234567890":
-                        length_start = character[0]
-                        return int(length_portion[length_start:])
-            elif left_bracket:
-                raise InvalidLengthHeader((length_portion, message))
-            else:
-                raise MissingLengthHeader((length_portion, message))
-            return False
+        def init_connection_state(self):
+            """Set up the per connection state, the send queue and what is 
+            filled in at logon."""
+            self.send_queue = OutboundQueue(self.send_queue_messages,
+                                            self.send_queue_bytes,
+                                            self.slow_consumer_policy)
+            self.user_info = {"username":None, "privileges":dict()}
+            self.server_info = {"protocol":None, "client":None}
+            self.features = frozenset() # Protocol features agreed at logon
+            self.closed = False
+            self.room = None # The PublishSubscribe of the room joined at logon
+            self.output = OutputBuffer() # Messages taken from the send queue
+            self.buckets = {msg_type:TokenBucket(*limit) for msg_type, limit
+                            in self.message_limits.items()}
+            self.verified_admin = False # Gave the admin key at logon
+            self.open_streams = {} # Ids of streams the client may send on
+                                   # mapped to the bytes sent on them so far
 
-        def _calculate_recursive_length(self, json_dict):
-            """Calculate the length of a dictionary represented as JSON once a length
-            field has been added as a key."""
-            delimiter = "\r\n\r\n"
-            initial_length = len(
-                json.dumps(json_dict) + delimiter)
-            initial_list = [initial_length, json_dict]
-            recursive_length = len(
-                json.dumps(initial_list) + delimiter)
-            recursive_list = [recursive_length, json_dict]
-            while len(json.dumps(recursive_list) + delimiter) != recursive_list[0]:
-                recursive_length = len(
-                    json.dumps(recursive_list) + delimiter)
-                recursive_list = [recursive_length, json_dict]
-            return recursive_list[0]
-            
+        def _drain_wakeups(self):
+            """Empty the wakeup socket, the send queue itself is what tells the
+            mainloop how many messages are waiting."""
+            try:
+                while self._wakeup_receiver.recv(4096):
+                    pass
+            except (BlockingIOError, InterruptedError):
+                pass
 
-        def put_msg(self, utf8_message):
-            """Put a message into the connections send queue."""
-            self.send_queue.put(utf8_message)
-            print("Message put in send queue!") #DEBUG
+        def put_msg(self, utf8_message, kind=None):
+            """Put a message of <kind> into the connections send queue and 
+            wake the connection mainloop so that it is sent right away."""
+            if not self.send_queue.put(utf8_message, kind):
+                self.disconnect_slow_consumer()
+            if self.closed:
+                self.abandon_output()
+                return
+            try:
+                self._wakeup_sender.send(b"\0")
+            except (BlockingIOError, OSError):
+                # A wakeup is already pending or the connection is closed
+                pass
 
         def send_msg(self, message):
-            """Send a message that the connection mainloop has in its send queue."""
-            message_tuple = [self._calculate_recursive_length(message), message]
-            json_message = json.dumps(message_tuple) + '\r\n\r\n'
-            print("Sending message!" + repr(json_message), len(json_message.encode('utf-8'))) #DEBUG
-            utf8_message = json_message.encode('utf-8')
-            while utf8_message:
-                try:
-                    sent = self.request.send(utf8_message)
-                except socket.timeout:
-                    self.handle_quit("Timeout occurred.")
-                utf8_message = utf8_message[sent:]
-            print("Message sent!") #DEBUG
+            """Send an encoded message that the connection mainloop took from
+            its send queue, along with a batch of those queued behind it. The
+            messages are written together by the connection's OutputBuffer."""
+            self.fill_output(message)
+            timed = Metrics.enabled
+            if timed:
+                started = time.perf_counter()
+                pending = self.output.pending_bytes
+            try:
+                self.output.write_all(self.request)
+            except OSError as error:
+                for frame in self.output.clear():
+                    frame_sent(frame)
+                self.handle_quit(str(error))
+                return False
+            if timed:
+                Metrics.histogram("send").record(time.perf_counter() - started)
+                Metrics.counter("bytes_sent").inc(pending)
             return True
 
+        def fill_output(self, message=None):
+            """Move <message>, if given, and the messages in the send queue
+            into the output buffer until it holds IOV_MAX messages or
+            output_bytes bytes. The rest stay in the send queue, where they
+            count against its bounds while the client is slow to read."""
+            if message is not None:
+                self.output.append(message)
+            while (len(self.output) < IOV_MAX and 
+                   self.output.pending_bytes < self.output_bytes):
+                message = self.send_queue.get()
+                if message is None:
+                    return
+                self.output.append(message)
+
         def select_and_handle_msg(self, message):
             """
             Generic message handler.
 
             This function takes a text message extracted by the program mainloop
             and further extracts the message dictionary from the list which
-            contains it and the length header. After this has been accomplished
+            contains it and the length header. Attachment frames have their 
+            header decoded and their raw bytes put under the 'attachment' key
+            without being looked at, and binary frames arrive already decoded.
+            After this has been accomplished
             the message dictionary's 'type' key is read to find out which handler
             should be passed this mesasge. The handler to be passed is defined
             as a method of this class with the prefix "handle_" and then the type
             of message appened. For example to handle a 'pubmsg' you would call
-            handle_pubmsg().
+            handle_pubmsg(). Until the client has logged on into a room only
+            the messages in before_logon are handled.
+
+            While the global Metrics are enabled the time taken to decode the
+            message and to handle it are recorded, the latter under the type
+            of the message.
             """
+            timed = Metrics.enabled
+            if timed:
+                started = time.perf_counter()
             try:
-                json_message = json.loads(message)[1] 
+                if isinstance(message, BinaryMessage):
+                    json_message = message.message
+                elif isinstance(message, Attachment):
+                    json_message = json.loads(message.header)
+                    json_message["attachment"] = message.body
+                else:
+                    json_message = json.loads(message)[1] 
             except ValueError:
                 raise JSONDecodeError(message)
             msg_type = json_message["type"]
+            if self.room is None and msg_type not in self.before_logon:
+                return self.send_error(json_message, "You must log on first.")
             handler = getattr(self, "handle_" + msg_type)
-            handler(json_message)
+            if timed:
+                decoded = time.perf_counter()
+                Metrics.histogram("decode").record(decoded - started)
+                handler(json_message)
+                Metrics.histogram("dispatch." + msg_type).record(
+                    time.perf_counter() - decoded)
+            else:
+                handler(json_message)
             return True
 
         def handle_logon(self, message):
@@ -345,40 +1082,330 @@ class MRCStreamHandler(socketserver.BaseRequestHandler):
             The reason why it's named like this is that future extensions and
             variants of this protocol will store information besides client
             info here such as preferences for a chat matchmaking system.
+
+            The client lists the optional protocol features it understands
+            under the server_info key 'features'. The ones the server also
+            supports are enabled for the connection and sent back in the room
+            message so the client knows which it may use.
+
+            The room to join is named under the server_info key 'room', the
+            server's default room is joined if it isn't given. A connection
+            logs on once and stays in the same room until it quits.
+
+            The room message is followed by the room's recent history, or
+            only the part of it since the timestamp given under the 
+            server_info key 'since'.
+
+            The room message carries a resume token. A client reconnecting
+            after losing its connection gives it under the server_info key
+            'resume', along with the sequence number of the last message it
+            saw under 'last_seq'. It then keeps its username, rejoins its 
+            room and is only sent the messages it missed. A token the server
+            doesn't accept is ignored and the logon carries on as normal.
             """
+            if self.room is not None:
+                return self.send_error(message, "You are already logged on.")
+            session = Rooms.check_token(message["server"].get("resume"))
+            if session is not None:
+                room_name = session[1]
+            else:
+                room_name = message["server"].get("room")
+            room = Rooms.join(room_name)
+            if room is None:
+                return self.send_error(message, "No such room.", room=room_name)
             self.user_info.update(message["user"])
             self.server_info.update(message["server"])
-            print("LOGON REACHED!") #DEBUG
-            print(message) #DEBUG
-            print(self.user_info, self.server_info) #DEBUG
-            PubSub.subscribe(self, {"user_info":self.user_info, 
-                                    "server_info":self.server_info})
-            room_msg = self.generate_room_msg()
-            room_msg["username"] = self.user_info["username"]
-            PubSub.put_msg_into_publish_queue((room_msg, self))
+            key = self.server_info.pop("admin_key", None)
+            self.verified_admin = (
+                self.admin_key is not None and isinstance(key, str) and
+                hmac.compare_digest(key.encode('utf-8'),
+                                    self.admin_key.encode('utf-8')))
+            last_seq = None
+            if session is not None:
+                self.user_info["username"] = session[0]
+                last_seq = self.server_info.get("last_seq", 0)
+            self.features = self.supported_features.intersection(
+                self.server_info.get("features", []))
+            if FEATURE_DEFLATE in self.features:
+                self.output.compressor = FrameCompressor(self.compress_threshold)
+            log.debug("%s logged on with %s", self.user_info["username"],
+                      {name:value for name, value in self.server_info.items()
+                       if name != "resume"})
+            self.room = room
+            self.room.join(self, {"user_info":self.user_info, 
+                                  "server_info":self.server_info},
+                           self.server_info.get("since"), last_seq)
+            return True
+
+        def handle_rooms(self, message):
+            """Send the client a list of the rooms on the server. A rooms
+            message is of the form:
+
+            {"type":"rooms",
+             "rooms":<LIST OF DICTIONARIES WITH THE 'name', 'topic' AND 
+                      NUMBER OF 'users' OF EACH ROOM>,
+             "default":<NAME OF THE ROOM JOINED WHEN NONE IS GIVEN>}
+            """
+            rooms = [{"name":room.name, "topic":room.topic,
+                      "users":len(room.recipients)} for room in Rooms.rooms()]
+            self.put_msg(encode_frame({"type":"rooms", "rooms":rooms,
+                                       "default":Rooms.default_room}))
             return True
 
         def handle_pubmsg(self, message):
-            """Handle a public message sent to the single QA room."""
+            """Handle a public message sent to the client's QA room.
+
+            Users must be within their pubmsg rate limit and, if the room has
+            a speaking floor, hold the floor or be able to take it. Messages 
+            that aren't allowed are answered with an error and never reach
+            the room's PubSub, as are messages from muted users and messages
+            whose text isn't a string."""
+            if not isinstance(message.get("msg"), str):
+                return self.send_error(message, "A message's text must be a "
+                                       "string.")
+            if self in self.room.muted:
+                return self.send_error(message, "You have been muted.")
+            if not self.within_limit(message):
+                return False
+            if self.room.floor is not None and not self.is_admin():
+                allowed, retry_after = self.room.floor.speak(self)
+                if not allowed:
+                    return self.send_error(
+                        message, "Somebody else has the floor or you have "
+                        "spoken too recently.", retry_after=round(retry_after, 1))
             message["username"] = self.user_info["username"]
-            PubSub.put_msg_into_publish_queue((message, self))
+            self.room.put_msg_into_publish_queue((message, self))
+            return True
+
+        def handle_mute(self, message):
+            """Handle an administrator muting or unmuting a user. A mute 
+            message is of the form:
+
+            {"type":"mute",
+             "username":<STRING REPRESENTING USERNAME>,
+             "muted":<TRUE TO MUTE THE USER, FALSE TO UNMUTE THEM>}
+
+            On a multi-process server the user may be on another worker, so 
+            nobody is told if there is no such user.
+            """
+            if not self.is_admin():
+                return self.send_error(message, "Only administrators may mute "
+                                       "users.")
+            found = self.room.mute(message["username"], bool(message["muted"]))
+            if found is False:
+                return self.send_error(message, "No such user.",
+                                       username=message["username"])
+            return True
+
+        def handle_typing(self, message):
+            """Handle a keepalive sent while the user is typing, which takes
+            the floor if it's free and keeps it from running out if they
+            already hold it."""
+            if self.room.floor is None or self.is_admin():
+                return True
+            allowed, retry_after = self.room.floor.typing(self)
+            if not allowed:
+                return self.send_error(
+                    message, "Somebody else has the floor or you have spoken "
+                    "too recently.", retry_after=round(retry_after, 1))
             return True
 
         def handle_screenshot(self, screenshot):
-            """Handle a screenshot sent to the administrators of the QA room."""
+            """Handle a screenshot sent to the administrators of the QA room.
+
+            A screenshot from a client without attachment frames is sent as
+            base64 text under 'screenshot', and is decoded here so the room 
+            only ever sees its bytes under 'attachment'. The rate limit is 
+            checked first, so refused screenshots are never decoded."""
+            if not self.within_limit(screenshot):
+                return False
+            if "attachment" not in screenshot:
+                try:
+                    screenshot["attachment"] = base64.b64decode(
+                        screenshot.pop("screenshot"), validate=True)
+                except (KeyError, TypeError, ValueError):
+                    return self.send_error(screenshot, "A screenshot must be "
+                                           "sent as base64 text.")
+            elif not isinstance(screenshot["attachment"], bytes):
+                return self.send_error(screenshot, "A screenshot must be sent"
+                                       " as bytes.")
             screenshot["username"] = self.user_info["username"]
-            PubSub.put_msg_into_publish_queue((screenshot, self))
+            self.room.put_msg_into_publish_queue((screenshot, self))
+            return True
+
+        def handle_screenshot_chunk(self, chunk):
+            """Handle one chunk of a screenshot being streamed to the 
+            administrators of the QA room. 
+
+            The first chunk of a stream counts against the screenshot rate 
+            limit, and the rest of a stream that was refused are dropped. A
+            connection may have at most max_open_streams streams open, and a
+            stream that grows past max_stream_bytes is refused part way 
+            through, the room being told to throw away what it has of it."""
+            stream, seq = chunk.get("stream"), chunk.get("seq")
+            if (type(stream) is not int or type(seq) is not int or 
+                not isinstance(chunk.get("final"), bool) or
+                not isinstance(chunk.get("attachment"), bytes) or
+                len(chunk["attachment"]) > CHUNK_SIZE):
+                return self.send_error(chunk, "A chunk needs an integer stream"
+                                       " and seq, a boolean final and at most "
+                                       + str(CHUNK_SIZE) + " bytes of "
+                                       "attachment.")
+            if seq == 0:
+                if len(self.open_streams) >= self.max_open_streams:
+                    return self.send_error(chunk, "Too many streams are open.",
+                                           stream=stream)
+                if not self.within_limit(chunk, "screenshot"):
+                    return False
+                self.open_streams[stream] = 0
+            elif stream not in self.open_streams:
+                return False
+            self.open_streams[stream] += len(chunk["attachment"])
+            if self.open_streams[stream] > self.max_stream_bytes:
+                del self.open_streams[stream]
+                self.room.put_msg_into_publish_queue(
+                    ({"type":"screenshot_chunk", "stream":stream, "abort":True,
+                      "username":self.user_info["username"]}, self))
+                return self.send_error(chunk, "The screenshot is too large.",
+                                       stream=stream)
+            if chunk["final"]:
+                del self.open_streams[stream]
+            self.room.put_msg_into_publish_queue(
+                ({"type":"screenshot_chunk", "stream":stream, "seq":seq,
+                  "final":chunk["final"], "attachment":chunk["attachment"],
+                  "username":self.user_info["username"]}, self))
+            return True
+
+        def within_limit(self, message, msg_type=None):
+            """Take a token from the rate limit for messages of <msg_type>, by
+            default the type of <message>, and return whether there was one.
+            If there wasn't the client is sent an error saying when to try
+            again, along with the stream <message> was part of if any."""
+            bucket = self.buckets.get(msg_type or message["type"])
+            if bucket is None or self.is_admin() or bucket.take():
+                return True
+            details = {"retry_after":round(bucket.retry_after(), 1)}
+            if "stream" in message:
+                details["stream"] = message["stream"]
+            return self.send_error(message, "You are sending messages too "
+                                   "quickly.", **details)
+
+        def handle_fetch_screenshot(self, fetch):
+            """Handle an administrator fetching a screenshot from the store by
+            the hash it was given in a screenshot_ref message.
+
+            The screenshot is sent straight back from this connection rather
+            than through the room's PubSub, as nobody else needs to see it."""
+            if not self.is_admin():
+                return self.send_error(fetch, "Only administrators may fetch "
+                                       "screenshots.")
+            body = self.room.screenshots.get(fetch["hash"])
+            if body is None:
+                return self.send_error(fetch, "No screenshot with that hash is"
+                                       " stored.", hash=fetch["hash"])
+            screenshot = {"type":"screenshot",
+                          "hash":fetch["hash"],
+                          "attachment":body}
+            self.room.send_screenshot(self, screenshot, dict())
+            return True
+
+        def handle_screenshot_stats(self, message):
+            """Send an administrator statistics about the screenshot store."""
+            if not self.is_admin():
+                return self.send_error(message, "Only administrators may see "
+                                       "screenshot statistics.")
+            self.put_msg(encode_frame({"type":"screenshot_stats",
+                                       "stats":self.room.screenshots.stats()}))
+            return True
+
+        def handle_queue_stats(self, message):
+            """Send an administrator the state of every connection's send 
+            queue, laggiest first, so clients that aren't keeping up can be 
+            spotted."""
+            if not self.is_admin():
+                return self.send_error(message, "Only administrators may see "
+                                       "queue statistics.")
+            queues = []
+            for subscriber in self.room.recipients:
+                stats = subscriber.send_queue.stats()
+                stats["username"] = subscriber.user_info["username"]
+                queues.append(stats)
+            queues.sort(key=lambda stats: (stats["dropped"], 
+                                           stats["queued_bytes"]), reverse=True)
+            self.put_msg(encode_frame({"type":"queue_stats", "queues":queues}))
             return True
 
+        def handle_stats(self, message):
+            """Send an administrator a snapshot of the server's metrics."""
+            if not self.is_admin():
+                return self.send_error(message, "Only administrators may see "
+                                       "server statistics.")
+            self.put_msg(encode_frame({"type":"stats", 
+                                       "metrics":Metrics.snapshot()}))
+            return True
+
+        def is_admin(self):
+            """Return whether the connection may act as an administrator: 
+            mute users, fetch screenshots, see statistics and skip the rate 
+            limits and speaking floor. Privileges are declared by the client
+            itself, so only those that declared admin privileges and gave 
+            the server's admin key may."""
+            return (self.verified_admin and
+                    self.user_info["privileges"].get("type") == "admin")
+
+        def send_error(self, message, reason, **details):
+            """Tell the client that <message> could not be handled because of 
+            <reason>. An error message is of the form:
+
+            {"type":"error",
+             "request":<THE TYPE OF THE MESSAGE THAT FAILED>,
+             "reason":<STRING DESCRIBING WHAT WENT WRONG>}
+
+            with any keyword arguments given added as extra keys."""
+            error = {"type":"error", "request":message["type"], "reason":reason}
+            error.update(details)
+            self.put_msg(encode_frame(error))
+            return False
+
         def handle_entrance(self, message):
             pass
 
         def handle_exit(self, _exit):
             pass
 
+        def handle_roster(self, message):
+            """Send the client the whole roster of its room, see 
+            PublishSubscribe.roster_frame()."""
+            self.put_msg(self.room.roster_frame(), "roster")
+            return True
+
         def handle_quit(self, timout_msg):
             """Handle a connection quitting or timing out."""
+            if self.closed:
+                return
+            self.closed = True
+            if self.room is not None:
+                self.room.unsubscribe(self)
             self.request.close()
+            self.abandon_output()
+
+        def abandon_output(self):
+            """Throw away the messages left in the send queue of a closed 
+            connection, letting any that are tracked know they won't be sent."""
+            for frame in self.send_queue.clear():
+                frame_sent(frame)
+
+        def disconnect_slow_consumer(self):
+            """Cut off a client whose send queue overflowed. The socket is 
+            shut down rather than closed so that the connection's own loop 
+            sees it end and cleans up after it, whichever thread this is 
+            called from."""
+            log.warning("Disconnecting slow consumer %s.", 
+                        self.user_info["username"])
+            try:
+                self.request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             
         def generate_room_msg(self):
             """Generate a room type message and return it.
@@ -386,59 +1413,239 @@ class MRCStreamHandler(socketserver.BaseRequestHandler):
             A room message is of the form:
 
             {"type":"room",
+             "room":<STRING REPRESENTING THE NAME OF THE ROOM>,
              "users":<LIST OF STRINGS REPRESENTING USERNAMES>,
-             "topic":<STRING REPRESENTING THE CURRENT ROOM TOPIC>}
+             "topic":<STRING REPRESENTING THE CURRENT ROOM TOPIC>,
+             "username":<STRING REPRESENTING THE USERNAME LOGGED ON AS>,
+             "server":{"protocol":"QAServ1.0", 
+                       "features":<LIST OF THE FEATURES ENABLED>},
+             "resume":<TOKEN TO RESUME THE SESSION WITH>}
+
+            The room adds the number of messages of history that follow it 
+            and the sequence numbers and roster version, see 
+            PublishSubscribe.join().
             """
-            users = []
-            for subscriber in PubSub.Subscriptions:
-                users.append(
-                    PubSub.Subscriptions[subscriber]["user_info"]["username"])
-            #TODO: Implement topic.
-            topic = "PLACEHOLDER TOPIC"
             return {"type":"room",
-                    "users":users,
-                    "topic":topic}
+                    "room":self.room.name,
+                    "users":list(self.room.roster),
+                    "topic":self.room.topic,
+                    "username":self.user_info["username"],
+                    "server":{"protocol":"QAServ1.0",
+                              "features":sorted(self.features)},
+                    "resume":Rooms.issue_token(self.user_info["username"],
+                                               self.room.name)}
         
-class StreamError(Exception):
-    """Errors related to handling MRC streams."""
-    pass
-
-class LengthHeaderError(StreamError):
-    """Abstract length header error class."""
-    def __init__(self, length_portion="Portion not given"):
-        self.length_portion = length_portion
-    def __str__(self):
-        return repr(self.length_portion)
-
-class MissingLengthHeader(LengthHeaderError):
-    """Error raised when a length header appears to be missing."""
-    pass
-
-class InvalidLengthHeader(LengthHeaderError):
-    """Error raised when a length header appears to be present but
-    garbled."""
-    pass
-
-class MessageDelimiterError(LengthHeaderError):
-    """Abstract message delimiter error class."""
-    pass
-
-class MissingMessageDelimiter(MessageDelimiterError):
-    """Error raised when a message delimiter appears to be missing."""
-    pass
-
-class InvalidMessageDelimiter(MessageDelimiterError):
-    """Error raised when a message delimiter appears to be present but
-    garbled."""
-    pass
-
-class JSONDecodeError(Exception):
-    """Error raised when a json encoded message fails to decode to a valid JSON
-    document."""
-    def __init__(self, invalid_json="JSON not given."):
-        self.invalid_json = invalid_json
-    def __str__(self):
-        return repr(self.invalid_json)
+class EventLoopServer():
+    """Questions and answer server that serves every connection from a single
+    selector loop instead of a thread per connection.
+
+    Each connection is an EventLoopConnection, which uses the same handle_*
+    message handlers as MRCStreamHandler and publishes through the same
+    rooms. The loop only wakes up when a socket is 
+    readable, a connection has output waiting or another thread has put a
+    message into a connections send queue. An idle room costs nothing.
+
+    The public interface mirrors QAServer so that the two engines can be
+    swapped for each other on the command line.
+    """
+    request_queue_size = 1024
+    allow_reuse_port = False
+
+    def __init__(self, server_address, ConnectionHandlerClass):
+        self.server_address = server_address
+        self.ConnectionHandlerClass = ConnectionHandlerClass
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.allow_reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.bind(server_address)
+        self.server_address = self.socket.getsockname()
+        self.socket.listen(self.request_queue_size)
+        self.socket.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ, self._accept)
+        # Other threads (such as PubSub) wake the loop by writing a byte here
+        self._wakeup_receiver, self._wakeup_sender = socket.socketpair()
+        self._wakeup_receiver.setblocking(False)
+        self._wakeup_sender.setblocking(False)
+        self.selector.register(self._wakeup_receiver, selectors.EVENT_READ,
+                               self._handle_wakeup)
+        self._pending_output = set()
+        self._pending_lock = threading.Lock()
+        self._connections = set()
+        self._shutdown_request = False
+        self._is_shut_down = threading.Event()
+
+    def serve_forever(self):
+        """Run the event loop until shutdown() is called."""
+        self._is_shut_down.clear()
+        try:
+            while not self._shutdown_request:
+                for key, mask in self.selector.select():
+                    key.data(key.fileobj, mask)
+        finally:
+            self._shutdown_request = False
+            self._is_shut_down.set()
+
+    def shutdown(self):
+        """Stop the serve_forever() loop and wait for it to exit. Must be called
+        from a different thread than the one running the loop."""
+        self._shutdown_request = True
+        self.wakeup()
+        self._is_shut_down.wait()
+
+    def server_close(self):
+        """Close every connection and the listening socket."""
+        for connection in list(self._connections):
+            connection.handle_quit("Server shutting down.")
+        self.selector.close()
+        self._wakeup_receiver.close()
+        self._wakeup_sender.close()
+        self.socket.close()
+
+    def wakeup(self, connection=None):
+        """Wake up the event loop, marking <connection> as having output to 
+        send if given. Safe to call from any thread."""
+        if connection is not None:
+            with self._pending_lock:
+                self._pending_output.add(connection)
+        try:
+            self._wakeup_sender.send(b"\0")
+        except (BlockingIOError, OSError):
+            # The loop already has a wakeup pending or is shutting down
+            pass
+
+    def want_write(self, connection, wants_write):
+        """Change whether the loop waits for <connection> to become writable."""
+        events = selectors.EVENT_READ
+        if wants_write:
+            events |= selectors.EVENT_WRITE
+        self.selector.modify(connection.request, events, connection.handle_event)
+
+    def remove_connection(self, connection):
+        """Stop serving <connection> and close its socket."""
+        if connection in self._connections:
+            self._connections.remove(connection)
+            self.selector.unregister(connection.request)
+        connection.request.close()
+
+    def _accept(self, listening_socket, mask):
+        try:
+            request, client_address = listening_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        request.setblocking(False)
+        connection = self.ConnectionHandlerClass(request, client_address, self)
+        self._connections.add(connection)
+        self.selector.register(request, selectors.EVENT_READ, 
+                               connection.handle_event)
+
+    def _handle_wakeup(self, wakeup_receiver, mask):
+        try:
+            while wakeup_receiver.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        with self._pending_lock:
+            pending = self._pending_output
+            self._pending_output = set()
+        for connection in pending:
+            if connection in self._connections:
+                self.want_write(connection, True)
+
+class EventLoopConnection(MRCStreamHandler):
+        """Handles a single MRC connection on behalf of an EventLoopServer.
+
+        Message handling is inherited from MRCStreamHandler, only the way 
+        bytes get to and from the socket differs. Instead of running its own
+        mainloop the connection is driven by handle_event() whenever its socket
+        is ready, and everything it does must avoid blocking.
+        """
+        def __init__(self, request, client_address, server):
+            # BaseRequestHandler.__init__ runs handle() which would block the
+            # event loop, so the attributes it sets are set here instead.
+            self.request = request
+            self.client_address = client_address
+            self.server = server
+            self.init_connection_state()
+            self.decoder = FrameDecoder(self.read_size, self.max_frame_size)
+
+        def handle_event(self, request, mask):
+            """Called by the event loop when the connection's socket is ready."""
+            if mask & selectors.EVENT_READ:
+                self.handle_readable()
+            if mask & selectors.EVENT_WRITE and not self.closed:
+                self.handle_writable()
+
+        def handle_readable(self):
+            """Read what is available from the socket and handle every complete
+            message that has arrived."""
+            try:
+                received = self.decoder.recv_into(self.request)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as error:
+                self.handle_quit(str(error))
+                return
+            if not received:
+                self.handle_quit("Connection closed by client.")
+                return
+            if Metrics.enabled:
+                Metrics.counter("bytes_received").inc(received)
+            try:
+                message = self.decoder.next_frame()
+                while message is not None and not self.closed:
+                    self.select_and_handle_msg(message)
+                    message = self.decoder.next_frame()
+            except Exception as error:
+                # A bad client must not be able to take the loop down with it
+                log.exception("Dropping connection from %s.",
+                              self.client_address)
+                self.handle_quit(repr(error))
+
+        def handle_writable(self):
+            """Write as much queued output as the socket will take, a batch 
+            from the send queue at a time."""
+            while True:
+                self.fill_output()
+                if not self.output:
+                    break
+                timed = Metrics.enabled
+                if timed:
+                    started = time.perf_counter()
+                try:
+                    sent = self.output.write_to(self.request)
+                except (BlockingIOError, InterruptedError):
+                    return
+                except OSError as error:
+                    self.handle_quit(str(error))
+                    return
+                if timed:
+                    Metrics.histogram("send").record(time.perf_counter() - started)
+                    Metrics.counter("bytes_sent").inc(sent)
+            self.server.want_write(self, False)
+
+        def put_msg(self, utf8_message, kind=None):
+            """Put a message of <kind> into the connections send queue. Safe 
+            to call from any thread."""
+            if not self.send_queue.put(utf8_message, kind):
+                self.disconnect_slow_consumer()
+            if self.closed:
+                self.abandon_output()
+                return
+            self.server.wakeup(self)
+
+        def handle_quit(self, timout_msg):
+            """Handle a connection quitting or timing out."""
+            if self.closed:
+                return
+            self.closed = True
+            if self.room is not None:
+                self.room.unsubscribe(self)
+            self.server.remove_connection(self)
+            for frame in self.output.clear():
+                frame_sent(frame)
+            self.abandon_output()
 
 class ImproperHandlingError(Exception):
     """Error raised when a message handler has improperly handled a message."""
@@ -449,12 +1656,231 @@ class ImproperHandlingError(Exception):
     def __str__(self):
         return repr((self.error_msg, self.error_cause))
 
+def serve(arguments, bus_path=None, session_secret=None):
+    """Open the rooms and run a server configured by the command line 
+    <arguments> until it is interrupted. <bus_path> is the hub of a 
+    multi-process server this process is a worker of, if it is one, and
+    <session_secret> the secret its workers sign resume tokens with."""
+    screenshot_store = ScreenshotStore(
+        memory_limit=arguments.screenshot_memory * 1024 * 1024,
+        spill_directory=arguments.screenshot_dir,
+        disk_limit=arguments.screenshot_disk * 1024 * 1024)
+    swear_filter = SwearFilter.from_file(arguments.swear_words)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, 
+                      lambda signum, frame: swear_filter.reload())
+    floor_settings = None
+    if not arguments.no_floor:
+        floor_settings = {"lock_seconds":arguments.floor_lock,
+                          "cooldown_seconds":arguments.floor_cooldown,
+                          "max_lines":arguments.floor_lines}
+    history_settings = {"max_messages":arguments.history_messages,
+                        "max_bytes":arguments.history_kilobytes * 1024}
+    topics = dict()
+    for room in arguments.room:
+        name, _, topic = room.partition("=")
+        topics[name] = topic or None
+    journal = None
+    if arguments.journal and bus_path is None:
+        journal = open_journal(arguments)
+    RoomDirectory(topics, arguments.default_room, not arguments.fixed_rooms,
+                  screenshot_store=screenshot_store, swear_filter=swear_filter,
+                  floor_settings=floor_settings, 
+                  history_settings=history_settings, journal=journal,
+                  bus_path=bus_path, session_secret=session_secret)
+
+    HOST, PORT = arguments.host, arguments.port
+    MRCStreamHandler.read_size = arguments.read_size
+    MRCStreamHandler.max_frame_size = arguments.max_frame_size * 1024 * 1024
+    MRCStreamHandler.send_queue_messages = arguments.send_queue_messages
+    MRCStreamHandler.send_queue_bytes = arguments.send_queue_bytes
+    MRCStreamHandler.slow_consumer_policy = arguments.slow_consumer
+    MRCStreamHandler.compress_threshold = arguments.compress_threshold
+    MRCStreamHandler.admin_key = arguments.admin_key
+    MRCStreamHandler.max_stream_bytes = arguments.screenshot_size * 1024 * 1024
+    MRCStreamHandler.message_limits = {
+        "pubmsg":(arguments.pubmsg_rate, arguments.pubmsg_burst),
+        "screenshot":(1 / arguments.screenshot_interval, 1)}
+    
+    if arguments.engine == "eventloop":
+        EventLoopServer.allow_reuse_port = bus_path is not None
+        server = EventLoopServer((HOST, PORT), EventLoopConnection)
+    else:
+        QAServer.allow_reuse_port = bus_path is not None
+        server = QAServer((HOST, PORT), MRCStreamHandler)
+    endpoint = None
+    Metrics.enabled = arguments.metrics or arguments.metrics_socket is not None
+    if arguments.metrics_socket is not None:
+        path = arguments.metrics_socket
+        if bus_path is not None:
+            path += "." + str(os.getpid()) # One socket for each worker
+        endpoint = MetricsEndpoint(path, Metrics).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Keyboard interrupt detected!") #DEBUG
+        server.shutdown()
+        server.server_close()
+    finally:
+        if journal is not None:
+            journal.close()
+        if endpoint is not None:
+            endpoint.close()
+
+def open_journal(arguments):
+    """Open the journal configured by the command line <arguments>."""
+    return Journal(arguments.journal,
+                   segment_bytes=arguments.journal_segment * 1024 * 1024,
+                   max_bytes=arguments.journal_size * 1024 * 1024,
+                   max_age=arguments.journal_days * 24 * 60 * 60)
+
+def serve_workers(arguments):
+    """Run a server configured by the command line <arguments> as several
+    worker processes.
+
+    Every worker listens on the same port with SO_REUSEPORT, so the kernel
+    spreads incoming connections between them, and serves its connections
+    and rooms with an engine of its own. This process runs the qa_cluster 
+    Hub that links the workers' rooms together until it is interrupted,
+    and keeps the journal if there is one."""
+    bus_path = arguments.bus or os.path.join(
+        tempfile.gettempdir(), "qa_server-" + str(os.getpid()) + ".bus")
+    journal = None
+    if arguments.journal:
+        journal = open_journal(arguments)
+    hub = Hub(bus_path, journal, PublishSubscribe.history_kinds)
+    hub_thread = threading.Thread(target=hub.serve_forever, name="hub")
+    hub_thread.daemon = True
+    hub_thread.start()
+    session_secret = os.urandom(32)
+    workers = [multiprocessing.Process(target=serve, 
+                                       args=(arguments, bus_path, session_secret),
+                                       name="worker " + str(number))
+               for number in range(arguments.workers)]
+    for worker in workers:
+        worker.start()
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: 
+                      [os.kill(worker.pid, signal.SIGHUP) for worker in workers])
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        print("Keyboard interrupt detected!") #DEBUG
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+        hub.close()
+        if journal is not None:
+            journal.close()
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", default="localhost", 
                         help="The hostname to serve on.")
     parser.add_argument("-p", "--port", default=9665, type=int, 
                         help="The port number on which to allow access.")
+    parser.add_argument("--engine", default="threads", 
+                        choices=["threads", "eventloop"],
+                        help="Serve each connection from its own thread or "
+                        "every connection from a single event loop.")
+    parser.add_argument("--read-size", default=DEFAULT_READ_SIZE, type=int,
+                        help="How many bytes to read from a connection at a "
+                        "time.")
+    parser.add_argument("--max-frame-size", 
+                        default=DEFAULT_MAX_FRAME_SIZE // (1024 * 1024), 
+                        type=int, help="Longest message in megabytes a client"
+                        " may send, clients sending longer ones are "
+                        "disconnected.")
+    parser.add_argument("--swear-words", 
+                        default=os.path.join(os.path.dirname(
+                            os.path.abspath(__file__)), 
+                            "swear_word_list", "swear_word_list.json"),
+                        help="JSON list of words to censor in public messages. "
+                        "The list is reloaded on SIGHUP.")
+    parser.add_argument("--room", action="append", default=[],
+                        metavar="NAME[=TOPIC]",
+                        help="Open a room when the server starts. May be given"
+                        " more than once.")
+    parser.add_argument("--default-room", default="main",
+                        help="The room joined by clients that don't name one.")
+    parser.add_argument("--fixed-rooms", action="store_true",
+                        help="Only allow the rooms given on the command line "
+                        "instead of opening any room a client names.")
+    parser.add_argument("--admin-key", default=os.environ.get("QA_ADMIN_KEY"),
+                        help="Key administrators give at logon to mute users,"
+                        " fetch screenshots, see statistics and be exempt "
+                        "from rate limits and the speaking floor, by default "
+                        "the QA_ADMIN_KEY environment variable. Without one "
+                        "nobody may.")
+    parser.add_argument("--pubmsg-rate", default=1.0, type=float,
+                        help="Public messages a user may send per second.")
+    parser.add_argument("--pubmsg-burst", default=5, type=int,
+                        help="Public messages a user may send at once.")
+    parser.add_argument("--screenshot-interval", default=10.0, type=float,
+                        help="Seconds a user must wait between screenshots.")
+    parser.add_argument("--floor-lock", default=3.0, type=float,
+                        help="Seconds a user holds the floor after typing or "
+                        "speaking.")
+    parser.add_argument("--floor-cooldown", default=30.0, type=float,
+                        help="Seconds a user must wait to take the floor again.")
+    parser.add_argument("--floor-lines", default=3, type=int,
+                        help="Lines a user may speak each time they hold the "
+                        "floor.")
+    parser.add_argument("--no-floor", action="store_true",
+                        help="Let users speak without holding the floor.")
+    parser.add_argument("--history-messages", default=200, type=int,
+                        help="Public messages each room keeps to replay to "
+                        "users that join. 0 turns the history off.")
+    parser.add_argument("--history-kilobytes", default=1024, type=int,
+                        help="Kilobytes of messages each room keeps to replay.")
+    parser.add_argument("--journal", default=None, metavar="DIRECTORY",
+                        help="Keep a journal of public messages on disk in "
+                        "DIRECTORY and restore the rooms' history from it at"
+                        " startup.")
+    parser.add_argument("--journal-segment", default=64, type=int,
+                        help="Megabytes of journal in each segment file.")
+    parser.add_argument("--journal-size", default=1024, type=int,
+                        help="Megabytes of journal to keep.")
+    parser.add_argument("--journal-days", default=7.0, type=float,
+                        help="Days to keep journal segments for.")
+    parser.add_argument("--send-queue-messages", default=10000, type=int,
+                        help="Messages that may wait to be sent to a client.")
+    parser.add_argument("--send-queue-bytes", default=16 * 1024 * 1024, 
+                        type=int, help="Bytes that may wait to be sent to a "
+                        "client.")
+    parser.add_argument("--slow-consumer", default="drop_oldest",
+                        choices=OutboundQueue.POLICIES,
+                        help="What to do when a client falls so far behind its"
+                        " send queue fills up.")
+    parser.add_argument("--compress-threshold", default=COMPRESS_THRESHOLD,
+                        type=int, help="Smallest message in bytes compressed "
+                        "for clients that asked for compression.")
+    parser.add_argument("--screenshot-memory", default=64, type=int,
+                        help="Megabytes of screenshots to keep in memory.")
+    parser.add_argument("--screenshot-dir", default=None,
+                        help="Directory to spill screenshots that don't fit in"
+                        " memory to. Without one they are dropped.")
+    parser.add_argument("--screenshot-disk", default=1024, type=int,
+                        help="Megabytes of screenshots to keep on disk.")
+    parser.add_argument("--screenshot-size", default=16, type=int,
+                        help="Largest screenshot in megabytes a client may "
+                        "stream.")
+    parser.add_argument("--workers", default=1, type=int,
+                        help="Worker processes to serve connections from, all"
+                        " sharing the port and linked by a message bus.")
+    parser.add_argument("--bus", default=None,
+                        help="Path of the Unix socket linking the workers. "
+                        "Defaults to one in the temporary directory.")
+    parser.add_argument("--metrics", action="store_true",
+                        help="Keep counters and latency histograms of the "
+                        "server's work for the admin 'stats' message.")
+    parser.add_argument("--metrics-socket", default=None, metavar="PATH",
+                        help="Serve the metrics as plain text on a Unix socket"
+                        " at this path, one for each worker with its process "
+                        "id added. Implies --metrics.")
     #TODO: Add 'debug' argument that profiles code and let's you know which 
     # portions were called during a program run.
     # One way to do this as a general process might be to find a way to do it and
@@ -462,18 +1888,11 @@ if __name__ == '__main__':
     # debugger to get a stack trace, then using the python debugger from within
     # python should let you get a stack trace.
     arguments = parser.parse_args()
+    if arguments.workers > 1 and not arguments.no_floor:
+        parser.error("--workers needs --no-floor, the workers can't share a "
+                     "speaking floor.")
 
-    PubSubThread = threading.Thread(target=PublishSubscribe)
-    PubSubThread.daemon = True
-    PubSubThread.start()
-
-    HOST, PORT = arguments.host, arguments.port
-    
-    server = QAServer((HOST, PORT), MRCStreamHandler)
-    try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        print("Keyboard interrupt detected!") #DEBUG
-        server.shutdown()
-        server.server_close()
-        quit()
+    if arguments.workers > 1:
+        serve_workers(arguments)
+    else:
+        serve(arguments)
@@ -0,0 +1,179 @@
+# Storage for the screenshots and recent messages of the QA server
+import os
+import hashlib
+import threading
+import collections
+
+class ScreenshotStore():
+    """Keeps screenshots in memory keyed by the SHA256 hash of their contents.
+
+    Admins are sent a small reference to each screenshot rather than the
+    screenshot itself, and fetch the body from the store when they want to
+    look at it. Because screenshots are stored by their hash the same image
+    uploaded twice is only kept once.
+
+    Memory use is bounded by <memory_limit> bytes. When it is exceeded the
+    least recently used screenshots are evicted, either spilled to files in
+    <spill_directory> if one is given or dropped. Spilled screenshots are
+    bounded in the same way by <disk_limit> bytes and read back into memory
+    when they are fetched again.
+
+    The store is shared between the PubSub thread, which puts screenshots in
+    it, and the connection threads that fetch from it, so every method takes
+    the store's lock.
+    """
+    def __init__(self, memory_limit=64 * 1024 * 1024, spill_directory=None,
+                 disk_limit=1024 * 1024 * 1024):
+        self.memory_limit = memory_limit
+        self.spill_directory = spill_directory
+        self.disk_limit = disk_limit
+        if spill_directory:
+            os.makedirs(spill_directory, exist_ok=True)
+        self._memory = collections.OrderedDict() # digest -> bytes, oldest first
+        self._memory_bytes = 0
+        self._disk = collections.OrderedDict() # digest -> size, oldest first
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+
+    def put(self, screenshot):
+        """Store the bytes <screenshot> and return the hex digest it can be
+        fetched by."""
+        digest = hashlib.sha256(screenshot).hexdigest()
+        with self._lock:
+            self._counters["puts"] += 1
+            if digest in self._memory:
+                self._counters["duplicates"] += 1
+                self._memory.move_to_end(digest)
+                return digest
+            if digest in self._disk:
+                self._counters["duplicates"] += 1
+                self._remove_spilled(digest)
+            self._memory[digest] = bytes(screenshot)
+            self._memory_bytes += len(screenshot)
+            self._evict()
+        return digest
+
+    def get(self, digest):
+        """Return the screenshot stored under <digest>, or None if the store
+        doesn't have it (any more)."""
+        with self._lock:
+            if digest in self._memory:
+                self._counters["hits"] += 1
+                self._memory.move_to_end(digest)
+                return self._memory[digest]
+            if digest in self._disk:
+                self._counters["hits"] += 1
+                self._counters["disk_reads"] += 1
+                with open(self._spill_path(digest), "rb") as spill_file:
+                    screenshot = spill_file.read()
+                self._remove_spilled(digest)
+                self._memory[digest] = screenshot
+                self._memory_bytes += len(screenshot)
+                self._evict()
+                return screenshot
+            self._counters["misses"] += 1
+            return None
+
+    def __contains__(self, digest):
+        with self._lock:
+            return digest in self._memory or digest in self._disk
+
+    def stats(self):
+        """Return a dictionary of statistics about the store, suitable for
+        sending to a client as part of a message."""
+        with self._lock:
+            stats = {"memory_entries":len(self._memory),
+                     "memory_bytes":self._memory_bytes,
+                     "memory_limit":self.memory_limit,
+                     "disk_entries":len(self._disk),
+                     "disk_bytes":self._disk_bytes}
+            for counter in ("puts", "duplicates", "hits", "misses",
+                            "disk_reads", "evictions", "spills"):
+                stats[counter] = self._counters[counter]
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def _evict(self):
+        """Evict the least recently used screenshots until memory use is back
+        under the limit. The most recent screenshot is always kept."""
+        while self._memory_bytes > self.memory_limit and len(self._memory) > 1:
+            digest, screenshot = self._memory.popitem(last=False)
+            self._memory_bytes -= len(screenshot)
+            self._counters["evictions"] += 1
+            if self.spill_directory and len(screenshot) <= self.disk_limit:
+                self._spill(digest, screenshot)
+
+    def _spill(self, digest, screenshot):
+        with open(self._spill_path(digest), "wb") as spill_file:
+            spill_file.write(screenshot)
+        self._disk[digest] = len(screenshot)
+        self._disk_bytes += len(screenshot)
+        self._counters["spills"] += 1
+        while self._disk_bytes > self.disk_limit:
+            self._remove_spilled(next(iter(self._disk)))
+
+    def _remove_spilled(self, digest):
+        self._disk_bytes -= self._disk.pop(digest)
+        try:
+            os.remove(self._spill_path(digest))
+        except OSError:
+            pass
+
+    def _spill_path(self, digest):
+        return os.path.join(self.spill_directory, digest)
+
+class MessageHistory():
+    """The most recent messages sent to a room, kept encoded for the wire so
+    they can be replayed to a client that joins late.
+
+    At most <max_messages> messages and <max_bytes> bytes of them are kept,
+    the oldest are forgotten first. Each message is kept along with its 
+    timestamp and the room's sequence number for it, so a client can ask for
+    only the messages since a point in time or after the last message it 
+    saw. The history belongs to a single room and is used with the room's
+    lock held, so it is not locked itself.
+    """
+    def __init__(self, max_messages=200, max_bytes=1024 * 1024):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self._entries = collections.deque() # (seq, timestamp, frame), oldest first
+        self._bytes = 0
+        self.forgotten_seq = 0 # The newest sequence number no longer kept
+
+    def append(self, timestamp, frame, seq=0):
+        """Remember the encoded message <frame> sent at <timestamp> with the
+        sequence number <seq>."""
+        if len(frame) > self.max_bytes or not self.max_messages:
+            self.forgotten_seq = max(self.forgotten_seq, seq)
+            return
+        self._entries.append((seq, timestamp, frame))
+        self._bytes += len(frame)
+        while len(self._entries) > self.max_messages or self._bytes > self.max_bytes:
+            forgotten = self._entries.popleft()
+            self._bytes -= len(forgotten[2])
+            self.forgotten_seq = max(self.forgotten_seq, forgotten[0])
+
+    def since(self, timestamp=None):
+        """Return a list of the messages sent at or after <timestamp>, oldest
+        first, or of every message if it is None."""
+        if timestamp is None:
+            return [entry[2] for entry in self._entries]
+        return [entry[2] for entry in self._entries if entry[1] >= timestamp]
+
+    def after(self, seq):
+        """Return a list of the messages numbered after <seq>, oldest first."""
+        return [entry[2] for entry in self._entries if entry[0] > seq]
+
+    def complete_after(self, seq):
+        """Return whether after(<seq>) holds every message numbered after 
+        <seq>, none having been forgotten yet."""
+        return self.forgotten_seq <= seq
+
+    def forget_through(self, seq):
+        """Record that messages numbered up to <seq> may be missing."""
+        self.forgotten_seq = max(self.forgotten_seq, seq)
+
+    def __len__(self):
+        return len(self._entries)
@@ -10,10 +10,10 @@ import argparse
 
 
 class QuestionAnswerSystemClient(QWidget):
-    def __init__(self, hostname="localhost"):
+    def __init__(self, hostname="localhost", room=None):
         self.logic = QAClientLogic()
         self.logic.connect(hostname=hostname)
-        self.logic.logon()
+        self.logic.logon(room)
         self.config = self.read_config(self.logic.confpath)
         QWidget.__init__(self)
         self.setWindowTitle("Makerspace QA System")
@@ -25,6 +25,8 @@ class QuestionAnswerSystemClient(QWidget):
         self.control_panel = QHBoxLayout()
         self.chat_bar = QLineEdit(self)
         self.chat_bar.returnPressed.connect(self.send_msg_to_room)
+        self.chat_bar.textEdited.connect(self.send_typing)
+        self.last_typing = 0
         # Create the room info widgets
         self.discussion_topic = QLabel("Placeholder Topic", self)
         self.discussion_topic.setFrameStyle(QFrame.StyledPanel | QFrame.Sunken)
@@ -73,10 +75,9 @@ class QuestionAnswerSystemClient(QWidget):
         sender and the time the message was sent.
         """
         try:
-            raw_msg = self.logic.get_msg()
+            wrapped_msg = self.logic.get_msg()
         except queue.Empty:
             return False
-        wrapped_msg = json.loads(raw_msg)
         update = wrapped_msg[1]["type"]
         update_method = getattr(self, "update_on_" + update)
         update_method(wrapped_msg)
@@ -98,14 +99,29 @@ class QuestionAnswerSystemClient(QWidget):
         the following form:
 
         {"type":"room",
+         "room":<STRING REPRESENTING THE NAME OF THE ROOM>,
          "users":<LIST OF STRINGS REPRESENTING USERNAMES>,
-         "topic":<STRING REPRESENTING THE CURRENT ROOM TOPIC>}
+         "topic":<STRING REPRESENTING THE CURRENT ROOM TOPIC>,
+         "roster":<VERSION OF THE LIST OF USERS>}
          """
         message = wrapped_msg[1]
-        for user in message["users"]:
-            self.user_list_dict[user] = QLabel(user, self)
-            self.user_list.addWidget(self.user_list_dict[user], alignment=Qt.AlignTop)
+        self.set_users(message["users"])
         self.discussion_topic = QLabel(message["topic"], self)
+        if "room" in message:
+            self.room_address.setText("Host: " + self.logic.host + 
+                                      "  Room: " + message["room"])
+        return True
+
+    def update_on_roster(self, wrapped_msg):
+        """Replace the user list with the whole roster of the room, sent when
+        the client found it had missed an entrance or exit. Roster messages
+        are of the following form:
+
+        {"type":"roster",
+         "roster":<VERSION OF THE LIST OF USERS>,
+         "users":<LIST OF STRINGS REPRESENTING USERNAMES>}
+        """
+        self.set_users(wrapped_msg[1]["users"])
         return True
 
     def update_on_entrance(self, wrapped_msg):
@@ -114,13 +130,66 @@ class QuestionAnswerSystemClient(QWidget):
 
         {"type":"entrance",
          "username":<STRING REPRESENTING USERNAME>,
+         "roster":<VERSION OF THE LIST OF USERS AFTER THE ENTRANCE>,
          "timestamp":<UNIX TIMESTAMP>}
         """
-        entrance = wrapped_msg[1]
-        
+        self.add_user(wrapped_msg[1]["username"])
+        return True
 
     def update_on_exit(self, wrapped_msg):
-        pass
+        """Update the display when a user leaves the room. Exit messages are of
+        the same form as entrance messages."""
+        self.remove_user(wrapped_msg[1]["username"])
+        return True
+
+    def set_users(self, usernames):
+        for user in list(self.user_list_dict):
+            self.remove_user(user)
+        for user in usernames:
+            self.add_user(user)
+
+    def add_user(self, user):
+        if user in self.user_list_dict:
+            return
+        self.user_list_dict[user] = QLabel(user, self)
+        self.user_list.addWidget(self.user_list_dict[user], alignment=Qt.AlignTop)
+
+    def remove_user(self, user):
+        label = self.user_list_dict.pop(user, None)
+        if label is not None:
+            self.user_list.removeWidget(label)
+            label.deleteLater()
+
+    def update_on_error(self, wrapped_msg):
+        """Show the user why the server refused one of their messages. Error
+        messages are of the following form:
+
+        {"type":"error",
+         "request":<THE TYPE OF THE MESSAGE THAT WAS REFUSED>,
+         "reason":<STRING DESCRIBING WHY>}
+
+        and may say how many seconds to wait under 'retry_after'."""
+        error = wrapped_msg[1]
+        error_text = "* " + error["reason"]
+        if "retry_after" in error:
+            error_text += " Try again in " + str(error["retry_after"]) + "s."
+        self.append_text(error_text, self.discussion_view_cursor)
+        return True
+
+    def update_on_missed(self, wrapped_msg):
+        """Let the user know the server threw away messages for them because
+        they weren't being read quickly enough."""
+        missed = wrapped_msg[1]
+        self.append_text("* " + str(missed["count"]) + " messages were missed.",
+                         self.discussion_view_cursor)
+        return True
+
+    @Slot(str)
+    def send_typing(self, text):
+        """Let the server know the user is typing, at most once a second."""
+        if time.time() - self.last_typing >= 1:
+            self.last_typing = time.time()
+            self.logic.typing()
 
     @Slot(str, result=bool) 
     def send_msg_to_room(self):
@@ -162,8 +231,11 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", default="localhost", 
                         help="The host to connect to.")
+    parser.add_argument("--room", default=None,
+                        help="The room to join, by default the one in the "
+                        "config file or the server's default room.")
     arguments = parser.parse_args()
     qt_app = QApplication(sys.argv)
-    qa_client = QuestionAnswerSystemClient(arguments.host)
+    qa_client = QuestionAnswerSystemClient(arguments.host, arguments.room)
     qa_client.show_and_raise()
     sys.exit(qt_app.exec_())
@@ -44,6 +44,18 @@ if __name__ == '__main__':
                         help="The hostname to serve on.")
     parser.add_argument("-p", "--port", default=9665, type=int, 
                         help="The port number on which to allow access.")
+    parser.add_argument("--engine", default="threads", 
+                        choices=["threads", "eventloop"],
+                        help="Serve each connection from its own thread or "
+                        "every connection from a single event loop.")
+    parser.add_argument("--read-size", default=DEFAULT_READ_SIZE, type=int,
+                        help="How many bytes to read from a connection at a "
+                        "time.")
+    parser.add_argument("--swear-words", 
+                        default=os.path.join(os.path.dirname(
+                            os.path.abspath(__file__)), 
+                            "swear_word_list", "swear_word_list.json"),
+                        help="JSON list of words to censor in public messages.")
     #TODO: Add 'debug' argument that profiles code and let's you know which 
     # portions were called during a program run.
     # One way to do this as a general process might be to find a way to do it and
@@ -53,13 +65,16 @@ if __name__ == '__main__':
 
     arguments = parser.parse_args()
 
-    PubSubThread = threading.Thread(target=PublishSubscribe)
-    PubSubThread.daemon = True
-    PubSubThread.start()
+    swear_filter = SwearFilter.from_file(arguments.swear_words)
+    RoomDirectory(swear_filter=swear_filter)
     
     HOST, PORT = arguments.host, arguments.port
+    MRCStreamHandler.read_size = arguments.read_size
     
-    server = QAServer((HOST, PORT), MRCStreamHandler)
+    if arguments.engine == "eventloop":
+        server = EventLoopServer((HOST, PORT), EventLoopConnection)
+    else:
+        server = QAServer((HOST, PORT), MRCStreamHandler)
     
     sthread = ServerThread()
     sthread.start()
@@ -0,0 +1,47 @@
+import os
+import json
+import base64
+from qa_common import (FrameDecoder, Attachment, encode_frame, encode_message,
+                       attachment_to_base64)
+from clients import logon, receive, receive_frame
+
+def test_attachment_round_trip_between_messages():
+    body = os.urandom(300000)
+    wire = (encode_frame({"type":"pubmsg", "msg":"before"}) +
+            encode_message({"type":"screenshot", "attachment":body}) +
+            encode_frame({"type":"pubmsg", "msg":"after"}))
+    decoder = FrameDecoder(read_size=4096)
+    messages = []
+    for offset in range(0, len(wire), 4096):
+        decoder.feed(wire[offset:offset + 4096])
+        message = decoder.next_frame()
+        while message is not None:
+            messages.append(message)
+            message = decoder.next_frame()
+    assert json.loads(messages[0])[1]["msg"] == "before"
+    assert isinstance(messages[1], Attachment)
+    assert json.loads(messages[1].header) == {"type":"screenshot"}
+    assert messages[1].body == body
+    assert json.loads(messages[2])[1]["msg"] == "after"
+
+def test_attachment_to_base64():
+    legacy = attachment_to_base64({"type":"screenshot", "attachment":b"\x00\xff"},
+                                  "screenshot")
+    assert legacy == {"type":"screenshot", "screenshot":"AP8="}
+
+def test_screenshot_reaches_binary_and_legacy_admins(server):
+    binary_admin = logon(server, "binary", "admin", ["attachments"])
+    room = receive(*binary_admin)
+    assert room["server"]["features"] == ["attachments"]
+    legacy_admin = logon(server, "legacy", "admin", [])
+    assert receive(*legacy_admin)["server"]["features"] == []
+    student = logon(server, "student", "user", ["attachments"])
+    receive(*student)
+    body = os.urandom(100000)
+    student[0].sendall(encode_message({"type":"screenshot", "attachment":body}))
+    screenshot = receive_frame(*binary_admin)
+    assert isinstance(screenshot, Attachment)
+    assert screenshot.body == body
+    assert json.loads(screenshot.header)["username"] == "student"
+    legacy = receive(*legacy_admin)
+    assert base64.b64decode(legacy["screenshot"]) == body
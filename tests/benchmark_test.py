@@ -0,0 +1,34 @@
+import os
+import json
+import importlib.util
+
+spec = importlib.util.spec_from_file_location(
+    "benchmark_run", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  "..", "benchmarks", "run.py"))
+benchmark_run = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(benchmark_run)
+
+def test_compare_finds_cases_over_the_threshold():
+    baseline = {"fast":1.0, "slow":1.0}
+    scores = {"fast":1.2, "slow":1.3, "new":5.0}
+    assert benchmark_run.compare(scores, baseline, 25) == ["slow"]
+    assert benchmark_run.compare(scores, baseline, 50) == []
+
+def test_run_stores_a_baseline_then_checks_against_it(tmp_path, capsys):
+    baseline = str(tmp_path / "baseline.json")
+    arguments = ["--baseline", baseline, "--filter", "frame_length[100]",
+                 "--retries", "0"]
+    assert benchmark_run.main(arguments) == 0
+    with open(baseline) as baseline_file:
+        stored = json.load(baseline_file)
+    assert list(stored["scores"]) == ["frame_length[100]"]
+    assert "Stored the results" in capsys.readouterr().out
+    stored["scores"]["frame_length[100]"] *= 1000
+    with open(baseline, "w") as baseline_file:
+        json.dump(stored, baseline_file)
+    assert benchmark_run.main(arguments) == 0
+    stored["scores"]["frame_length[100]"] /= 1e6
+    with open(baseline, "w") as baseline_file:
+        json.dump(stored, baseline_file)
+    assert benchmark_run.main(arguments) == 1
+    assert "REGRESSION" in capsys.readouterr().out
@@ -0,0 +1,39 @@
+import os
+import json
+from qa_censor import SwearFilter
+from pubsub_test import FakeConnection, start_pubsub, decode
+
+WORD_LIST = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                         "swear_word_list", "swear_word_list.json")
+
+def test_words_are_masked_on_word_boundaries():
+    swear_filter = SwearFilter(["darn\n", "heck\n", "heckin\n"])
+    assert swear_filter.censor("Darn it, what the HECK") == "**** it, what the ****"
+    assert swear_filter.censor("heckin' darned heckler") == "******' darned heckler"
+    assert swear_filter.censor("darn_it darn-it") == "darn_it ****-it"
+    assert swear_filter.censor("nothing to see") == "nothing to see"
+
+def test_overlapping_words_are_all_found():
+    swear_filter = SwearFilter(["he", "she", "hers", "his"])
+    assert swear_filter.censor("ushers she his he") == "ushers *** *** **"
+
+def test_shipped_word_list_loads_and_reloads(tmp_path):
+    swear_filter = SwearFilter.from_file(WORD_LIST)
+    assert len(swear_filter) == len(json.load(open(WORD_LIST)))
+    assert swear_filter.censor("you bastardo") == "you ********"
+    path = tmp_path / "words.json"
+    path.write_text(json.dumps(["gosh\n"]))
+    swear_filter = SwearFilter.from_file(str(path))
+    assert swear_filter.censor("oh gosh") == "oh ****"
+    path.write_text(json.dumps(["golly\n"]))
+    swear_filter.reload()
+    assert swear_filter.censor("oh gosh golly") == "oh gosh *****"
+
+def test_pubmsg_is_censored_before_publishing():
+    pubsub = start_pubsub()
+    pubsub.swear_filter = SwearFilter(["darn"])
+    connection = FakeConnection("student")
+    pubsub.subscribe(connection, connection.logon_info())
+    pubsub.put_msg_into_publish_queue(
+        ({"type":"pubmsg", "msg":"darn", "username":"student"}, connection))
+    assert decode(connection.received.get(timeout=5))["msg"] == "****"
@@ -0,0 +1,40 @@
+"""Clients for the tests that talk to a server over loopback. The servers
+themselves are started by the fixtures in conftest.py."""
+import json
+import socket
+import qa_server
+from qa_common import FrameDecoder, encode_frame
+
+def main_room():
+    return qa_server.Rooms.join()
+
+def logon(server, username, privilege="user", features=None, **server_info):
+    """Connect to <server> and log on as <username>, returning the connection
+    and a FrameDecoder for it. <features>, if given, and any other keyword
+    arguments, such as room or since, are sent as part of the server info."""
+    connection = socket.create_connection(server.server_address)
+    connection.settimeout(5)
+    server_info.update({"protocol":"QAServ1.0", "client":"test"})
+    if features is not None:
+        server_info["features"] = features
+    connection.sendall(encode_frame(
+        {"type":"logon",
+         "user":{"username":username, "privileges":{"type":privilege}},
+         "server":server_info}))
+    return connection, FrameDecoder()
+
+def receive(connection, decoder):
+    """Return the next JSON message from <connection>, decoded."""
+    message = decoder.next_frame()
+    while message is None:
+        decoder.feed(connection.recv(65536))
+        message = decoder.next_frame()
+    return json.loads(message)[1]
+
+def receive_frame(connection, decoder):
+    """Return the next frame from <connection> as FrameDecoder gives it."""
+    message = decoder.next_frame()
+    while message is None:
+        decoder.recv_into(connection)
+        message = decoder.next_frame()
+    return message
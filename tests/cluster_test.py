@@ -0,0 +1,147 @@
+import time
+import socket
+import threading
+import pytest
+from qa_server import RoomDirectory, PublishSubscribe
+from qa_cluster import Hub
+from qa_journal import Journal
+from pubsub_test import FakeConnection, decode
+
+def start_cluster(tmp_path, workers=2, journal=None):
+    path = str(tmp_path / "qa.bus")
+    hub = Hub(path, journal, PublishSubscribe.history_kinds)
+    hub_thread = threading.Thread(target=hub.serve_forever)
+    hub_thread.daemon = True
+    hub_thread.start()
+    return hub, [RoomDirectory(bus_path=path) for _ in range(workers)]
+
+def test_workers_see_every_message_in_the_same_order(tmp_path):
+    hub, workers = start_cluster(tmp_path)
+    try:
+        rooms = [worker.join("lab") for worker in workers]
+        connections = [FakeConnection("user" + str(number))
+                       for number in range(len(rooms))]
+        for room, connection in zip(rooms, connections):
+            room.subscribe(connection, connection.logon_info())
+        for number in range(50):
+            for room, connection in zip(rooms, connections):
+                room.put_msg_into_publish_queue(
+                    ({"type":"pubmsg", "msg":str(number),
+                      "username":connection.user_info["username"]}, connection))
+        received = [[decode(connection.received.get(timeout=5))
+                     for _ in range(100)] for connection in connections]
+        assert received[0] == received[1]
+        for connection in connections:
+            sent = [message["msg"] for message in received[0]
+                    if message["username"] == connection.user_info["username"]]
+            assert sent == [str(number) for number in range(50)]
+    finally:
+        hub.close()
+
+def test_screenshots_reach_admins_on_every_worker(tmp_path):
+    hub, workers = start_cluster(tmp_path)
+    try:
+        student = FakeConnection("student")
+        admin = FakeConnection("teacher", privilege="admin")
+        workers[0].join().subscribe(student, student.logon_info())
+        workers[1].join().subscribe(admin, admin.logon_info())
+        workers[0].join().put_msg_into_publish_queue(
+            ({"type":"screenshot", "attachment":b"\x00\x01\x02",
+              "username":"student"}, student))
+        screenshot = decode(admin.received.get(timeout=5))
+        assert (screenshot["type"], screenshot["username"]) == \
+            ("screenshot", "student")
+        assert workers[1].screenshots.get(screenshot["hash"]) == b"\x00\x01\x02"
+        assert student.received.empty()
+    finally:
+        hub.close()
+
+def test_mutes_reach_users_on_every_worker(tmp_path):
+    hub, workers = start_cluster(tmp_path)
+    try:
+        student = FakeConnection("student")
+        rooms = [worker.join() for worker in workers]
+        rooms[1].subscribe(student, student.logon_info())
+        assert rooms[0].mute("student", True) is None
+        deadline = time.time() + 5
+        while student not in rooms[1].muted and time.time() < deadline:
+            time.sleep(0.01)
+        assert rooms[1].muted == frozenset([student])
+        assert not rooms[0].muted
+    finally:
+        hub.close()
+
+def test_a_stuck_worker_is_dropped_without_holding_up_the_rest(tmp_path, 
+                                                              monkeypatch):
+    monkeypatch.setattr(Hub, "max_worker_bytes", 256 * 1024)
+    hub, workers = start_cluster(tmp_path)
+    try:
+        stuck = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stuck.connect(hub.path)
+        deadline = time.time() + 5
+        while len(hub._workers) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        speaker = FakeConnection("speaker")
+        listener = FakeConnection("listener")
+        workers[0].join().subscribe(speaker, speaker.logon_info())
+        workers[1].join().subscribe(listener, listener.logon_info())
+        for number in range(100):
+            workers[0].join().put_msg_into_publish_queue(
+                ({"type":"pubmsg", "msg":str(number) * 10000, 
+                  "username":"speaker"}, speaker))
+            message = decode(listener.received.get(timeout=5))["msg"]
+            assert message == str(number) * 10000
+        stuck.settimeout(5)
+        while stuck.recv(1024 * 1024):
+            pass
+        assert len(hub._workers) == 2
+    finally:
+        hub.close()
+
+def test_workers_cant_share_a_floor(tmp_path):
+    with pytest.raises(ValueError):
+        RoomDirectory(bus_path=str(tmp_path / "qa.bus"), floor_settings={})
+
+class ResumingConnection(FakeConnection):
+    def generate_room_msg(self):
+        return {"type":"room"}
+
+def test_hub_journal_restores_every_worker(tmp_path):
+    journal = Journal(str(tmp_path / "journal"))
+    hub, workers = start_cluster(tmp_path, journal=journal)
+    try:
+        speaker = FakeConnection("speaker")
+        workers[0].join("lab").subscribe(speaker, speaker.logon_info())
+        for text in ("one", "two"):
+            workers[0].join("lab").put_msg_into_publish_queue(
+                ({"type":"pubmsg", "msg":text, "username":"speaker"}, speaker))
+            speaker.received.get(timeout=5)
+    finally:
+        hub.close()
+        journal.close()
+    journal = Journal(str(tmp_path / "journal"))
+    assert [decode(record.frame)["seq"] for record in journal.read()] == [1, 2]
+    hub, workers = start_cluster(tmp_path, journal=journal)
+    try:
+        room = workers[1].join("lab")
+        assert [decode(frame)["msg"] for frame in room.history.since()] == \
+            ["one", "two"]
+        speaker = ResumingConnection("speaker")
+        room.join(speaker, speaker.logon_info(), last_seq=1)
+        assert decode(speaker.received.get(timeout=5))["resumed"]
+        room.put_msg_into_publish_queue(
+            ({"type":"pubmsg", "msg":"three", "username":"speaker"}, speaker))
+        assert decode(speaker.received.get(timeout=5))["msg"] == "two"
+        assert decode(speaker.received.get(timeout=5))["seq"] == 3
+    finally:
+        hub.close()
+        journal.close()
+
+def test_rooms_that_missed_messages_dont_claim_to_resume():
+    room = PublishSubscribe()
+    room.broadcast({"type":"pubmsg", "msg":"late", "username":"a",
+                    "timestamp":0}, seq=10)
+    for last_seq, resumed in ((5, False), (9, True), (12, False)):
+        connection = ResumingConnection("user" + str(last_seq))
+        room.join(connection, connection.logon_info(), last_seq=last_seq)
+        assert decode(connection.received.get(timeout=5))["resumed"] is resumed
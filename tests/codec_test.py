@@ -0,0 +1,39 @@
+import json
+import pytest
+import qa_codec
+from qa_common import (FrameDecoder, BinaryMessage, encode_binary_frame,
+                       encode_frame, BinaryFrameError, FrameCompressor)
+
+def test_values_round_trip():
+    message = {"type":"pubmsg", "msg":"héllo" * 100, "seq":2 ** 40,
+               "timestamp":1700000000, "negative":-5, "ratio":0.25,
+               "muted":False, "admin":True, "topic":None, "users":["a", "b"],
+               "nested":{"empty":[], "deep":[{"x":1}]}, "attachment":b"\x00\xff"}
+    assert qa_codec.loads(qa_codec.dumps(message)) == message
+
+def test_binary_frames_are_smaller_and_decode_side_by_side():
+    message = {"type":"pubmsg", "msg":"hi", "username":"student",
+               "timestamp":1700000000, "seq":12}
+    screenshot = {"type":"screenshot", "attachment":bytes(range(256)) * 40}
+    assert len(encode_binary_frame(message)) < len(encode_frame(message))
+    decoder = FrameDecoder()
+    compressor = FrameCompressor(threshold=100)
+    decoder.feed(encode_binary_frame(message) + encode_frame(message) + 
+                 compressor.compress(encode_binary_frame(screenshot)))
+    binary = decoder.next_frame()
+    assert binary == BinaryMessage(len(encode_binary_frame(message)), message)
+    assert json.loads(decoder.next_frame())[1] == message
+    assert decoder.next_frame().message == screenshot
+
+def test_garbled_binary_frames_are_refused():
+    for body in (b"\x09\x00\x00\x00\x01", b"\x06\x05abc", b"\x63", 
+                 qa_codec.dumps(["not", "a", "message"])):
+        decoder = FrameDecoder()
+        decoder.feed(b"\x02" + len(body).to_bytes(4, "big") + body)
+        with pytest.raises(BinaryFrameError):
+            decoder.next_frame()
+
+def test_unencodable_values():
+    for value in ({1:"numeric key"}, 2 ** 64, object()):
+        with pytest.raises(qa_codec.CodecError):
+            qa_codec.dumps(value)
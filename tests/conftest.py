@@ -0,0 +1,32 @@
+import threading
+import pytest
+from qa_server import (RoomDirectory, QAServer, MRCStreamHandler,
+                       EventLoopServer, EventLoopConnection)
+
+@pytest.fixture
+def start_server():
+    """Return a function that starts a server on loopback in a thread of its
+    own, returning the server and a new RoomDirectory built with the keyword
+    arguments it was given. The event loop engine is used unless <threaded>
+    is set. Every server started is shut down once the test is over."""
+    servers = []
+    def start(threaded=False, **room_options):
+        rooms = RoomDirectory(**room_options)
+        if threaded:
+            server = QAServer(("localhost", 0), MRCStreamHandler)
+        else:
+            server = EventLoopServer(("localhost", 0), EventLoopConnection)
+        servers.append(server)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        return server, rooms
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+@pytest.fixture
+def server(start_server):
+    """An event loop server with the default rooms."""
+    return start_server()[0]
@@ -0,0 +1,30 @@
+import time
+from qa_common import encode_frame
+from clients import main_room, logon, receive
+
+def test_logon_and_pubmsg(server):
+    alice = logon(server, "alice")
+    assert receive(*alice)["type"] == "room"
+    bob = logon(server, "bob")
+    room = receive(*bob)
+    assert sorted(room["users"]) == ["alice", "bob"]
+    alice[0].sendall(encode_frame({"type":"pubmsg", "msg":"hi"}))
+    for client in (alice, bob):
+        pubmsg = receive(*client)
+        assert pubmsg["msg"] == "hi" and pubmsg["username"] == "alice"
+
+def test_oversize_frame_disconnects(server):
+    alice = logon(server, "alice")
+    receive(*alice)
+    alice[0].sendall(b"[99999999999999,")
+    assert alice[0].recv(65536) == b""
+    assert not main_room().Subscriptions
+
+def test_disconnect_unsubscribes(server):
+    alice = logon(server, "alice")
+    receive(*alice)
+    alice[0].close()
+    deadline = time.time() + 5
+    while main_room().Subscriptions and time.time() < deadline:
+        time.sleep(0.01)
+    assert not main_room().Subscriptions
@@ -0,0 +1,222 @@
+import json
+import socket
+import pytest
+from qa_common import (FrameDecoder, encode_frame, frame_length,
+                       encode_attachment_frame, Attachment, OutputBuffer,
+                       DeliveryTracker, TrackedFrame, FrameCompressor,
+                       COMPRESSED_FRAME, CompressedFrameError,
+                       InvalidLengthHeader, MissingLengthHeader,
+                       InvalidMessageDelimiter, FrameTooLarge)
+
+def frame(message):
+    """Wrap <message> in a length header and delimiter the slow way."""
+    body = json.dumps(message)
+    length = len(body) + 9
+    while len(json.dumps([length, message]) + "\r\n\r\n") != length:
+        length = len(json.dumps([length, message]) + "\r\n\r\n")
+    return (json.dumps([length, message]) + "\r\n\r\n").encode('utf-8')
+
+def test_single_frame():
+    decoder = FrameDecoder()
+    wire = frame({"type":"pubmsg", "msg":"hello"})
+    decoder.feed(wire)
+    assert decoder.next_frame() == wire.decode('utf-8')
+    assert decoder.next_frame() is None
+    assert decoder.buffered() == 0
+
+def test_frame_split_across_reads():
+    decoder = FrameDecoder()
+    wire = frame({"type":"pubmsg", "msg":"x" * 5000})
+    for i in range(0, len(wire), 7):
+        assert decoder.next_frame() is None
+        decoder.feed(wire[i:i + 7])
+    assert decoder.next_frame() == wire.decode('utf-8')
+
+def test_several_frames_in_one_read():
+    decoder = FrameDecoder()
+    messages = [frame({"type":"pubmsg", "msg":str(i)}) for i in range(3)]
+    decoder.feed(b"".join(messages))
+    for wire in messages:
+        assert decoder.next_frame() == wire.decode('utf-8')
+    assert decoder.next_frame() is None
+
+def test_missing_length_header():
+    decoder = FrameDecoder()
+    decoder.feed(b'{"type": "pubmsg"}, ')
+    with pytest.raises(MissingLengthHeader):
+        decoder.next_frame()
+
+def test_garbled_length_header():
+    decoder = FrameDecoder()
+    decoder.feed(b"[12a, {}]")
+    with pytest.raises(InvalidLengthHeader):
+        decoder.next_frame()
+
+def test_runaway_length_header():
+    decoder = FrameDecoder()
+    decoder.feed(b"[" + b"1" * 64)
+    with pytest.raises(InvalidLengthHeader):
+        decoder.next_frame()
+
+def test_length_over_the_limit():
+    decoder = FrameDecoder(max_frame_size=1024)
+    decoder.feed(frame({"type":"pubmsg", "msg":"x" * 900}))
+    assert decoder.next_frame() is not None
+    decoder.feed(b"[99999999999999,")
+    with pytest.raises(FrameTooLarge):
+        decoder.next_frame()
+    assert len(decoder._buffer) < 1024 * 1024
+
+def test_bad_delimiter():
+    decoder = FrameDecoder()
+    decoder.feed(b'[18, {"a": 1}]\n\r\n\r')
+    with pytest.raises(InvalidMessageDelimiter):
+        decoder.next_frame()
+
+def test_encode_frame_matches_recursive_length():
+    for size in range(0, 2000):
+        message = {"type":"pubmsg", "msg":"x" * size}
+        assert encode_frame(message) == frame(message)
+
+def test_frame_length_at_digit_boundaries():
+    for body_length in (0, 1, 90, 91, 92, 989, 990, 991, 9988, 9989, 9990):
+        length = frame_length(body_length)
+        assert length == body_length + 8 + len(str(length))
+
+def test_encode_frame_non_ascii():
+    message = {"type":"pubmsg", "msg":"caf\u00e9 \u2603"}
+    wire = encode_frame(message)
+    assert wire == frame(message)
+    decoder = FrameDecoder()
+    decoder.feed(wire)
+    assert json.loads(decoder.next_frame())[1] == message
+
+def test_recv_into_small_reads_across_many_frames():
+    sender, receiver = socket.socketpair()
+    messages = [frame({"type":"pubmsg", "msg":"y" * (i * 37)}) for i in range(50)]
+    sender.sendall(b"".join(messages))
+    sender.close()
+    decoder = FrameDecoder(read_size=100)
+    decoded = []
+    while decoder.recv_into(receiver):
+        message = decoder.next_frame()
+        while message is not None:
+            decoded.append(message)
+            message = decoder.next_frame()
+    receiver.close()
+    assert decoded == [wire.decode('utf-8') for wire in messages]
+    assert decoder.buffered() == 0
+
+def test_large_frame_grows_buffer_once():
+    decoder = FrameDecoder(read_size=1024)
+    wire = frame({"type":"screenshot", "screenshot":"z" * 100000})
+    decoder.feed(wire[:1024])
+    assert decoder.next_frame() is None
+    decoder.feed(wire[1024:])
+    assert decoder.next_frame() == wire.decode('utf-8')
+
+class TrickleSocket:
+    """Takes at most <limit> bytes per call, recording each call."""
+    def __init__(self, limit):
+        self.limit = limit
+        self.calls = []
+        self.data = b""
+
+    def sendmsg(self, buffers):
+        self.calls.append(len(buffers))
+        data = b"".join(bytes(buffer) for buffer in buffers)[:self.limit]
+        self.data += data
+        return len(data)
+
+    def send(self, buffer):
+        return self.sendmsg([buffer])
+
+def test_output_buffer_writes_many_frames_per_call():
+    sent = []
+    output = OutputBuffer()
+    frames = [encode_frame({"type":"pubmsg", "msg":str(number)})
+              for number in range(10)]
+    for frame in frames:
+        output.append(TrackedFrame(frame, DeliveryTracker(1, lambda: sent.append(1))))
+    connection = TrickleSocket(len(frames[0]) * 4 + 3)
+    output.write_all(connection)
+    assert connection.data == b"".join(frames)
+    assert connection.calls == [10, 6, 2]
+    assert len(sent) == 10 and output.pending_bytes == 0
+
+def test_output_buffer_over_a_socket():
+    sender, receiver = socket.socketpair()
+    output = OutputBuffer()
+    frames = [encode_frame({"type":"pubmsg", "msg":"x" * number})
+              for number in range(0, 2000, 100)]
+    for frame in frames:
+        output.append(frame)
+    output.write_all(sender)
+    decoder = FrameDecoder()
+    received = []
+    while len(received) < len(frames):
+        decoder.recv_into(receiver)
+        message = decoder.next_frame()
+        while message is not None:
+            received.append(message.encode('utf-8'))
+            message = decoder.next_frame()
+    assert received == frames
+    sender.close()
+    receiver.close()
+
+def test_compressed_frames_share_one_deflate_stream():
+    compressor = FrameCompressor(threshold=100)
+    room = encode_frame({"type":"room", "users":["user" + str(number) 
+                                                 for number in range(50)]})
+    small = encode_frame({"type":"typing"})
+    attachment = encode_attachment_frame({"type":"screenshot"}, b"\x00" * 500)
+    wire = [compressor.compress(frame) for frame in (room, small, room, attachment)]
+    assert wire[1] is small
+    assert wire[0][0] == wire[2][0] == wire[3][0] == COMPRESSED_FRAME
+    assert len(wire[2]) < len(wire[0]) < len(room)
+    decoder = FrameDecoder(read_size=64)
+    for byte in range(len(b"".join(wire))):
+        decoder.feed(b"".join(wire)[byte:byte + 1])
+    decoded = []
+    message = decoder.next_frame()
+    while message is not None:
+        decoded.append(message)
+        message = decoder.next_frame()
+    assert decoded[:3] == [room.decode('utf-8'), small.decode('utf-8'),
+                           room.decode('utf-8')]
+    assert decoded[3] == Attachment('{"type": "screenshot"}', b"\x00" * 500)
+
+def test_compressed_frames_stay_tracked():
+    sent = []
+    output = OutputBuffer()
+    output.compressor = FrameCompressor(threshold=0)
+    output.append(TrackedFrame(encode_frame({"type":"pubmsg"}),
+                               DeliveryTracker(1, lambda: sent.append(1))))
+    output.write_all(TrickleSocket(5))
+    assert sent == [1]
+
+def test_corrupt_compressed_frame():
+    decoder = FrameDecoder()
+    decoder.feed(bytes([COMPRESSED_FRAME, 0, 0, 0, 4]) + b"\xff\xff\xff\xff")
+    with pytest.raises(CompressedFrameError):
+        decoder.next_frame()
+
+def test_prefixes_over_the_limit():
+    for prefix in (bytes([0x01]) + (16).to_bytes(4, "big") + 
+                   (2 ** 32 - 1).to_bytes(4, "big"),
+                   bytes([0x02]) + (2 ** 32 - 1).to_bytes(4, "big"),
+                   bytes([COMPRESSED_FRAME]) + (2 ** 20).to_bytes(4, "big")):
+        decoder = FrameDecoder(max_frame_size=1024)
+        decoder.feed(prefix)
+        with pytest.raises(FrameTooLarge):
+            decoder.next_frame()
+        assert len(decoder._buffer) < 1024 * 1024
+
+def test_compressed_frame_inflating_over_the_limit():
+    wire = FrameCompressor(threshold=0).compress(
+        encode_frame({"type":"pubmsg", "msg":"x" * 100000}))
+    decoder = FrameDecoder(max_frame_size=1024)
+    decoder.feed(wire)
+    assert len(wire) < 1024
+    with pytest.raises(FrameTooLarge):
+        decoder.next_frame()
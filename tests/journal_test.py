@@ -0,0 +1,62 @@
+import os
+from qa_journal import Journal
+from qa_server import RoomDirectory
+from qa_common import encode_frame
+from pubsub_test import FakeConnection, decode
+
+def frame(number):
+    return encode_frame({"type":"pubmsg", "msg":str(number)})
+
+def test_records_are_read_back_from_any_point(tmp_path):
+    journal = Journal(str(tmp_path), index_interval=100)
+    for number in range(1, 201):
+        assert journal.append("lab", float(number), frame(number)) == number
+    assert journal.sync(timeout=5)
+    assert journal.last_seq() == 200
+    records = journal.read(150, limit=3)
+    assert [record.seq for record in records] == [150, 151, 152]
+    assert (records[0].room, records[0].timestamp) == ("lab", 150.0)
+    assert decode(records[0].frame)["msg"] == "150"
+    assert [record.seq for record in journal.tail(2)] == [199, 200]
+    journal.close()
+
+def test_segments_roll_and_expire(tmp_path):
+    journal = Journal(str(tmp_path), segment_bytes=1000, max_bytes=3000)
+    for number in range(1, 301):
+        journal.append("lab", 0.0, frame(number))
+        if number % 10 == 0:
+            journal.sync(timeout=5)
+    journal.close()
+    segments = [name for name in os.listdir(tmp_path) if name.endswith(".log")]
+    assert 2 <= len(segments) <= 4
+    records = Journal(str(tmp_path)).read()
+    assert records[-1].seq == 300 and records[0].seq > 1
+    assert [record.seq for record in records] == \
+        list(range(records[0].seq, 301))
+
+def test_torn_record_is_dropped_on_reopen(tmp_path):
+    journal = Journal(str(tmp_path))
+    for number in range(1, 4):
+        journal.append("lab", 0.0, frame(number))
+    journal.close()
+    with open(os.path.join(str(tmp_path), "%020d.log" % 1), "ab") as segment_file:
+        segment_file.write(b"\x00\x01\x02 half a record")
+    journal = Journal(str(tmp_path))
+    assert journal.last_seq() == 3
+    assert journal.append("lab", 0.0, frame(4)) == 4
+    journal.sync(timeout=5)
+    assert [record.seq for record in journal.read()] == [1, 2, 3, 4]
+    journal.close()
+
+def test_history_survives_a_restart(tmp_path):
+    journal = Journal(str(tmp_path))
+    rooms = RoomDirectory(journal=journal)
+    speaker = FakeConnection("speaker")
+    rooms.join("lab").subscribe(speaker, speaker.logon_info())
+    rooms.join("lab").put_msg_into_publish_queue(
+        ({"type":"pubmsg", "msg":"remember me", "username":"speaker"}, speaker))
+    speaker.received.get(timeout=5)
+    journal.close()
+    restarted = RoomDirectory(journal=Journal(str(tmp_path)))
+    history = restarted.join("lab").history.since()
+    assert [decode(message)["msg"] for message in history] == ["remember me"]
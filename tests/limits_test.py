@@ -0,0 +1,230 @@
+import time
+import logging
+import types
+import threading
+import qa_server
+from qa_limits import TokenBucket, SpeakingFloor, OutboundQueue
+from qa_common import encode_frame, OutputBuffer, IOV_MAX
+from clients import logon, receive, main_room
+from pubsub_test import decode
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def test_token_bucket_allows_bursts_then_refills():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, burst=3, clock=clock)
+    assert [bucket.take() for _ in range(4)] == [True, True, True, False]
+    assert bucket.retry_after() == 0.5
+    clock.now += 0.5
+    assert bucket.take() and not bucket.take()
+    clock.now += 100
+    assert [bucket.take() for _ in range(4)] == [True, True, True, False]
+
+def test_floor_is_held_for_three_lines_then_cools_down():
+    clock = FakeClock()
+    floor = SpeakingFloor(lock_seconds=3, cooldown_seconds=30, max_lines=3,
+                          clock=clock)
+    assert floor.typing("alice") == (True, 0.0)
+    assert floor.speak("bob") == (False, 3.0)
+    assert floor.speak("alice")[0] and floor.speak("alice")[0]
+    assert floor.speak("alice")[0]
+    assert floor.holder() is None
+    assert floor.speak("alice") == (False, 30.0)
+    assert floor.speak("bob")[0]
+
+def test_floor_expires_unless_kept_alive_by_typing():
+    clock = FakeClock()
+    floor = SpeakingFloor(lock_seconds=3, cooldown_seconds=30, clock=clock)
+    assert floor.speak("alice")[0]
+    clock.now += 2
+    assert floor.typing("alice")[0]
+    clock.now += 2
+    assert floor.holder() == "alice"
+    clock.now += 2
+    assert floor.holder() is None
+    assert floor.typing("alice") == (False, 29.0)
+    floor.forget("alice")
+    assert floor.typing("alice")[0]
+
+def test_flooding_is_refused_before_reaching_pubsub(server, monkeypatch, capsys,
+                                                   caplog):
+    caplog.set_level(logging.DEBUG, "qa_server")
+    monkeypatch.setattr(qa_server.MRCStreamHandler, "message_limits",
+                        {"pubmsg":(0.001, 2)})
+    monkeypatch.setattr(qa_server.MRCStreamHandler, "admin_key", "secret")
+    admin = logon(server, "admin", "admin", admin_key="secret")
+    receive(*admin)
+    student = logon(server, "student")
+    receive(*student)
+    for number in range(5):
+        student[0].sendall(encode_frame({"type":"pubmsg", "msg":str(number)}))
+    for number in range(5):
+        admin[0].sendall(encode_frame({"type":"pubmsg", "msg":str(number)}))
+    received = [receive(*student) for _ in range(10)]
+    pubmsgs = [message["msg"] for message in received
+               if message["type"] == "pubmsg" and
+               message["username"] == "student"]
+    errors = [message for message in received if message["type"] == "error"]
+    assert pubmsgs == ["0", "1"]
+    assert len(errors) == 3
+    assert errors[0]["request"] == "pubmsg" and errors[0]["retry_after"] > 0
+    assert "secret" not in capsys.readouterr().out
+    assert "logged on" in caplog.text and "secret" not in caplog.text
+
+def test_refused_screenshots_are_not_decoded(server, monkeypatch):
+    monkeypatch.setattr(qa_server.MRCStreamHandler, "message_limits",
+                        {"screenshot":(0.001, 1)})
+    decoded = []
+    b64decode = qa_server.base64.b64decode
+    monkeypatch.setattr(qa_server.base64, "b64decode", 
+                        lambda *args, **kwargs: decoded.append(args) or 
+                        b64decode(*args, **kwargs))
+    student = logon(server, "student")
+    receive(*student)
+    for _ in range(3):
+        student[0].sendall(encode_frame({"type":"screenshot", 
+                                         "screenshot":"AP8=" * 1000}))
+    errors = [receive(*student) for _ in range(2)]
+    assert [error["request"] for error in errors] == ["screenshot"] * 2
+    assert len(decoded) == 1
+
+def test_self_declared_admins_are_limited(server, monkeypatch):
+    monkeypatch.setattr(qa_server.MRCStreamHandler, "message_limits",
+                        {"pubmsg":(0.001, 2)})
+    monkeypatch.setattr(qa_server.MRCStreamHandler, "admin_key", "secret")
+    for room, privilege, key in (("a", "admin", None), 
+                                 ("b", "admin", "guess"), 
+                                 ("c", "user", "secret")):
+        flooder = logon(server, "flooder", privilege, room=room,
+                        admin_key=key)
+        receive(*flooder)
+        for number in range(3):
+            flooder[0].sendall(encode_frame({"type":"pubmsg", 
+                                             "msg":str(number)}))
+        replies = [receive(*flooder) for _ in range(3)]
+        assert sorted(reply["type"] for reply in replies) == \
+            ["error", "pubmsg", "pubmsg"]
+        flooder[0].close()
+
+def test_self_declared_admins_may_not_act_as_admins(server, monkeypatch):
+    monkeypatch.setattr(qa_server.MRCStreamHandler, "admin_key", "secret")
+    teacher = logon(server, "teacher", "admin", admin_key="secret")
+    receive(*teacher)
+    impostor = logon(server, "impostor", "admin")
+    receive(*impostor)
+    requests = [{"type":"mute", "username":"teacher", "muted":True},
+                {"type":"stats"},
+                {"type":"queue_stats"},
+                {"type":"screenshot_stats"},
+                {"type":"fetch_screenshot", "hash":"0" * 64}]
+    for request in requests:
+        impostor[0].sendall(encode_frame(request))
+        error = receive(*impostor)
+        assert (error["type"], error["request"]) == ("error", request["type"])
+        assert error["reason"].startswith("Only administrators")
+    teacher[0].sendall(encode_frame({"type":"pubmsg", "msg":"still here"}))
+    assert receive(*teacher)["msg"] == "still here"
+    teacher[0].sendall(encode_frame({"type":"queue_stats"}))
+    assert receive(*teacher)["type"] == "queue_stats"
+
+def test_users_without_the_floor_are_refused(server):
+    main_room().floor = SpeakingFloor()
+    alice = logon(server, "alice")
+    receive(*alice)
+    bob = logon(server, "bob")
+    receive(*bob)
+    alice[0].sendall(encode_frame({"type":"typing"}))
+    alice[0].sendall(encode_frame({"type":"pubmsg", "msg":"question"}))
+    assert receive(*alice)["msg"] == "question"
+    bob[0].sendall(encode_frame({"type":"pubmsg", "msg":"interrupting"}))
+    # Alice's message may still be on its way to bob when he is refused
+    messages = [receive(*bob), receive(*bob)]
+    assert sorted(message["type"] for message in messages) == \
+        ["error", "pubmsg"]
+
+def test_outbound_queue_drops_oldest_chat_first():
+    outbound = OutboundQueue(max_messages=3, max_bytes=1000)
+    outbound.put(b"credit", "credit")
+    for number in range(4):
+        outbound.put(str(number).encode(), "pubmsg")
+    assert [outbound.get() for _ in range(4)] == [b"credit", b"2", b"3", None]
+    assert (outbound.dropped, outbound.overflows) == (2, 2)
+
+def test_outbound_queue_coalesces_drops_and_bounds_bytes():
+    outbound = OutboundQueue(max_bytes=10, policy="coalesce")
+    for number in range(5):
+        outbound.put(b"12345", "pubmsg")
+    missed = decode(outbound.get())
+    assert missed == {"type":"missed", "count":3}
+    assert outbound.stats()["queued_bytes"] == 10
+    assert outbound.stats()["dropped_bytes"] == 15
+
+def test_outbound_queue_drops_past_what_it_must_keep():
+    outbound = OutboundQueue(max_messages=5001, policy="coalesce")
+    for _ in range(5000):
+        outbound.put(b"c", "credit")
+    started = time.perf_counter()
+    for number in range(5000):
+        outbound.put(str(number).encode(), "pubmsg")
+    assert time.perf_counter() - started < 1
+    assert (len(outbound), outbound.dropped) == (5001, 5000)
+    assert len(outbound._entries) < 2 * 5001 + 64
+    frames = [outbound.get() for _ in range(5001)]
+    assert frames[:5000] == [b"c"] * 5000
+    assert decode(frames[5000]) == {"type":"missed", "count":5000}
+    outbound.put(b"after", "pubmsg")
+    assert outbound.get() == b"after"
+    assert outbound.get() is None and len(outbound) == 0
+
+def test_outbound_queue_asks_for_disconnect():
+    outbound = OutboundQueue(max_messages=1, policy="disconnect")
+    assert outbound.put(b"a", "pubmsg")
+    assert not outbound.put(b"b", "pubmsg")
+    assert outbound.clear() == [b"a", b"b"]
+
+def test_frozen_client_is_disconnected(server):
+    frozen = logon(server, "frozen")
+    receive(*frozen)
+    sender = logon(server, "sender")
+    receive(*sender)
+    assert len(main_room().Subscriptions) == 2
+    for connection in main_room().Subscriptions:
+        if connection.user_info["username"] == "frozen":
+            connection.send_queue = OutboundQueue(max_bytes=100000, 
+                                                  policy="disconnect")
+    drain = threading.Thread(target=lambda: receive_forever(sender[0]))
+    drain.daemon = True
+    drain.start()
+    message = encode_frame({"type":"pubmsg", "msg":"x" * 60000})
+    deadline = time.time() + 10
+    while len(main_room().Subscriptions) == 2 and time.time() < deadline:
+        sender[0].sendall(message)
+    assert len(main_room().Subscriptions) == 1
+
+def test_output_buffer_takes_a_bounded_batch():
+    connection = types.SimpleNamespace(output=OutputBuffer(),
+                                       send_queue=OutboundQueue(),
+                                       output_bytes=32 * 1024)
+    for _ in range(100):
+        connection.send_queue.put(b"x" * 10000, "pubmsg")
+    qa_server.MRCStreamHandler.fill_output(connection)
+    assert len(connection.output) == 4
+    assert connection.send_queue.stats()["queued_messages"] == 96
+    connection.output = OutputBuffer()
+    connection.send_queue = OutboundQueue()
+    for _ in range(2000):
+        connection.send_queue.put(b"x", "pubmsg")
+    qa_server.MRCStreamHandler.fill_output(connection)
+    assert len(connection.output) == IOV_MAX
+
+def receive_forever(connection):
+    try:
+        while connection.recv(65536):
+            pass
+    except OSError:
+        pass
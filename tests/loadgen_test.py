@@ -0,0 +1,15 @@
+import qa_loadgen
+
+def test_load_is_delivered_and_timed(server):
+    settings = qa_loadgen.parse_arguments(
+        ["--clients", "6", "--senders", "1", "--admins", "2", "--rate", "20",
+         "--screenshot-rate", "5", "--screenshot-size", "2000",
+         "--duration", "0.5", "--drain", "0.5", "--processes", "2",
+         "--features", "attachments"])
+    report = qa_loadgen.run_load(settings, server.server_address)
+    assert report["logged_on"] == 6 and not report["errors"]
+    assert report["sent"]["pubmsg"] >= 5 and report["sent"]["screenshot"] >= 1
+    assert report["delivered"] == report["expected"]
+    assert report["latency"]["pubmsg"]["count"] == report["delivered"]["pubmsg"]
+    assert 0 < report["latency"]["pubmsg"]["p50_ms"] <= \
+        report["latency"]["pubmsg"]["p999_ms"]
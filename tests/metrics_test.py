@@ -0,0 +1,68 @@
+import socket
+import qa_server
+from qa_metrics import MetricsRegistry, MetricsEndpoint, Metrics
+from qa_common import encode_frame
+from clients import logon, receive
+
+def test_snapshot_and_text_of_a_registry():
+    registry = MetricsRegistry(enabled=True)
+    registry.counter("bytes_received").inc(100)
+    registry.counter("bytes_received").inc(20)
+    registry.histogram("decode").record(0.002)
+    registry.gauge("connections", lambda: 3)
+    registry.gauge("broken", lambda: 1 / 0)
+    snapshot = registry.snapshot()
+    assert snapshot["counters"] == {"bytes_received":120}
+    assert snapshot["gauges"] == {"broken":None, "connections":3}
+    assert snapshot["histograms"]["decode"]["count"] == 1
+    lines = registry.render_text().splitlines()
+    assert "bytes_received 120" in lines
+    assert "connections 3" in lines
+    assert "decode_count 1" in lines
+    registry.reset()
+    assert registry.snapshot()["counters"] == {}
+    assert registry.snapshot()["gauges"]["connections"] == 3
+
+def test_endpoint_serves_the_metrics_as_text(tmp_path):
+    registry = MetricsRegistry()
+    registry.counter("bytes_sent").inc(7)
+    endpoint = MetricsEndpoint(str(tmp_path / "metrics"), registry).start()
+    try:
+        reader = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        reader.settimeout(5)
+        reader.connect(endpoint.path)
+        text = b""
+        data = reader.recv(4096)
+        while data:
+            text += data
+            data = reader.recv(4096)
+        reader.close()
+        assert text.decode('utf-8') == registry.render_text()
+    finally:
+        endpoint.close()
+
+def test_stats_message_is_for_admins_only(server, monkeypatch):
+    monkeypatch.setattr(qa_server.MRCStreamHandler, "admin_key", "secret")
+    Metrics.enabled = True
+    try:
+        student = logon(server, "student", "user", [])
+        receive(*student)
+        teacher = logon(server, "teacher", "admin", [], admin_key="secret")
+        receive(*teacher)
+        student[0].sendall(encode_frame({"type":"pubmsg", "msg":"hello"}))
+        assert receive(*student)["msg"] == "hello"
+        assert receive(*teacher)["msg"] == "hello"
+        student[0].sendall(encode_frame({"type":"stats"}))
+        assert receive(*student)["type"] == "error"
+        teacher[0].sendall(encode_frame({"type":"stats"}))
+        stats = receive(*teacher)["metrics"]
+        assert stats["gauges"]["connections"] == 2
+        assert stats["gauges"]["room.main.subscribers"] == 2
+        assert stats["counters"]["bytes_received"] > 0
+        assert stats["counters"]["bytes_sent"] > 0
+        for name in ("decode", "dispatch.pubmsg", "filter.pubmsg", "fanout",
+                     "send"):
+            assert stats["histograms"][name]["count"] > 0
+    finally:
+        Metrics.enabled = False
+        Metrics.reset()
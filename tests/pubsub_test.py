@@ -0,0 +1,83 @@
+import json
+import queue
+from qa_server import PublishSubscribe
+from qa_common import FrameDecoder
+
+class FakeConnection:
+    """Stands in for an MRCStreamHandler, collecting what PubSub sends it."""
+    def __init__(self, username, privilege="user"):
+        self.received = queue.Queue()
+        self.user_info = {"username":username, "privileges":{"type":privilege}}
+        self.features = frozenset()
+
+    def put_msg(self, utf8_message, kind=None):
+        self.received.put(utf8_message)
+
+    def logon_info(self):
+        return {"user_info":self.user_info, "server_info":{}}
+
+def start_pubsub():
+    return PublishSubscribe().start()
+
+def decode(utf8_message):
+    decoder = FrameDecoder()
+    decoder.feed(utf8_message)
+    return json.loads(decoder.next_frame())[1]
+
+def test_pubmsg_is_encoded_once_for_all_recipients():
+    pubsub = start_pubsub()
+    connections = [FakeConnection("user" + str(i)) for i in range(5)]
+    for connection in connections:
+        pubsub.subscribe(connection, connection.logon_info())
+    pubsub.put_msg_into_publish_queue(
+        ({"type":"pubmsg", "msg":"hello", "username":"user0"}, connections[0]))
+    received = [connection.received.get(timeout=5) for connection in connections]
+    assert all(message is received[0] for message in received)
+    assert decode(received[0])["msg"] == "hello"
+
+def test_pubmsg_is_encoded_once_per_codec():
+    pubsub = start_pubsub()
+    connections = [FakeConnection("user" + str(i)) for i in range(4)]
+    for connection in connections[2:]:
+        connection.features = frozenset(["binary"])
+    for connection in connections:
+        pubsub.subscribe(connection, connection.logon_info())
+    pubsub.put_msg_into_publish_queue(
+        ({"type":"pubmsg", "msg":"hello", "username":"user0"}, connections[0]))
+    received = [connection.received.get(timeout=5) for connection in connections]
+    assert received[0] is received[1] and received[2] is received[3]
+    decoder = FrameDecoder()
+    decoder.feed(received[2])
+    assert decoder.next_frame().message == decode(received[0])
+
+def test_screenshot_only_reaches_admins():
+    pubsub = start_pubsub()
+    user = FakeConnection("student")
+    admin = FakeConnection("teacher", privilege="admin")
+    for connection in (user, admin):
+        pubsub.subscribe(connection, connection.logon_info())
+    pubsub.put_msg_into_publish_queue(
+        ({"type":"screenshot", "attachment":b"", "username":"student"}, user))
+    assert decode(admin.received.get(timeout=5))["type"] == "screenshot"
+    assert user.received.empty()
+
+def test_indexes_follow_subscriptions_and_privileges():
+    pubsub = start_pubsub()
+    user = FakeConnection("student")
+    admin = FakeConnection("teacher", privilege="admin")
+    for connection in (user, admin):
+        pubsub.subscribe(connection, connection.logon_info())
+    recipients = pubsub.recipients
+    assert recipients == (user, admin)
+    assert pubsub.admins == frozenset([admin]) and not pubsub.muted
+    assert pubsub.set_privilege(user, "muted", True)
+    assert pubsub.muted == frozenset([user])
+    pubsub.put_msg_into_publish_queue(
+        ({"type":"pubmsg", "msg":"muted", "username":"student"}, user))
+    pubsub.put_msg_into_publish_queue(
+        ({"type":"pubmsg", "msg":"heard", "username":"teacher"}, admin))
+    assert decode(user.received.get(timeout=5))["msg"] == "heard"
+    pubsub.unsubscribe(user)
+    assert pubsub.recipients == (admin,) and not pubsub.muted
+    assert recipients == (user, admin) # Snapshots are never changed in place
+    assert not pubsub.set_privilege(user, "muted", False)
@@ -0,0 +1,226 @@
+import time
+import socket
+import threading
+import qa_server
+from qa_store import MessageHistory
+from qa_censor import SwearFilter
+from qa_client import QAClientLogic
+from qa_common import encode_frame
+from clients import logon, receive
+
+def test_rooms_are_isolated_from_each_other(start_server):
+    server, rooms = start_server(topics={"section-a":"Lab A"})
+    alice = logon(server, "alice", room="section-a")
+    room = receive(*alice)
+    assert (room["room"], room["topic"]) == ("section-a", "Lab A")
+    bob = logon(server, "bob", room="section-b")
+    assert receive(*bob)["room"] == "section-b"
+    carol = logon(server, "carol")
+    assert receive(*carol)["room"] == "main"
+    # Hold up section-a's PubSub, section-b must carry on regardless
+    blocked = threading.Event()
+    section_a = rooms.join("section-a")
+    filter_pubmsg = section_a.filter_pubmsg
+    section_a.filter_pubmsg = lambda *args: (blocked.wait(5),
+                                             filter_pubmsg(*args))[1]
+    alice[0].sendall(encode_frame({"type":"pubmsg", "msg":"from a"}))
+    bob[0].sendall(encode_frame({"type":"pubmsg", "msg":"from b"}))
+    assert receive(*bob)["msg"] == "from b"
+    blocked.set()
+    assert receive(*alice)["msg"] == "from a"
+    carol[0].sendall(encode_frame({"type":"rooms"}))
+    listing = receive(*carol)
+    assert {room["name"]:room["users"] for room in listing["rooms"]} == \
+        {"main":1, "section-a":1, "section-b":1}
+
+def test_fixed_rooms_refuse_unknown_names(start_server):
+    server, rooms = start_server(topics={"lab":None}, open_rooms=False)
+    stranger = logon(server, "stranger", room="elsewhere")
+    error = receive(*stranger)
+    assert (error["type"], error["room"]) == ("error", "elsewhere")
+    stranger[0].sendall(encode_frame({"type":"pubmsg", "msg":"hello?"}))
+    assert receive(*stranger)["reason"] == "You must log on first."
+    student = logon(server, "student", room="lab")
+    assert receive(*student)["room"] == "lab"
+    assert [room.name for room in qa_server.Rooms.rooms()] == ["lab", "main"]
+
+def test_history_is_replayed_after_the_room_message(start_server):
+    server, rooms = start_server(history_settings={"max_messages":3})
+    alice = logon(server, "alice")
+    receive(*alice)
+    for number in range(5):
+        alice[0].sendall(encode_frame({"type":"pubmsg", "msg":str(number)}))
+    for number in range(5):
+        latest = receive(*alice)
+    latecomer = logon(server, "latecomer")
+    room = receive(*latecomer)
+    assert (room["type"], room["history"]) == ("room", 3)
+    assert [receive(*latecomer)["msg"] for _ in range(3)] == ["2", "3", "4"]
+    alice[0].sendall(encode_frame({"type":"pubmsg", "msg":"live"}))
+    assert receive(*latecomer)["msg"] == "live"
+    caught_up = logon(server, "caught_up", since=latest["timestamp"] + 1)
+    assert receive(*caught_up)["history"] == 0
+
+def test_history_is_bounded_by_bytes():
+    history = MessageHistory(max_messages=100, max_bytes=10)
+    for number in range(5):
+        history.append(number, b"1234")
+    assert history.since() == [b"1234", b"1234"]
+    assert history.since(4) == [b"1234"]
+    history.append(5, b"x" * 11)
+    assert len(history) == 2
+
+def test_sessions_resume_with_only_the_missed_messages(start_server):
+    server, rooms = start_server(topics={"lab":None})
+    alice = logon(server, "alice", room="lab")
+    receive(*alice)
+    bob = logon(server, "bob", room="lab")
+    token = receive(*bob)["resume"]
+    alice[0].sendall(encode_frame({"type":"pubmsg", "msg":"seen"}))
+    last_seq = receive(*bob)["seq"]
+    bob[0].close()
+    for text in ("missed", "also missed"):
+        alice[0].sendall(encode_frame({"type":"pubmsg", "msg":text}))
+    assert [receive(*alice)["seq"] for _ in range(3)] == \
+        [last_seq, last_seq + 1, last_seq + 2]
+    bob = logon(server, "someone else", resume=token, last_seq=last_seq)
+    room = receive(*bob)
+    assert (room["username"], room["room"]) == ("bob", "lab")
+    assert (room["resumed"], room["history"]) == (True, 2)
+    assert [receive(*bob)["msg"] for _ in range(2)] == ["missed", "also missed"]
+    forger = logon(server, "mallory", resume=token + "0", last_seq=last_seq)
+    room = receive(*forger)
+    assert (room["username"], room["room"]) == ("mallory", "main")
+    assert (room["resumed"], room["history"]) == (False, 0)
+
+def test_client_reconnects_and_resumes(start_server, tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    server, rooms = start_server()
+    logic = QAClientLogic()
+    assert logic.connect(*server.server_address)
+    logic.logon()
+    room = logic.pubmsg_queue.get(timeout=5)[1]
+    username = room["username"]
+    alice = logon(server, "alice")
+    receive(*alice)
+    entrance = logic.pubmsg_queue.get(timeout=5)[1]
+    assert (entrance["type"], entrance["username"]) == ("entrance", "alice")
+    alice[0].sendall(encode_frame({"type":"pubmsg", "msg":"before"}))
+    assert logic.pubmsg_queue.get(timeout=5)[1]["msg"] == "before"
+    logic.connection.shutdown(socket.SHUT_RDWR)
+    assert logic.connection_error.wait(5)
+    deadline = time.time() + 5
+    while len(rooms.join().recipients) > 1 and time.time() < deadline:
+        time.sleep(0.01)
+    alice[0].sendall(encode_frame({"type":"pubmsg", "msg":"during"}))
+    logic.pubmsg("queued while disconnected")
+    assert logic.reconnect()
+    room = logic.pubmsg_queue.get(timeout=5)[1]
+    assert (room["username"], room["resumed"]) == (username, True)
+    messages = [logic.pubmsg_queue.get(timeout=5)[1]["msg"] for _ in range(2)]
+    assert messages == ["during", "queued while disconnected"]
+
+def test_members_get_roster_deltas_and_newcomers_the_roster(start_server):
+    server, rooms = start_server()
+    alice = logon(server, "alice", features=["roster"])
+    room = receive(*alice)
+    assert (room["users"], room["roster"]) == (["alice"], 1)
+    bob = logon(server, "bob")
+    room = receive(*bob)
+    assert (room["users"], room["roster"]) == (["alice", "bob"], 2)
+    entrance = receive(*alice)
+    assert (entrance["type"], entrance["username"], entrance["roster"]) == \
+        ("entrance", "bob", 2)
+    bob[0].close()
+    exit = receive(*alice)
+    assert (exit["type"], exit["username"], exit["roster"]) == \
+        ("exit", "bob", 3)
+    main = rooms.join("main")
+    assert main.roster_frame() is main.roster_frame()
+    alice[0].sendall(encode_frame({"type":"roster"}))
+    roster = receive(*alice)
+    assert (roster["users"], roster["roster"]) == (["alice"], 3)
+
+def test_client_asks_for_the_roster_after_a_missed_delta():
+    logic = QAClientLogic()
+    logic.handle_server_msg([0, {"type":"room", "server":{}, "roster":4}])
+    delta = {"type":"entrance", "username":"bob", "roster":5}
+    assert logic.handle_server_msg([0, delta]) == [0, delta]
+    assert logic.handle_server_msg([0, dict(delta, roster=5)]) is None
+    assert logic.handle_server_msg([0, dict(delta, roster=7)]) is None
+    assert logic.send_queue.get_nowait() == {"type":"roster"}
+    logic.handle_server_msg([0, {"type":"roster", "roster":7, "users":["bob"]}])
+    assert logic.roster_version == 7
+
+def test_client_counts_sequence_numbers_from_what_it_received():
+    logic = QAClientLogic()
+    logic.last_seq = 3
+    logic.handle_server_msg([0, {"type":"room", "server":{}, "seq":10,
+                                 "resumed":True, "history":2}])
+    assert logic.last_seq == 3
+    logic.handle_server_msg([0, {"type":"pubmsg", "msg":"missed", "seq":4}])
+    assert logic.last_seq == 4
+    logic.handle_server_msg([0, {"type":"room", "server":{}, "seq":10,
+                                 "resumed":False, "history":2}])
+    assert logic.last_seq is None
+    logic.handle_server_msg([0, {"type":"pubmsg", "msg":"history", "seq":9}])
+    assert logic.last_seq == 9
+
+def test_clients_that_ask_get_compressed_messages(server, monkeypatch):
+    monkeypatch.setattr(qa_server.MRCStreamHandler, "compress_threshold", 64)
+    plain = logon(server, "plain")
+    receive(*plain)
+    squeezed = logon(server, "squeezed", features=["deflate"])
+    first_byte = squeezed[0].recv(1, socket.MSG_PEEK)
+    room = receive(*squeezed)
+    assert (first_byte[0], room["server"]["features"]) == (0x03, ["deflate"])
+    for text in ("hi", "a much longer message " * 10):
+        plain[0].sendall(encode_frame({"type":"pubmsg", "msg":text}))
+        assert receive(*plain)["msg"] == receive(*squeezed)["msg"] == text
+
+def test_history_reaches_clients_that_ask_for_compression(server, monkeypatch):
+    monkeypatch.setattr(qa_server.MRCStreamHandler, "compress_threshold", 64)
+    alice = logon(server, "alice")
+    receive(*alice)
+    texts = ["message number {} ".format(number) * 5 for number in range(3)]
+    for text in texts:
+        alice[0].sendall(encode_frame({"type":"pubmsg", "msg":text}))
+        assert receive(*alice)["msg"] == text
+    late = logon(server, "late", features=["deflate"])
+    assert receive(*late)["history"] == 3
+    assert [receive(*late)["msg"] for text in texts] == texts
+
+def test_a_bad_message_does_not_stop_the_room(start_server):
+    server, rooms = start_server()
+    alice = logon(server, "alice")
+    receive(*alice)
+    bob = logon(server, "bob")
+    receive(*bob)
+    alice[0].sendall(encode_frame({"type":"screenshot",
+                                   "screenshot":"b'\\x89PNG\\r\\n'"}))
+    error = receive(*alice)
+    assert (error["type"], error["request"]) == ("error", "screenshot")
+    room = rooms.join()
+    filter_pubmsg = room.filter_pubmsg
+    def failing_filter(recipients, connection, pubmsg):
+        room.filter_pubmsg = filter_pubmsg
+        raise RuntimeError("filter failed")
+    room.filter_pubmsg = failing_filter
+    alice[0].sendall(encode_frame({"type":"pubmsg", "msg":"lost"}))
+    alice[0].sendall(encode_frame({"type":"pubmsg", "msg":"after"}))
+    assert receive(*bob)["msg"] == "after"
+
+def test_pubmsg_text_must_be_a_string(start_server):
+    server, rooms = start_server(swear_filter=SwearFilter(["darn"]))
+    alice = logon(server, "alice")
+    receive(*alice)
+    for text in (5, ["hi"], None):
+        alice[0].sendall(encode_frame({"type":"pubmsg", "msg":text}))
+        error = receive(*alice)
+        assert (error["type"], error["request"]) == ("error", "pubmsg")
+    room = rooms.join()
+    room.put_msg_into_publish_queue(
+        ({"type":"pubmsg", "msg":5, "username":"alice"}, 
+         room.recipients[0]))
+    alice[0].sendall(encode_frame({"type":"pubmsg", "msg":"still here"}))
+    assert receive(*alice)["msg"] == "still here"
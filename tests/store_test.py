@@ -0,0 +1,73 @@
+import os
+import json
+import hashlib
+import qa_server
+from qa_store import ScreenshotStore
+from qa_common import Attachment, encode_frame, encode_message
+from clients import logon, receive, receive_frame
+
+def test_duplicate_screenshots_are_stored_once():
+    store = ScreenshotStore()
+    first = store.put(b"same image")
+    assert store.put(b"same image") == first
+    assert first == hashlib.sha256(b"same image").hexdigest()
+    assert store.get(first) == b"same image"
+    assert store.get("0" * 64) is None
+    stats = store.stats()
+    assert stats["memory_entries"] == 1
+    assert stats["memory_bytes"] == len(b"same image")
+    assert (stats["puts"], stats["duplicates"]) == (2, 1)
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+    assert stats["hit_rate"] == 0.5
+
+def test_least_recently_used_screenshots_are_evicted():
+    store = ScreenshotStore(memory_limit=250)
+    used = store.put(b"\x00" * 100)
+    old = store.put(b"\x01" * 100)
+    store.get(used)
+    new = store.put(b"\x02" * 100)
+    assert old not in store
+    assert used in store and new in store
+    assert store.stats()["evictions"] == 1
+
+def test_evicted_screenshots_spill_to_disk(tmp_path):
+    store = ScreenshotStore(memory_limit=150, spill_directory=str(tmp_path),
+                            disk_limit=250)
+    digests = [store.put(bytes([i]) * 100) for i in range(4)]
+    stats = store.stats()
+    assert (stats["memory_entries"], stats["disk_entries"]) == (1, 2)
+    assert digests[0] not in store
+    assert store.get(digests[1]) == b"\x01" * 100
+    assert store.stats()["disk_reads"] == 1
+    assert sorted(os.listdir(str(tmp_path))) == sorted([digests[2], digests[3]])
+
+def test_admins_are_sent_references_and_fetch_screenshots(server, monkeypatch):
+    monkeypatch.setattr(qa_server.MRCStreamHandler, "admin_key", "secret")
+    admin = logon(server, "admin", "admin", ["attachments", "screenshot_refs"],
+                  admin_key="secret")
+    receive(*admin)
+    student = logon(server, "student", "user", ["attachments"])
+    receive(*student)
+    body = os.urandom(50000)
+    for _ in range(2):
+        student[0].sendall(encode_message(
+            {"type":"screenshot", "attachment":body}))
+    references = [receive(*admin), receive(*admin)]
+    digest = hashlib.sha256(body).hexdigest()
+    for reference in references:
+        assert reference["type"] == "screenshot_ref"
+        assert reference["hash"] == digest
+        assert (reference["size"], reference["username"]) == (50000, "student")
+    admin[0].sendall(encode_frame({"type":"fetch_screenshot", "hash":digest}))
+    frame = receive_frame(*admin)
+    assert isinstance(frame, Attachment)
+    assert json.loads(frame.header) == {"type":"screenshot", "hash":digest}
+    assert frame.body == body
+    admin[0].sendall(encode_frame({"type":"fetch_screenshot", "hash":"0" * 64}))
+    error = receive(*admin)
+    assert (error["type"], error["request"]) == ("error", "fetch_screenshot")
+    admin[0].sendall(encode_frame({"type":"screenshot_stats"}))
+    stats = receive(*admin)["stats"]
+    assert (stats["memory_entries"], stats["duplicates"]) == (1, 1)
+    student[0].sendall(encode_frame({"type":"fetch_screenshot", "hash":digest}))
+    assert receive(*student)["type"] == "error"
@@ -0,0 +1,74 @@
+import os
+import json
+import time
+import base64
+import qa_server
+from qa_client import QAClientLogic
+from qa_common import Attachment, CHUNK_SIZE, encode_frame, encode_message
+from clients import logon, receive, receive_frame, main_room
+
+def wait_for_room(logic):
+    deadline = time.time() + 5
+    while not logic.features and time.time() < deadline:
+        time.sleep(0.01)
+    return logic.get_msg()
+
+def test_screenshot_file_streams_in_chunks(server, tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    streaming_admin = logon(server, "streaming", "admin", 
+                            ["attachments", "streams"])
+    receive(*streaming_admin)
+    legacy_admin = logon(server, "legacy", "admin", [])
+    receive(*legacy_admin)
+    logic = QAClientLogic(read_size=4096)
+    assert logic.connect(*server.server_address)
+    logic.logon()
+    room = wait_for_room(logic)
+    assert room[1]["server"]["features"] == ["attachments", "binary", 
+                                             "deflate", "roster",
+                                             "screenshot_refs", "streams"]
+    screenshot = os.urandom(CHUNK_SIZE * 5 + 123)
+    path = tmp_path / "screenshot.png"
+    path.write_bytes(screenshot)
+    logic.screenshot_file(str(path))
+    logic.pubmsg("sent while streaming")
+    chunks = []
+    while not chunks or not chunks[-1][0]["final"]:
+        frame = receive_frame(*streaming_admin)
+        if isinstance(frame, Attachment):
+            chunks.append((json.loads(frame.header), frame.body))
+    assert [header["seq"] for header, body in chunks] == list(range(6))
+    assert b"".join(body for header, body in chunks) == screenshot
+    messages = [receive(*legacy_admin), receive(*legacy_admin)]
+    legacy = [message for message in messages 
+              if message["type"] == "screenshot"][0]
+    assert base64.b64decode(legacy["screenshot"]) == screenshot
+
+def test_incoming_chunks_are_reassembled():
+    logic = QAClientLogic()
+    for seq, part in enumerate([b"abc", b"def"]):
+        message = {"type":"screenshot_chunk", "stream":7, "seq":seq, 
+                   "final":seq == 1, "username":"student", "attachment":part}
+        result = logic.handle_server_msg([0, message])
+    assert result[1] == {"type":"screenshot", "username":"student",
+                         "attachment":b"abcdef"}
+
+def test_bad_and_oversize_streams_are_refused(server, monkeypatch):
+    monkeypatch.setattr(qa_server.MRCStreamHandler, "max_stream_bytes", 10)
+    student = logon(server, "student", "user", ["attachments", "streams"])
+    receive(*student)
+    student[0].sendall(encode_frame({"type":"screenshot_chunk", "stream":1,
+                                     "seq":0, "final":False}))
+    assert receive(*student)["type"] == "error"
+    for seq in range(2):
+        student[0].sendall(encode_message(
+            {"type":"screenshot_chunk", "stream":1, "seq":seq, 
+             "final":False, "attachment":b"12345678"}))
+    replies = sorted([receive(*student), receive(*student)],
+                     key=lambda reply: reply["type"])
+    assert [reply["type"] for reply in replies] == ["credit", "error"]
+    assert (replies[1]["reason"], replies[1]["stream"]) == \
+        ("The screenshot is too large.", 1)
+    student[0].sendall(encode_frame({"type":"pubmsg", "msg":"still here"}))
+    assert receive(*student)["msg"] == "still here"
+    assert main_room()._reassembly == {}
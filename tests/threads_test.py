@@ -0,0 +1,42 @@
+import socket
+import socketserver
+import qa_server
+from qa_common import encode_frame
+from clients import logon, receive
+
+def test_logon_and_pubmsg(start_server):
+    server, rooms = start_server(threaded=True)
+    alice = logon(server, "alice")
+    assert receive(*alice)["type"] == "room"
+    bob = logon(server, "bob")
+    assert sorted(receive(*bob)["users"]) == ["alice", "bob"]
+    alice[0].sendall(encode_frame({"type":"pubmsg", "msg":"hi"}))
+    for client in (alice, bob):
+        assert receive(*client)["msg"] == "hi"
+
+def test_failing_handler_leaves_the_room(start_server):
+    server, rooms = start_server(threaded=True)
+    alice = logon(server, "alice")
+    receive(*alice)
+    bob = logon(server, "bob")
+    receive(*bob)
+    bob[0].sendall(encode_frame({"type":"bogus"}))
+    assert bob[0].recv(65536) == b""
+    carol = logon(server, "carol")
+    assert sorted(receive(*carol)["users"]) == ["alice", "carol"]
+
+def test_workers_share_a_port_before_python_3_11(monkeypatch):
+    def server_bind(self):
+        # TCPServer.server_bind() as it was before allow_reuse_port
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(self.server_address)
+        self.server_address = self.socket.getsockname()
+    monkeypatch.setattr(socketserver.TCPServer, "server_bind", server_bind)
+    monkeypatch.setattr(qa_server.QAServer, "allow_reuse_port", True)
+    first = qa_server.QAServer(("localhost", 0), qa_server.MRCStreamHandler)
+    try:
+        second = qa_server.QAServer(first.server_address,
+                                    qa_server.MRCStreamHandler)
+        second.server_close()
+    finally:
+        first.server_close()